@@ -10,6 +10,10 @@ from app.main_route import main_blueprint
 from app.member_similarity_route import member_similarity_blueprint
 from app.lsi_route import lsi_blueprint
 from app.cluster_route import cluster_blueprint
+from app.services import search
+from modules.db import database_url
+from app.services.models import load_models
+from app.services import semantic_search
 
 db = SQLAlchemy()
 
@@ -21,17 +25,22 @@ def create_app():
 
     load_dotenv()
     # Database configuration
-    db_user = os.getenv('db_user')
-    db_password = os.getenv('db_password')
-    db_host = os.getenv('db_host')
-    db_port = os.getenv('db_port', 5432)  # Default to 5432 if not set
-    db_name = os.getenv('db_name')
-    app.config["SQLALCHEMY_DATABASE_URI"] = f'postgresql+psycopg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}'
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_url()
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
     # Initialize the database
     db.init_app(app)
 
+    # Serve searches from the memory-mapped inverted index when it is enabled
+    if search.SEARCH_BACKEND == "index":
+        search.load_search_index()
+
+    # Memory-map the fitted models (TF-IDF, LSI, cluster centroids) persisted by the pipeline
+    load_models()
+
+    # Memory-map the approximate nearest-neighbour index over the LSI vectors, if it was built
+    semantic_search.load_lsi_index()
+
     # Register blueprints
 
     app.register_blueprint(main_blueprint)
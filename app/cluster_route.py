@@ -1,69 +1,77 @@
 from flask import Blueprint, render_template, request
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
+from modules.db import get_engine
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 import pandas as pd
+from app.services.models import get_model
+from app.services.cluster_summary import get_cluster_summary
 from math import ceil
-import os
-from dotenv import load_dotenv
 
-# Load environment variables
-load_dotenv()
-
-# Database connection details
-db_user = os.getenv("db_user")
-db_password = os.getenv("db_password")
-db_host = os.getenv("db_host")
-db_port = os.getenv("db_port")
-db_name = os.getenv("db_name")
-
-# Create the database engine
-engine = create_engine(f"postgresql+psycopg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}")
+# Shared, pooled database engine (see modules/db.py)
+engine = get_engine("app")
 
 cluster_blueprint = Blueprint('clusters', __name__)
 
 ITEMS_PER_PAGE = 10  # Number of speeches per page
+RECOMMENDATIONS = 5  # Similar speeches returned per speech
 
 
 @cluster_blueprint.route('/clusters', methods=['GET'])
 def clusters():
     """Main route to display clusters and speeches."""
     try:
-        # Fetch all unique cluster IDs
-        with engine.connect() as connection:
-            cluster_ids = connection.execute(text("""
-                SELECT DISTINCT cluster_id FROM clustered_speeches ORDER BY cluster_id
-            """)).fetchall()
-            cluster_ids = [row[0] for row in cluster_ids]
+        # Cluster ids, sizes and top terms come from the cached summary written at clustering time
+        summary = get_cluster_summary(engine)
+        cluster_ids = [cluster['cluster_id'] for cluster in summary]
+        sizes = {cluster['cluster_id']: cluster['size'] for cluster in summary}
 
-        # Get query parameters
+        # Get query parameters; pages are addressed by the speech id they start after (or end before)
         cluster_id = request.args.get('cluster_id', cluster_ids[0] if cluster_ids else 0, type=int)
-        page = request.args.get('page', 1, type=int)
-        offset = (page - 1) * ITEMS_PER_PAGE
+        page = max(request.args.get('page', 1, type=int), 1)
+        after = request.args.get('after', type=int)
+        before = request.args.get('before', type=int)
 
-        # Fetch speeches for the selected cluster
+        # Keyset pagination over the (cluster_id, speech_id) index, every page costs the same
         with engine.connect() as connection:
-            speeches = connection.execute(text("""
-                SELECT f.id, f.member_name, f.sitting_date, f.political_party, f.merged_speech
-                FROM clustered_speeches c
-                JOIN final_speeches f ON c.speech_id = f.id
-                WHERE c.cluster_id = :cluster_id
-                ORDER BY f.id
-                LIMIT :limit OFFSET :offset
-            """), {"cluster_id": cluster_id, "limit": ITEMS_PER_PAGE, "offset": offset}).fetchall()
-
-            # Count total speeches in the cluster for pagination
-            total_count = connection.execute(text("""
-                SELECT COUNT(*) FROM clustered_speeches
-                WHERE cluster_id = :cluster_id
-            """), {"cluster_id": cluster_id}).scalar()
+            if before is not None:
+                speeches = connection.execute(text("""
+                    SELECT f.id, f.member_name, f.sitting_date, f.political_party, f.merged_speech
+                    FROM clustered_speeches c
+                    JOIN final_speeches f ON c.speech_id = f.id
+                    WHERE c.cluster_id = :cluster_id AND c.speech_id < :before
+                    ORDER BY c.speech_id DESC
+                    LIMIT :limit
+                """), {"cluster_id": cluster_id, "before": before, "limit": ITEMS_PER_PAGE}).fetchall()[::-1]
+            else:
+                speeches = connection.execute(text("""
+                    SELECT f.id, f.member_name, f.sitting_date, f.political_party, f.merged_speech
+                    FROM clustered_speeches c
+                    JOIN final_speeches f ON c.speech_id = f.id
+                    WHERE c.cluster_id = :cluster_id AND c.speech_id > :after
+                    ORDER BY c.speech_id
+                    LIMIT :limit
+                """), {"cluster_id": cluster_id, "after": after if after is not None else -1,
+                       "limit": ITEMS_PER_PAGE}).fetchall()
+            if not speeches and (after is not None or before is not None):
+                # A stale keyset (e.g. the cluster was re-clustered) ran off the end: start over
+                speeches = connection.execute(text("""
+                    SELECT f.id, f.member_name, f.sitting_date, f.political_party, f.merged_speech
+                    FROM clustered_speeches c
+                    JOIN final_speeches f ON c.speech_id = f.id
+                    WHERE c.cluster_id = :cluster_id
+                    ORDER BY c.speech_id
+                    LIMIT :limit
+                """), {"cluster_id": cluster_id, "limit": ITEMS_PER_PAGE}).fetchall()
+                page = 1
 
         # Calculate total pages
-        total_pages = ceil(total_count / ITEMS_PER_PAGE)
+        total_pages = ceil(sizes.get(cluster_id, 0) / ITEMS_PER_PAGE)
 
         return render_template(
             'clusters.html',
             cluster_ids=cluster_ids,
+            clusters=summary,
             selected_cluster=cluster_id,
             speeches=speeches,
             current_page=page,
@@ -80,10 +88,28 @@ def recommend_similar_speeches(speech_id, cluster_id):
 
 
 
-@cluster_blueprint.route('/clusters/similar_json/<int:speech_id>/<int:cluster_id>', methods=['GET'])
-def recommend_similar_speeches_json(speech_id, cluster_id):
-    """Return top 5 similar speeches as JSON, excluding the speech itself."""
-    try:
+def compute_similar_speeches(speech_id, cluster_id, limit=RECOMMENDATIONS):
+    """
+    Rank the speeches of a cluster by their cosine similarity to `speech_id` on the fly.
+    Only used for speeches that have no precomputed neighbours yet.
+    """
+    model = get_model("tfidf")
+    if model is not None:
+        # Project the cluster's processed speeches with the TF-IDF model fitted by the pipeline
+        with engine.connect() as connection:
+            result = connection.execute(text("""
+                SELECT c.speech_id, p.processed_speech
+                FROM clustered_speeches c
+                JOIN processed_speeches p ON p.speech_id = c.speech_id
+                WHERE c.cluster_id = :cluster_id
+            """), {"cluster_id": cluster_id})
+            speeches = pd.DataFrame(result.fetchall(), columns=["id", "processed_speech"])
+
+        tfidf_matrix = model["model"].transform(speeches["processed_speech"].fillna(""))
+        target_index = speeches.index[speeches["id"] == speech_id][0]
+        # Rows are L2-normalised, so the dot product is the cosine similarity
+        cosine_similarities = (tfidf_matrix @ tfidf_matrix[target_index].T).toarray().ravel()
+    else:
         # Fetch all speeches for the cluster
         with engine.connect() as connection:
             result = connection.execute(text("""
@@ -97,23 +123,39 @@ def recommend_similar_speeches_json(speech_id, cluster_id):
         # Find the selected speech
         target_speech = speeches.loc[speeches["id"] == speech_id, "merged_speech"].values[0]
 
-        # Compute cosine similarity
+        # No stored model yet: fit one on the cluster
         vectorizer = TfidfVectorizer(stop_words="english")
         tfidf_matrix = vectorizer.fit_transform([target_speech] + speeches["merged_speech"].tolist())
         cosine_similarities = cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:]).flatten()
 
-        # Add similarity scores to speeches and filter out the target speech
-        speeches["similarity"] = cosine_similarities
-        filtered_speeches = speeches[speeches["id"] != speech_id]
+    # Add similarity scores to speeches and filter out the target speech
+    speeches["similarity"] = cosine_similarities
+    filtered_speeches = speeches[speeches["id"] != speech_id]
+
+    # Get the most similar speeches
+    top_speeches = filtered_speeches.sort_values(by="similarity", ascending=False).head(limit)
+    return top_speeches[["id", "similarity"]].to_dict(orient="records")
+
+
+@cluster_blueprint.route('/clusters/similar_json/<int:speech_id>/<int:cluster_id>', methods=['GET'])
+def recommend_similar_speeches_json(speech_id, cluster_id):
+    """Return top 5 similar speeches as JSON, excluding the speech itself."""
+    try:
+        # Neighbours precomputed by modules/create_speech_neighbours.py, read through the primary key
+        with engine.connect() as connection:
+            result = connection.execute(text("""
+                SELECT neighbour_id, similarity
+                FROM speech_neighbours
+                WHERE speech_id = :speech_id
+                ORDER BY rank
+                LIMIT :limit
+            """), {"speech_id": speech_id, "limit": RECOMMENDATIONS}).fetchall()
+        recommendations = [{"id": row[0], "similarity": row[1]} for row in result]
 
-        # Get top 5 similar speeches
-        top_speeches = filtered_speeches.sort_values(by="similarity", ascending=False).head(5)
+        if not recommendations:
+            recommendations = compute_similar_speeches(speech_id, cluster_id)
 
         # Return JSON response
-        return {
-            "recommendations": top_speeches[["id", "similarity"]].to_dict(orient="records")
-        }
+        return {"recommendations": recommendations}
     except Exception as e:
         return {"error": str(e)}
-
-
@@ -1,22 +1,13 @@
 from flask import Blueprint, jsonify , render_template , request
-from sqlalchemy import create_engine, text
-from dotenv import load_dotenv
-import os
-
-# Load environment variables
-load_dotenv()
+from sqlalchemy import text
+from modules.db import get_engine
+from app.services.semantic_search import more_like_this, semantic_search, DEFAULT_NEIGHBOURS
 
 # Flask Blueprint
 lsi_blueprint = Blueprint("lsi", __name__)
 
-# Database connection details
-db_user = os.getenv("db_user")
-db_password = os.getenv("db_password")
-db_host = os.getenv("db_host")
-db_port = os.getenv("db_port")
-db_name = os.getenv("db_name")
-
-engine = create_engine(f"postgresql+psycopg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}")
+# Shared, pooled database engine (see modules/db.py)
+engine = get_engine("app")
 
 @lsi_blueprint.route("/lsi_vectors", methods=["GET"])
 def get_lsi_vectors():
@@ -49,3 +40,29 @@ def get_lsi_vectors():
         )
     except Exception as e:
         return render_template("error.html", error_message=str(e))
+
+
+@lsi_blueprint.route("/lsi/similar/<int:speech_id>", methods=["GET"])
+def similar_speeches(speech_id):
+    """"More like this": the speeches closest to a speech in LSI space, from the ANN index."""
+    try:
+        k = min(max(request.args.get("k", DEFAULT_NEIGHBOURS, type=int), 1), 100)
+        results = more_like_this(speech_id, k)
+        if results is None:
+            return jsonify({"error": "Speech not found in the LSI index"}), 404
+        return jsonify({"speech_id": speech_id, "results": results})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@lsi_blueprint.route("/lsi/search", methods=["GET"])
+def semantic_search_route():
+    """Semantic search: project the query into LSI space and return the closest speeches."""
+    try:
+        query = request.args.get("q", "").strip()
+        if not query:
+            return jsonify({"error": "Missing query parameter 'q'"}), 400
+        k = min(max(request.args.get("k", DEFAULT_NEIGHBOURS, type=int), 1), 100)
+        return jsonify({"query": query, "results": semantic_search(query, k)})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
@@ -1,20 +1,51 @@
+from math import ceil
 from flask import Blueprint, render_template, request, jsonify
-from app.services.search import search_speeches
+from modules.db import pool_metrics
+from app.services.search import search_speeches_page, get_speech, RESULTS_PER_PAGE, SCORERS, DEFAULT_SCORER
 
 main_blueprint = Blueprint("main", __name__)
 
 @main_blueprint.route("/", methods=['GET', 'POST'])
 def index():
-    if request.method == 'POST':
-        search_term = request.form['search_term']
+    # The form submits with POST, the pagination links with GET
+    search_term = request.values.get('search_term', '').strip()
+    if search_term:
+        page = max(request.args.get('page', 1, type=int), 1)
+        scorer = request.values.get('scorer', DEFAULT_SCORER)
+        if scorer not in SCORERS:
+            scorer = DEFAULT_SCORER
+
         # Call the search function and pass the user query
-        results = search_speeches(search_term)
+        search_page = search_speeches_page(search_term, limit=RESULTS_PER_PAGE,
+                                           offset=(page - 1) * RESULTS_PER_PAGE, scorer=scorer)
 
         # Return the results to the same template
-        return render_template('index.html', results=results, search_term=search_term)
+        return render_template(
+            'index.html',
+            results=search_page['results'],
+            search_term=search_term,
+            scorer=scorer,
+            scorers=SCORERS,
+            current_page=page,
+            total_pages=ceil(search_page['total'] / RESULTS_PER_PAGE),
+            total_results=search_page['total']
+        )
+
+    # If there is no search term, just show the search form
+    return render_template('index.html', results=None, scorer=DEFAULT_SCORER, scorers=SCORERS)
+
+@main_blueprint.route('/speech/<int:speech_id>')
+def speech(speech_id):
+    """Return the full text of a speech, loaded on demand from the search results."""
+    result = get_speech(speech_id)
+    if result is None:
+        return jsonify({"error": "Speech not found"}), 404
+    return jsonify(result)
 
-    # If GET request, just show the search form
-    return render_template('index.html', results=None)
+@main_blueprint.route('/metrics/db')
+def db_metrics():
+    """Connection pool usage and checkout wait times of this process."""
+    return jsonify(pool_metrics())
 
 @main_blueprint.route('/about')
 def about():
@@ -1,20 +1,10 @@
 from flask import Blueprint, render_template, request
-from sqlalchemy import create_engine, text
-from dotenv import load_dotenv
-import os
+from sqlalchemy import text
+from modules.db import get_engine
+from app.services.lookup_cache import get_members
 
-# Load environment variables
-load_dotenv()
-
-# Fetch database credentials from .env
-db_user = os.getenv("db_user")
-db_password = os.getenv("db_password")
-db_host = os.getenv("db_host")
-db_port = os.getenv("db_port")
-db_name = os.getenv("db_name")
-
-# Create the database engine
-engine = create_engine(f"postgresql+psycopg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}", echo=False)
+# Shared, pooled database engine (see modules/db.py)
+engine = get_engine("app")
 
 # Define the blueprint
 member_similarity_blueprint = Blueprint('member_similarity', __name__)
@@ -22,12 +12,8 @@ member_similarity_blueprint = Blueprint('member_similarity', __name__)
 @member_similarity_blueprint.route('/member_similarity', methods=['GET', 'POST'])
 def member_similarity():
     try:
-        # Step 1: Fetch all members from the database
-        members_query = text("SELECT DISTINCT member_1 FROM member_similarity_scores")
-
-        with engine.connect() as connection:
-            members = connection.execute(members_query).fetchall()
-            members = [member[0] for member in members]  # Extract member names
+        # Step 1: Fetch all members from the cached members dimension table
+        members = get_members(engine)
 
         # Step 2: Handle the form submission (selected member and k)
         if request.method == 'POST':
@@ -0,0 +1,17 @@
+from sqlalchemy import text
+from app.services.lookup_cache import lookup_cache
+
+
+def load_cluster_summary(connection):
+    rows = connection.execute(text(
+        "SELECT cluster_id, size, top_terms FROM cluster_summary ORDER BY cluster_id"
+    )).fetchall()
+    return [{'cluster_id': row[0], 'size': row[1], 'top_terms': row[2] or []} for row in rows]
+
+
+def get_cluster_summary(engine):
+    """
+    Return the cluster summary written at clustering time as a list of
+    {'cluster_id', 'size', 'top_terms'} dicts ordered by cluster id, cached until reclustering.
+    """
+    return lookup_cache.get("cluster_summary", engine, load_cluster_summary, dataset="clusters")
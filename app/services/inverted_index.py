@@ -0,0 +1,107 @@
+import json
+from pathlib import Path
+import numpy as np
+from modules.artifact_store import CURRENT_LINK
+
+
+class InvertedIndex:
+    """
+    Read-only inverted index over the files written by `modules/create_search_index.py`.
+    Every array is memory-mapped, so several worker processes serving the app share the same pages.
+    """
+
+    def __init__(self, path):
+        # Rebuilt indexes are published as v<N> directories behind a "current" symlink; resolving
+        # it pins this instance to one version while the pipeline publishes the next
+        current = Path(path) / CURRENT_LINK
+        path = current.resolve() if current.exists() else Path(path)
+        self.path = path
+        self.terms = np.load(path / "terms.npy", mmap_mode="r")
+        self.offsets = np.load(path / "offsets.npy", mmap_mode="r")
+        self.speech_ids = np.load(path / "speech_ids.npy", mmap_mode="r")
+        self.weights = np.load(path / "weights.npy", mmap_mode="r")
+        bm25_path = path / "bm25_weights.npy"
+        self.bm25_weights = np.load(bm25_path, mmap_mode="r") if bm25_path.exists() else None
+        with open(path / "meta.json", encoding="utf-8") as f:
+            self.meta = json.load(f)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def term_index(self, term):
+        """Binary search the sorted term array, returning the term's position or None."""
+        position = int(np.searchsorted(self.terms, term))
+        if position < len(self.terms) and self.terms[position] == term:
+            return position
+        return None
+
+    def postings(self, term, scorer="tfidf"):
+        """
+        Return the (speech_ids, tfidf_weights, scorer_weights) postings of a term, empty arrays if
+        it is unknown. The scorer weights are the BM25 weights for "bm25", the TF-IDF ones otherwise.
+        """
+        position = self.term_index(term)
+        if position is None:
+            empty = np.empty(0, dtype=np.float32)
+            return np.empty(0, dtype=np.int32), empty, empty
+        start, end = self.offsets[position], self.offsets[position + 1]
+        weights = self.weights[start:end]
+        if scorer == "bm25":
+            if self.bm25_weights is None:
+                raise ValueError("The search index was built without BM25 weights.")
+            return self.speech_ids[start:end], weights, self.bm25_weights[start:end]
+        return self.speech_ids[start:end], weights, weights
+
+    def search(self, terms, k, min_weight=0.0, offset=0, scorer="tfidf"):
+        """
+        Rank speeches for a list of distinct terms and return (page, total_matches), where `page`
+        holds the `k` best (speech_id, score) pairs after skipping the first `offset`.
+
+        Scorers mirror the SQL ones in services/search.py. "tfidf": speeches containing every term
+        (among postings above `min_weight`) win if there are any, otherwise any speech whose
+        average weight over the matched terms exceeds `min_weight`; the score is that average.
+        "bm25": sum of the BM25 weights. "cosine": sum of the unit-length TF-IDF weights divided
+        by the norm of the binary query vector.
+        """
+        if k <= 0:
+            return [], 0
+        matched_ids, matched_weights = [], []
+        for term in terms:
+            ids, tfidf_weights, weights = self.postings(term, scorer)
+            keep = tfidf_weights > min_weight
+            matched_ids.append(ids[keep])
+            matched_weights.append(weights[keep])
+        if not matched_ids:
+            return [], 0
+
+        all_ids = np.concatenate(matched_ids)
+        if not len(all_ids):
+            return [], 0
+        all_weights = np.concatenate(matched_weights).astype(np.float64)
+
+        # Each speech appears at most once per term, so the group size is the number of matched terms
+        unique_ids, inverse = np.unique(all_ids, return_inverse=True)
+        sums = np.bincount(inverse, weights=all_weights)
+
+        if scorer == "tfidf":
+            counts = np.bincount(inverse)
+            scores = sums / counts
+            if counts.max() == len(terms):
+                mask = counts == len(terms)
+            else:
+                mask = scores > min_weight
+            unique_ids, scores = unique_ids[mask], scores[mask]
+        elif scorer == "cosine":
+            scores = sums / np.sqrt(len(terms))
+        else:
+            scores = sums
+        total = len(scores)
+
+        # Partial selection of the best offset + k candidates, only those get fully sorted
+        wanted = offset + k
+        if total > wanted:
+            top = np.argpartition(-scores, wanted - 1)[:wanted]
+            unique_ids, scores = unique_ids[top], scores[top]
+        # Highest score first, ties broken by speech id like the SQL ORDER BY
+        order = np.lexsort((unique_ids, -scores))[offset:wanted]
+        return [(int(unique_ids[i]), float(scores[i])) for i in order], total
@@ -0,0 +1,85 @@
+import os
+import time
+import threading
+from sqlalchemy import text
+
+LOOKUP_CACHE_TTL = int(os.getenv("lookup_cache_ttl", 300))  # Seconds before a cached list is revalidated
+
+VERSION_QUERY = text("SELECT version FROM dataset_versions WHERE name = :name")
+
+
+class LookupCache:
+    """
+    Process-wide cache for small lookup lists (members, parties, cluster summary).
+
+    An entry is served from memory for `ttl` seconds. After that the pipeline's version of the
+    underlying dataset (the dataset_versions table) is read with a primary key lookup, and the list
+    is only reloaded if the version changed or is unknown.
+    """
+
+    def __init__(self, ttl=LOOKUP_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _read_version(self, engine, dataset):
+        try:
+            with engine.connect() as connection:
+                return connection.execute(VERSION_QUERY, {"name": dataset}).scalar()
+        except Exception:
+            # No dataset_versions table yet: fall back to plain TTL expiry
+            return None
+
+    def get(self, name, engine, loader, dataset=None):
+        """
+        Return the cached value of `name`, calling `loader(connection)` to (re)load it. `dataset` is
+        the dataset_versions entry whose change invalidates the value.
+        """
+        now = time.monotonic()
+        entry = self._entries.get(name)
+        if entry is not None and now - entry["checked_at"] < self.ttl:
+            return entry["value"]
+
+        version = self._read_version(engine, dataset) if dataset else None
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and version is not None and entry["version"] == version:
+                entry["checked_at"] = now
+                return entry["value"]
+            with engine.connect() as connection:
+                value = loader(connection)
+            self._entries[name] = {"value": value, "version": version, "checked_at": now}
+            return value
+
+    def invalidate(self, name=None):
+        """Drop one cached value, or all of them."""
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
+
+
+lookup_cache = LookupCache()
+
+
+def get_members(engine):
+    """Names of all members, from the members dimension table."""
+    return lookup_cache.get(
+        "members", engine,
+        lambda connection: [row[0] for row in connection.execute(
+            text("SELECT member_name FROM members ORDER BY member_name")
+        )],
+        dataset="dimensions"
+    )
+
+
+def get_parties(engine):
+    """Names of all political parties, from the parties dimension table."""
+    return lookup_cache.get(
+        "parties", engine,
+        lambda connection: [row[0] for row in connection.execute(
+            text("SELECT political_party FROM parties ORDER BY political_party")
+        )],
+        dataset="dimensions"
+    )
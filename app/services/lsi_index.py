@@ -0,0 +1,84 @@
+import json
+from pathlib import Path
+import numpy as np
+from modules.artifact_store import CURRENT_LINK
+
+
+class LsiIndex:
+    """
+    Read-only inverted-file (IVF) index over the LSI vectors, written by `modules/create_lsi_index.py`.
+    Vectors are unit length and grouped by their nearest centroid, so a query only scores the
+    vectors of the `nprobe` lists closest to it. Every array is memory-mapped.
+    """
+
+    def __init__(self, path, nprobe=8):
+        # Rebuilt indexes are published as v<N> directories behind a "current" symlink; resolving
+        # it pins this instance to one version while the pipeline publishes the next
+        current = Path(path) / CURRENT_LINK
+        path = current.resolve() if current.exists() else Path(path)
+        self.path = path
+        self.nprobe = nprobe
+        self.centroids = np.load(path / "centroids.npy", mmap_mode="r")
+        self.offsets = np.load(path / "offsets.npy", mmap_mode="r")
+        self.speech_ids = np.load(path / "speech_ids.npy", mmap_mode="r")
+        self.vectors = np.load(path / "vectors.npy", mmap_mode="r")
+        # Speech ids in ascending order and the position of each one's vector, for binary search
+        self.sorted_ids = np.load(path / "sorted_ids.npy", mmap_mode="r")
+        self.id_positions = np.load(path / "id_positions.npy", mmap_mode="r")
+        with open(path / "meta.json", encoding="utf-8") as f:
+            self.meta = json.load(f)
+
+    def __len__(self):
+        return len(self.speech_ids)
+
+    def vector(self, speech_id):
+        """Return the stored unit-length vector of a speech, or None if it isn't indexed."""
+        position = int(np.searchsorted(self.sorted_ids, speech_id))
+        if position < len(self.sorted_ids) and self.sorted_ids[position] == speech_id:
+            return np.asarray(self.vectors[self.id_positions[position]])
+        return None
+
+    def search(self, vector, k=10, nprobe=None, exclude=()):
+        """
+        Return the `k` (speech_id, cosine similarity) pairs closest to `vector`, best first,
+        scanning the `nprobe` inverted lists whose centroids are most similar to it.
+        """
+        if k <= 0:
+            return []
+        query = np.asarray(vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return []
+        query = query / norm
+
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        centroid_scores = self.centroids @ query
+        probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+
+        candidate_ids, candidate_scores = [], []
+        for probe in probes:
+            start, end = self.offsets[probe], self.offsets[probe + 1]
+            if start == end:
+                continue
+            candidate_ids.append(self.speech_ids[start:end])
+            candidate_scores.append(self.vectors[start:end] @ query)
+        if not candidate_ids:
+            return []
+        ids = np.concatenate(candidate_ids)
+        scores = np.concatenate(candidate_scores)
+
+        if exclude:
+            keep = ~np.isin(ids, list(exclude))
+            ids, scores = ids[keep], scores[keep]
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            ids, scores = ids[top], scores[top]
+        order = np.lexsort((ids, -scores))
+        return [(int(ids[i]), float(scores[i])) for i in order]
+
+    def more_like_this(self, speech_id, k=10, nprobe=None):
+        """Return the `k` speeches most similar to an indexed speech, excluding the speech itself."""
+        vector = self.vector(speech_id)
+        if vector is None:
+            return None
+        return self.search(vector, k, nprobe, exclude=(speech_id,))
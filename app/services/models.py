@@ -0,0 +1,31 @@
+from modules.artifact_store import load_artifact
+
+# Fitted models loaded from the artifact store at application startup, keyed by artifact name
+ARTIFACT_NAMES = ("tfidf", "lsi", "kmeans")
+models = {}
+
+
+def load_models(names=ARTIFACT_NAMES):
+    """
+    Load the fitted models written by the pipeline. Large arrays are memory-mapped, so worker
+    processes serving the app share the same pages. Missing artifacts are skipped.
+    """
+    for name in names:
+        try:
+            artifact = load_artifact(name, mmap=True)
+        except Exception as e:
+            artifact = None
+            print(f"Could not load the '{name}' model: {e}")
+        if artifact is None:
+            models.pop(name, None)
+            continue
+        models[name] = artifact
+        print(f"Loaded the '{name}' model (version {artifact['version']}).")
+    return models
+
+
+def get_model(name):
+    """Return a loaded artifact, loading it on first use; None if the pipeline hasn't produced it."""
+    if name not in models:
+        load_models((name,))
+    return models.get(name)
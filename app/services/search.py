@@ -1,24 +1,20 @@
 import os
+from pathlib import Path
 import spacy
-import re
-import unicodedata
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
+from modules.db import get_engine
 from dotenv import load_dotenv
 from greek_stemmer import GreekStemmer  # Ensure this is correctly imported
 from sqlalchemy.dialects.postgresql import ARRAY
+from markupsafe import Markup, escape
+from modules.token_cache import TokenCache, stem_token, remove_accents
+from app.services.inverted_index import InvertedIndex
 
 # Load environment variables
 load_dotenv()
 
-# Fetch database credentials from .env
-db_user = os.getenv("db_user")
-db_password = os.getenv("db_password")
-db_host = os.getenv("db_host")
-db_port = os.getenv("db_port")
-db_name = os.getenv("db_name")
-
-# Create the database engine
-engine = create_engine(f"postgresql+psycopg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}", echo=False)
+# Shared, pooled database engine (see modules/db.py)
+engine = get_engine("app")
 
 # Load the Greek language model from spaCy
 nlp = spacy.load("el_core_news_sm")
@@ -29,207 +25,272 @@ stopwords = nlp.Defaults.stop_words
 # Initialize Greek stemmer
 greek_stemmer = GreekStemmer()  # Assuming GreekStemmer has been correctly initialized
 
+# Surface form -> stem cache, warm-started from the one persisted by the preprocessing pipeline
+token_cache = TokenCache.load()
 
-def remove_accents(text):
-    """Remove accents from Greek words."""
-    if not text:
-        return ''
-    normalized_text = unicodedata.normalize('NFD', text)
-    accent_removed_text = ''.join(
-        char for char in normalized_text if unicodedata.category(char) != 'Mn'
-    )
-    return unicodedata.normalize('NFC', accent_removed_text)
-
+# Optional in-process search backend ("index"), loaded at application startup
+SEARCH_BACKEND = os.getenv("search_backend", "db")
+SEARCH_INDEX_PATH = Path(os.getenv("search_index_path", Path(__file__).resolve().parents[2] / "data" / "search_index"))
+search_index = None
 
-def preprocess_query(query, nlp, greek_stopwords, stemmer):
-    """
-    Preprocess the search query by:
-    1. Removing unwanted patterns (special characters and punctuation)
-    2. Converting to lowercase
-    3. Removing accents
-    4. Tokenizing
-    5. Removing stopwords
-    6. Stemming
-    """
-    # Remove unwanted characters and punctuation (similar to the chunk preprocessing)
-    UNWANTED_PATTERN = re.compile(r'[0-9@#$%^&*()\-\_=+\[\]{};:\'",.<>/?\\|`~!]')  # Define unwanted pattern
-    TAB_PATTERN = re.compile(r'\t+')  # Define tab pattern
 
-    # Step 1: Uppercase the query
-    query = query.upper()
+def load_search_index(path=SEARCH_INDEX_PATH):
+    """Memory-map the inverted index built by modules/create_search_index.py and serve searches from it."""
+    global search_index
+    try:
+        search_index = InvertedIndex(path)
+        print(f"Loaded search index from {path}: {search_index.meta}")
+    except Exception as e:
+        search_index = None
+        print(f"Could not load search index from {path}, falling back to the database: {e}")
+    return search_index
 
-    # Step 2: Remove unwanted patterns and tabs from the query
-    query = UNWANTED_PATTERN.sub('', query)
-    query = TAB_PATTERN.sub('', query)
 
-    # Step 3: Remove accents
-    query = remove_accents(query)
+def preprocess_query(query, nlp, greek_stopwords, stemmer, cache=None):
+    """
+    Preprocess the search query the same way speeches are preprocessed:
+    1. Tokenizing
+    2. Removing unwanted patterns (special characters and punctuation)
+    3. Uppercasing and removing accents
+    4. Removing stopwords
+    5. Stemming
+    Cleaning and stemming go through the token cache shared with the preprocessing pipeline.
+    """
+    cache = cache if cache is not None else token_cache
 
-    # Step 4: Tokenize the query using spaCy
+    # Step 1: Tokenize the query using spaCy
     doc = nlp(query)
 
-    # Step 5: Process tokens by removing stopwords and applying stemming
+    # Steps 2-5: Normalise and stem every token, dropping stopwords and single characters
     processed_query = []
-
     for token in doc:
-        # Skip if token is empty, a stopword, or a single character
-        cleaned_token = token.text
-        if cleaned_token in greek_stopwords or len(cleaned_token) <= 1:
-            continue
-
-        # Apply stemming
-        stemmed_token = stemmer.stem(cleaned_token)
+        stemmed_token = stem_token(token.text, stemmer, greek_stopwords, cache)
 
-        # Add the processed (stemmed) token
+        # Add the processed (stemmed) token, lowercased like the TF-IDF vocabulary
         if stemmed_token:
-            stemmed_token_final= stemmed_token.lower()
-            processed_query.append(stemmed_token_final)
+            processed_query.append(stemmed_token.lower())
 
-    # Step 6: Return the final preprocessed query
+    # Return the final preprocessed query
     return " ".join(processed_query)
 
 
+MIN_TFIDF = 0.2  # Postings below this TF-IDF value are ignored by the "tfidf" scorer
+
+# Pluggable scorers: how the postings of the query terms are aggregated per speech. BM25 weights
+# and L2-normalised TF-IDF values are precomputed by the pipeline (modules/create_tf_idf.py), so
+# every scorer is a single pass over the matching postings without per-query normalisation.
+SCORERS = {
+    # Average TF-IDF of the matched terms, speeches containing every term first
+    "tfidf": {"score": "AVG(tfidf_value)", "min_weight": MIN_TFIDF, "require_all_terms": True},
+    # Okapi BM25: sum of the precomputed per-posting BM25 weights
+    "bm25": {"score": "SUM(bm25_weight)", "min_weight": 0.0, "require_all_terms": False},
+    # Cosine between the (binary, unit-length) query vector and the unit-length speech vector
+    "cosine": {"score": "SUM(tfidf_value) / SQRT(:term_count)", "min_weight": 0.0, "require_all_terms": False},
+}
+DEFAULT_SCORER = os.getenv("search_scorer", "tfidf")
+
+# Resolves every query term to its id through the terms dictionary, scores the speeches over the
+# postings (clustered by term id, so each term's postings are read contiguously) and joins their
+# metadata in a single statement.
+# With the "tfidf" scorer, speeches containing all terms are returned if there are any, otherwise
+# every speech matching at least one term is ranked by its average TF-IDF value.
+# ORDER BY ... LIMIT lets PostgreSQL keep only the top offset + limit rows in a bounded heap,
+# and COUNT(*) OVER () reports the total number of matches for pagination.
+SEARCH_QUERY_TEMPLATE = """
+    WITH matches AS (
+        SELECT p.speech_id,
+               {score} AS score,
+               COUNT(DISTINCT p.term_id) AS matched_terms
+        FROM terms t
+        JOIN tfidf_postings p ON p.term_id = t.term_id
+        WHERE t.term = ANY(:terms) AND p.tfidf_value > :min_weight
+        GROUP BY p.speech_id
+    ),
+    ranked AS (
+        SELECT speech_id, score, matched_terms,
+               MAX(matched_terms) OVER () AS best_match
+        FROM matches
+    ),
+    selected AS (
+        SELECT speech_id, score, COUNT(*) OVER () AS total
+        FROM ranked
+        WHERE {match_filter}
+        ORDER BY score DESC, speech_id
+        LIMIT :limit OFFSET :offset
+    )
+    SELECT f.id, f.merged_speech, f.member_name, f.sitting_date, f.political_party, f.roles, s.score, s.total
+    FROM selected s
+    JOIN final_speeches f ON f.id = s.speech_id
+    ORDER BY s.score DESC, f.id
+"""
+ALL_TERMS_FILTER = """(best_match = :term_count AND matched_terms = :term_count)
+           OR (best_match < :term_count AND score > :min_weight)"""
+
+SEARCH_QUERIES = {
+    name: text(SEARCH_QUERY_TEMPLATE.format(
+        score=scorer["score"],
+        match_filter=ALL_TERMS_FILTER if scorer["require_all_terms"] else "TRUE"
+    ))
+    for name, scorer in SCORERS.items()
+}
+
+# Metadata of speeches ranked by the in-memory index, fetched by primary key
+SPEECHES_BY_ID_QUERY = text("""
+    SELECT id, merged_speech, member_name, sitting_date, political_party, roles
+    FROM final_speeches
+    WHERE id = ANY(:ids)
+""")
+
+DEFAULT_LIMIT = 100  # Maximum number of speeches returned by a search
+RESULTS_PER_PAGE = 10  # Speeches per page of search results
+SNIPPET_WORDS = 30  # Words of context shown around the first matched term
+SNIPPET_SCAN_WORDS = 20000  # Stop looking for a matched term after this many words
+SNIPPET_PREFIX_CHARS = 3  # Leading characters a word must share with a query term before it is stemmed
+
+# Accented Greek letters (monotonic and polytonic) -> unaccented ones, and combining accents
+# (left by str.upper on e.g. 'ΐ') -> nothing, so a whole speech is normalised with one str.translate
+ACCENT_TABLE = {
+    code: remove_accents(chr(code))
+    for code in [*range(0x370, 0x400), *range(0x1F00, 0x2000)]
+    if remove_accents(chr(code)) not in ('', chr(code))
+}
+ACCENT_TABLE.update(dict.fromkeys(range(0x300, 0x370)))
+# Characters the preprocessing strips from tokens, skipped at the start of a word by the snippet pre-check
+LEADING_STRIPPED = "0123456789@#$%^&*()-_=+[]{};:'\",.<>/?\\|`~!"
+
+
+def rank_with_index(terms, limit, offset=0, scorer=DEFAULT_SCORER):
+    """
+    Rank speeches with the in-memory inverted index and attach their metadata.
+    Ranking never touches the database; only the rows of the requested page are looked up by id.
+    Returns (rows, total_matches).
+    """
+    ranked, total = search_index.search(terms, limit, min_weight=SCORERS[scorer]["min_weight"],
+                                        offset=offset, scorer=scorer)
+    if not ranked:
+        return [], total
+    with engine.connect() as connection:
+        speeches = {
+            row[0]: row for row in
+            connection.execute(SPEECHES_BY_ID_QUERY, {'ids': [speech_id for speech_id, _ in ranked]}).fetchall()
+        }
+    return [tuple(speeches[speech_id]) + (score,) for speech_id, score in ranked if speech_id in speeches], total
 
 
+def extract_snippet(speech, terms, window=SNIPPET_WORDS):
+    """
+    Return an HTML-safe excerpt of `window` words around the first word whose stem is one of
+    the query terms, with every matching word wrapped in <mark>.
 
-def search_speeches(query):
+    The stemmer only rewrites word endings, so a word can only stem to a query term if its
+    uppercased, unaccented form starts with the term's first characters. That check is a cheap
+    string comparison; only the few words passing it are stemmed (and enter the token cache).
     """
-    Search for speeches based on a query (multiple terms), return those containing all terms,
-    or if no such speech, return the best matching speeches based on TF-IDF score > 0.2.
+    if not speech:
+        return Markup('')
+    words = speech.split()
+    normalised_words = speech.upper().translate(ACCENT_TABLE).split()
+    if len(normalised_words) != len(words):
+        # Only possible for a "word" made of combining accents alone
+        normalised_words = [remove_accents(word.upper()) for word in words]
+    terms = set(terms)
+    prefixes = tuple({term.upper()[:SNIPPET_PREFIX_CHARS] for term in terms})
+
+    def matches(i):
+        if not normalised_words[i].lstrip(LEADING_STRIPPED).startswith(prefixes):
+            return False
+        stemmed = stem_token(words[i], greek_stemmer, stopwords, token_cache)
+        return bool(stemmed) and stemmed.lower() in terms
+
+    first_match = next((i for i in range(min(len(words), SNIPPET_SCAN_WORDS)) if matches(i)), 0)
+    start = max(0, first_match - window // 2)
+    end = min(len(words), start + window)
+
+    parts = [Markup('<mark>{}</mark>').format(words[i]) if matches(i) else escape(words[i]) for i in range(start, end)]
+    snippet = Markup(' ').join(parts)
+    if start > 0:
+        snippet = Markup('… ') + snippet
+    if end < len(words):
+        snippet = snippet + Markup(' …')
+    return snippet
+
+
+def search_speeches_page(query, limit=RESULTS_PER_PAGE, offset=0, scorer=DEFAULT_SCORER):
     """
+    Ranked retrieval: score speeches for the query with one of SCORERS ("tfidf" returns speeches
+    containing all query terms or, if there are none, the best partial matches with TF-IDF
+    score > 0.2; "bm25" and "cosine" rank every speech matching any term) and return one page.
+
+    Only the top `offset + limit` speeches are ever ranked in full and each result carries a
+    snippet around the matched terms instead of the whole speech.
+    Returns {'results': [...], 'total': total_matches, 'terms': [...]}.
+    """
+    page = {'results': [], 'total': 0, 'terms': []}
+    if scorer not in SCORERS:
+        scorer = DEFAULT_SCORER
     try:
         # Preprocess the query before performing the search
         processed_query = preprocess_query(query, nlp, stopwords, greek_stemmer)
         print(f"Processed query: {processed_query}")  # Debugging log for the processed query
 
-        # Split the query into individual terms for multi-term search
-        terms = processed_query.split()  # Processed query will have individual terms
+        # Split the query into individual terms for multi-term search (repeated terms count once)
+        terms = list(dict.fromkeys(processed_query.split()))
+        page['terms'] = terms
         if not terms:
             print("No terms found in query after preprocessing.")  # Debug log if no valid terms
-            return []
-
-        # Create a dictionary to hold speech IDs and their aggregated TF-IDF scores
-        speech_scores = {}
-        speeches_with_all_terms = {}
+            return page
 
-        # Use full-text search for matching terms in the term_vector column
-        for term in terms:
-            sql_query = text("""
-                SELECT speech_id, tfidf_value 
-                FROM tfidf_values 
-                WHERE term = :term AND tfidf_value > 0.2  -- Filter by tfidf_value > 0.2
-            """)
-
-            # Execute the query with the current term
+        if search_index is not None:
+            rows, page['total'] = rank_with_index(terms, limit, offset, scorer)
+        else:
             with engine.connect() as connection:
-                result = connection.execute(sql_query, {'term': term}).fetchall()
-
-            print(f"Result for term '{term}': {result}")  # Debug log for query result
-
-            # Aggregate the TF-IDF values for each speech
-            for row in result:
-                speech_id = row[0]  # Get the speech ID
-                tfidf_value = row[1]  # Get the TF-IDF value
-
-                # If speech_id already in the dictionary, add the TF-IDF value, otherwise, initialize it
-                if speech_id in speech_scores:
-                    speech_scores[speech_id].append(tfidf_value)
-                else:
-                    speech_scores[speech_id] = [tfidf_value]
-
-                # Check if this speech contains all terms and store it separately
-                if speech_id not in speeches_with_all_terms:
-                    speeches_with_all_terms[speech_id] = set()
-                speeches_with_all_terms[speech_id].add(term)
-
-        # Identify speeches that contain all terms
-        complete_match_speeches = {
-            speech_id: data for speech_id, data in speeches_with_all_terms.items()
-            if len(data) == len(terms)  # All terms must be present in the speech
-        }
-
-        # If no speeches contain all terms, return the best matching speeches based on TF-IDF scores
-        results_with_tfidf = []
-        if complete_match_speeches:
-            # Only include speeches that contain all the query terms
-            for speech_id in complete_match_speeches:
-                # Calculate the aggregated TF-IDF score (average of all terms for the speech)
-                aggregated_score = sum(speech_scores[speech_id]) / len(speech_scores[speech_id])
-
-                # Fetch the corresponding speech details from final_speeches table
-                sql_speeches_query = text("""
-                    SELECT id, merged_speech, member_name, sitting_date, political_party, roles
-                    FROM final_speeches 
-                    WHERE id = :speech_id
-                """)
-
-                with engine.connect() as connection:
-                    speech_result = connection.execute(sql_speeches_query, {'speech_id': speech_id}).fetchone()
-
-                if speech_result:
+                rows = connection.execute(SEARCH_QUERIES[scorer], {
+                    'terms': terms,
+                    'term_count': len(terms),
+                    'min_weight': SCORERS[scorer]["min_weight"],
+                    'limit': limit,
+                    'offset': offset
+                }).fetchall()
+            # Every row carries the window total; an empty page past the end reports none
+            page['total'] = rows[0][7] if rows else 0
+
+        for speech_id, merged_speech, member_name, sitting_date, political_party, roles, score, *_ in rows:
+            page['results'].append({
+                'speech': {
+                    'id': speech_id,
+                    'snippet': extract_snippet(merged_speech, terms),
+                    'member_name': member_name,
                     # Format the sitting_date to show only the date part (YYYY-MM-DD)
-                    formatted_sitting_date = speech_result[3].strftime('%Y-%m-%d') if speech_result[3] else None
-
-                    results_with_tfidf.append({
-                        'speech': {
-                            'id': speech_result[0],
-                            'merged_speech': speech_result[1],
-                            'member_name': speech_result[2],
-                            'sitting_date': formatted_sitting_date,  # Use formatted date here
-                            'political_party': speech_result[4],
-                            'roles': speech_result[5]
-                        },
-                        'tfidf_value': aggregated_score  # Display the aggregated TF-IDF score
-                    })
+                    'sitting_date': sitting_date.strftime('%Y-%m-%d') if sitting_date else None,
+                    'political_party': political_party,
+                    'roles': roles
+                },
+                'tfidf_value': score  # Display the aggregated relevance score
+            })
 
-
-        else:
-            # If no speech has all the terms, return the top speeches based on individual term matches
-            for speech_id, scores in speech_scores.items():
-                # Calculate the average score for each speech
-                avg_score = sum(scores) / len(scores)
-
-                # Only include speeches with an aggregated score > 0.2
-                if avg_score > 0.2:
-                    sql_speeches_query = text("""
-                        SELECT id, merged_speech, member_name, sitting_date, political_party, roles
-                        FROM final_speeches 
-                        WHERE id = :speech_id
-                    """)
-
-                    with engine.connect() as connection:
-                        speech_result = connection.execute(sql_speeches_query, {'speech_id': speech_id}).fetchone()
-
-                    if speech_result:
-                        results_with_tfidf.append({
-                            'speech': {
-                                'id': speech_result[0],
-                                'merged_speech': speech_result[1],
-                                'member_name': speech_result[2],
-                                'sitting_date': speech_result[3],
-                                'political_party': speech_result[4],
-                                'roles': speech_result[5]
-                            },
-                            'tfidf_value': avg_score  # Display the aggregated TF-IDF score
-                        })
-
-        # Order the results by TF-IDF value in descending order
-        results_with_tfidf = sorted(results_with_tfidf, key=lambda x: x['tfidf_value'], reverse=True)
-
-        return results_with_tfidf
+        return page
 
     except Exception as e:
         print(f"Error occurred during search: {e}")
-        return []
-
-
-
-
-
-
-
-
-
-
+        return page
 
 
+def search_speeches(query, limit=DEFAULT_LIMIT, scorer=DEFAULT_SCORER):
+    """
+    Search for speeches based on a query (multiple terms), return those containing all terms,
+    or if no such speech, return the best matching speeches based on TF-IDF score > 0.2.
+    Results come back ranked by score and limited to `limit` speeches.
+    """
+    return search_speeches_page(query, limit=limit, scorer=scorer)['results']
+
+
+def get_speech(speech_id):
+    """Fetch the full text of a single speech, for on-demand display next to the search results."""
+    with engine.connect() as connection:
+        row = connection.execute(
+            text("SELECT id, member_name, merged_speech FROM final_speeches WHERE id = :speech_id"),
+            {'speech_id': speech_id}
+        ).fetchone()
+    if row is None:
+        return None
+    return {'id': row[0], 'member_name': row[1], 'merged_speech': row[2]}
@@ -0,0 +1,72 @@
+import os
+from pathlib import Path
+from app.services.lsi_index import LsiIndex
+from app.services.models import get_model
+from app.services.search import (
+    engine, nlp, stopwords, greek_stemmer, preprocess_query, SPEECHES_BY_ID_QUERY
+)
+
+# Approximate nearest-neighbour index over the LSI vectors, loaded at application startup
+LSI_INDEX_PATH = Path(os.getenv("lsi_index_path", Path(__file__).resolve().parents[2] / "data" / "lsi_index"))
+LSI_INDEX_NPROBE = int(os.getenv("lsi_index_nprobe", 8))  # Inverted lists scanned per query
+DEFAULT_NEIGHBOURS = 10
+lsi_index = None
+
+
+def load_lsi_index(path=LSI_INDEX_PATH, nprobe=LSI_INDEX_NPROBE):
+    """Memory-map the LSI index built by modules/create_lsi_index.py."""
+    global lsi_index
+    try:
+        lsi_index = LsiIndex(path, nprobe=nprobe)
+        print(f"Loaded LSI index from {path}: {lsi_index.meta}")
+    except Exception as e:
+        lsi_index = None
+        print(f"Could not load LSI index from {path}, semantic search is disabled: {e}")
+    return lsi_index
+
+
+def attach_speech_metadata(ranked):
+    """Turn (speech_id, similarity) pairs into result dicts with the speeches' metadata."""
+    if not ranked:
+        return []
+    with engine.connect() as connection:
+        speeches = {
+            row[0]: row for row in
+            connection.execute(SPEECHES_BY_ID_QUERY, {'ids': [speech_id for speech_id, _ in ranked]}).fetchall()
+        }
+    results = []
+    for speech_id, similarity in ranked:
+        if speech_id not in speeches:
+            continue
+        _, _, member_name, sitting_date, political_party, _ = speeches[speech_id]
+        results.append({
+            'id': speech_id,
+            'member_name': member_name,
+            'sitting_date': sitting_date.strftime('%Y-%m-%d') if sitting_date else None,
+            'political_party': political_party,
+            'similarity': similarity
+        })
+    return results
+
+
+def more_like_this(speech_id, k=DEFAULT_NEIGHBOURS):
+    """Return the `k` speeches closest to `speech_id` in LSI space, None if the speech isn't indexed."""
+    if lsi_index is None:
+        raise RuntimeError("The LSI index is not loaded, build it with modules/create_lsi_index.py.")
+    ranked = lsi_index.more_like_this(speech_id, k)
+    return None if ranked is None else attach_speech_metadata(ranked)
+
+
+def semantic_search(query, k=DEFAULT_NEIGHBOURS):
+    """Project a free-text query into LSI space with the stored LSI model and return the `k` closest speeches."""
+    if lsi_index is None:
+        raise RuntimeError("The LSI index is not loaded, build it with modules/create_lsi_index.py.")
+    model = get_model("lsi")
+    if model is None:
+        raise RuntimeError("No LSI model found in the artifact store, run the LSI stage first.")
+
+    processed_query = preprocess_query(query, nlp, stopwords, greek_stemmer)
+    if not processed_query:
+        return []
+    vector = model["svd"].transform(model["vectorizer"].transform([processed_query]))[0]
+    return attach_speech_metadata(lsi_index.search(vector, k))
@@ -0,0 +1,258 @@
+import os
+import sys
+import logging
+import numpy as np
+from sqlalchemy import text
+from modules.db import get_engine
+from dotenv import load_dotenv
+from modules.import_csv_to_db import copy_csv_to_postgresql, add_source_row_column, source_row_column
+from modules.create_final_speeches import GROUP_COLUMNS, GROUP_MATCH, ID_ORDER
+from modules.preprocess import create_processed_speeches_table, preprocess_and_store_speeches
+from modules.create_tf_idf import fold_in_term_weights, iter_posting_rows, replace_rows
+from modules.cluster_speeches import predict_in_batches
+from modules.create_dimensions import bump_dataset_version
+from modules.pipeline import bump_table_versions
+from modules.artifact_store import load_artifact, refresh_fingerprint, corpus_fingerprint
+
+# Load environment variables
+load_dotenv()
+
+# Shared, pooled database engine (see modules/db.py)
+engine = get_engine()
+
+DELTA_TABLE = "speeches_delta"  # Raw rows of the delta CSV, until they are merged
+PENDING_TABLE = "pending_appends"  # Ids of merged speeches not yet folded into the models, or refitted over
+# Above either threshold the new speeches are not folded in and the models have to be refitted
+DRIFT_THRESHOLD = float(os.getenv("append_drift_threshold", 0.05))  # Share of new tokens outside the fitted vocabulary
+MAX_GROWTH = float(os.getenv("append_max_growth", 0.2))  # Speeches added since the last fit, relative to the fitted corpus
+
+# Logging setup
+logging.basicConfig(level=logging.INFO)
+
+
+def create_pending_table(connection):
+    connection.execute(text(f"CREATE TABLE IF NOT EXISTS {PENDING_TABLE} (speech_id BIGINT PRIMARY KEY);"))
+
+
+def pending_speech_ids(connection):
+    return connection.execute(text(f"SELECT speech_id FROM {PENDING_TABLE} ORDER BY speech_id")).scalars().all()
+
+
+def clear_pending_appends(speech_ids=None):
+    """Forget the pending speeches once they are folded in (`speech_ids`), or all of them after a full refit."""
+    with engine.begin() as connection:
+        create_pending_table(connection)
+        if speech_ids is None:
+            connection.execute(text(f"TRUNCATE {PENDING_TABLE};"))
+        else:
+            connection.execute(text(f"DELETE FROM {PENDING_TABLE} WHERE speech_id = ANY(:ids)"), {"ids": speech_ids})
+
+
+def merge_delta(connection):
+    """
+    Merge the rows of the delta table into `speeches` and `final_speeches`: speeches of a (member,
+    sitting) group that already exists are appended to its merged_speech, new groups get ids after
+    the current maximum. The ids of every changed or new speech are recorded as pending in the same
+    transaction, and returned.
+    """
+    columns = ", ".join(GROUP_COLUMNS)
+    connection.execute(text(f"""
+        CREATE TEMPORARY TABLE delta_groups ON COMMIT DROP AS
+        SELECT {columns}, STRING_AGG(speech, ' ' ORDER BY {source_row_column}) AS merged_speech
+        FROM {DELTA_TABLE}
+        WHERE member_name IS NOT NULL AND sitting_date IS NOT NULL
+        GROUP BY {columns};
+    """))
+
+    updated_ids = connection.execute(text(f"""
+        UPDATE final_speeches f
+        SET merged_speech = f.merged_speech || ' ' || d.merged_speech
+        FROM delta_groups d
+        WHERE {GROUP_MATCH}
+        RETURNING f.id;
+    """)).scalars().all()
+
+    inserted_ids = connection.execute(text(f"""
+        INSERT INTO final_speeches (id, {columns}, merged_speech)
+        SELECT (SELECT COALESCE(MAX(id), 0) FROM final_speeches) + ROW_NUMBER() OVER (ORDER BY {", ".join(ID_ORDER)}),
+               {columns}, merged_speech
+        FROM delta_groups d
+        WHERE NOT EXISTS (SELECT 1 FROM final_speeches f WHERE {GROUP_MATCH})
+        RETURNING id;
+    """)).scalars().all()
+
+    # Keep the raw table complete, so a full rebuild includes the delta; the delta's rows are
+    # numbered after the existing ones, in their load order
+    add_source_row_column(connection)
+    delta_columns = connection.execute(text("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_name = :table AND column_name <> :source_row ORDER BY ordinal_position
+    """), {"table": DELTA_TABLE, "source_row": source_row_column}).scalars().all()
+    column_list = ", ".join(f'"{column}"' for column in delta_columns)
+    connection.execute(text(
+        f"INSERT INTO speeches ({column_list}) SELECT {column_list} FROM {DELTA_TABLE} ORDER BY {source_row_column};"
+    ))
+    connection.execute(text(f"TRUNCATE {DELTA_TABLE};"))
+
+    # Extended speeches are preprocessed again
+    if updated_ids:
+        connection.execute(text("DELETE FROM processed_speeches WHERE speech_id = ANY(:ids)"), {"ids": updated_ids})
+    create_pending_table(connection)
+    connection.execute(text(f"""
+        INSERT INTO {PENDING_TABLE} (speech_id) SELECT unnest(CAST(:ids AS BIGINT[]))
+        ON CONFLICT (speech_id) DO NOTHING;
+    """), {"ids": updated_ids + inserted_ids})
+    # Tell the pipeline's watermarks about the writes in place
+    for table in ("speeches", "final_speeches", "processed_speeches"):
+        bump_dataset_version(connection, table)
+    logging.info(f"Merged the delta: {len(updated_ids)} speeches extended, {len(inserted_ids)} new speeches.")
+    return sorted(updated_ids + inserted_ids)
+
+
+def fetch_processed_speeches(connection, speech_ids):
+    rows = connection.execute(text("""
+        SELECT speech_id, processed_speech FROM processed_speeches
+        WHERE speech_id = ANY(:ids)
+        ORDER BY speech_id
+    """), {"ids": speech_ids}).fetchall()
+    return [row[0] for row in rows], [row[1] for row in rows]
+
+
+def measure_drift(connection, speeches, tfidf_artifact):
+    """
+    Return (share of the new speeches' tokens outside the fitted vocabulary, growth of the corpus
+    since the models were fitted).
+    """
+    vectorizer = tfidf_artifact["model"][0]
+    analyzer = vectorizer.build_analyzer()
+    vocabulary = vectorizer.vocabulary_
+    n_tokens = n_known = 0
+    for speech in speeches:
+        tokens = analyzer(speech)
+        n_tokens += len(tokens)
+        n_known += sum(token in vocabulary for token in tokens)
+    oov_rate = 1 - n_known / n_tokens if n_tokens else 0.0
+
+    n_fitted = tfidf_artifact["metadata"].get("n_speeches") or 0
+    n_speeches = connection.execute(text("SELECT COUNT(*) FROM processed_speeches")).scalar()
+    growth = (n_speeches - n_fitted) / n_fitted if n_fitted else float("inf")
+    return oov_rate, growth
+
+
+def fold_in_tfidf(connection, speech_ids, speeches, tfidf_artifact):
+    """Weigh the new speeches with the stored TF-IDF model and write their tfidf_postings and speech_stats rows."""
+    avg_doc_length = connection.execute(text("SELECT AVG(doc_length) FROM speech_stats")).scalar() or 0.0
+    _, tfidf_matrix, bm25_matrix, doc_lengths = fold_in_term_weights(
+        speeches, tfidf_artifact["model"], tfidf_artifact["metadata"]["n_speeches"], float(avg_doc_length)
+    )
+    # Term ids are vocabulary indexes, so the stored model's terms are already in the terms table.
+    # tfidf_postings is keyed by term, so deleting the old postings of extended speeches scans it once.
+    row_count = replace_rows("tfidf_postings", ["term_id", "speech_id", "tfidf_value", "bm25_weight"], "speech_id",
+                             speech_ids, iter_posting_rows(tfidf_matrix, bm25_matrix, speech_ids))
+    replace_rows("speech_stats", ["speech_id", "doc_length"], "speech_id",
+                 speech_ids, zip(speech_ids, doc_lengths.tolist()))
+    bump_table_versions(["tfidf_postings", "speech_stats"])
+    logging.info(f"Folded {len(speech_ids)} speeches into tfidf_postings ({row_count} rows).")
+
+
+def fold_in_lsi(speech_ids, speeches, lsi_artifact):
+    """Project the new speeches with the stored LSI model and write their lsi_speeches rows. Returns the vectors."""
+    vectors = lsi_artifact["svd"].transform(lsi_artifact["vectorizer"].transform(speeches))
+    replace_rows("lsi_speeches", ["speech_id", "lsi_vector"], "speech_id",
+                 speech_ids, zip(speech_ids, vectors.tolist()))
+    bump_table_versions(["lsi_speeches"])
+    logging.info(f"Folded {len(speech_ids)} speeches into lsi_speeches.")
+    return vectors
+
+
+def assign_clusters(speech_ids, vectors, kmeans_artifact):
+    """Assign the new speeches to the nearest stored centroid and refresh the cluster sizes."""
+    clusters = predict_in_batches(kmeans_artifact["kmeans"], np.asarray(vectors, dtype=np.float32))
+    replace_rows("clustered_speeches", ["speech_id", "cluster_id"], "speech_id",
+                 speech_ids, zip(speech_ids, clusters.tolist()))
+    with engine.begin() as connection:
+        for table in ("cluster_centroids", "cluster_summary"):
+            connection.execute(text(f"""
+                UPDATE {table} t
+                SET size = c.size
+                FROM (SELECT cluster_id, COUNT(*) AS size FROM clustered_speeches GROUP BY cluster_id) c
+                WHERE t.cluster_id = c.cluster_id;
+            """))
+        for table in ("clustered_speeches", "cluster_centroids", "cluster_summary"):
+            bump_dataset_version(connection, table)
+        bump_dataset_version(connection, "clusters")
+    logging.info(f"Assigned {len(speech_ids)} speeches to the stored clusters.")
+
+
+def append_speeches(csv_path, drift_threshold=DRIFT_THRESHOLD, max_growth=MAX_GROWTH):
+    """
+    Append a CSV of new sittings without rebuilding everything: load it into the delta table,
+    merge only the affected (member, sitting) groups, preprocess only those speeches and fold
+    them into tfidf_postings, lsi_speeches and clustered_speeches with the stored models.
+
+    If the new speeches drift too far from the fitted models (too many unknown tokens, or the
+    corpus grew too much since the last fit) nothing is folded in and the TF-IDF, LSI and
+    clustering stages have to be rerun. Returns a dict with the changed speech ids, whether they
+    were folded in, and the measured drift.
+
+    The merge and each fold-in step commit separately, so the merged ids stay pending until all
+    steps are done. A later run (even of a delta loaded already) folds in the pending speeches
+    again, which the idempotent replace_rows allows, and reports them as not folded in until then.
+    """
+    try:
+        # The import checkpoint keys on the file path: a delta file that was loaded already is not loaded twice
+        logging.info(f"Loading {csv_path} into {DELTA_TABLE}...")
+        copy_csv_to_postgresql(csv_path, target_table=DELTA_TABLE)
+
+        create_processed_speeches_table()
+        with engine.begin() as connection:
+            merged_ids = merge_delta(connection)
+            speech_ids = pending_speech_ids(connection)
+        if not speech_ids:
+            logging.info("The delta contains no new speeches.")
+            return {"speech_ids": [], "folded_in": True, "oov_rate": 0.0, "growth": 0.0}
+        if len(speech_ids) > len(merged_ids):
+            logging.info(f"Resuming {len(speech_ids) - len(merged_ids)} speeches of an unfinished append.")
+
+        preprocess_and_store_speeches(start_after=speech_ids[0] - 1)
+        bump_table_versions(["processed_speeches"])
+
+        tfidf_artifact = load_artifact("tfidf")
+        lsi_artifact = load_artifact("lsi")
+        kmeans_artifact = load_artifact("kmeans")
+        with engine.connect() as connection:
+            speech_ids, speeches = fetch_processed_speeches(connection, speech_ids)
+            if tfidf_artifact is None or lsi_artifact is None or kmeans_artifact is None:
+                logging.info("No stored models to fold the new speeches into, a full refit is needed.")
+                return {"speech_ids": speech_ids, "folded_in": False, "oov_rate": None, "growth": None}
+
+            oov_rate, growth = measure_drift(connection, speeches, tfidf_artifact)
+            logging.info(f"Drift: {oov_rate:.2%} of the new tokens are unknown, "
+                         f"the corpus grew {growth:.2%} since the last fit.")
+            result = {"speech_ids": speech_ids, "folded_in": False, "oov_rate": oov_rate, "growth": growth}
+            if oov_rate > drift_threshold or growth > max_growth:
+                logging.info("Drift is above the threshold, the models have to be refitted.")
+                return result
+
+            fold_in_tfidf(connection, speech_ids, speeches, tfidf_artifact)
+        vectors = fold_in_lsi(speech_ids, speeches, lsi_artifact)
+        assign_clusters(speech_ids, vectors, kmeans_artifact)
+
+        # The stored models now describe the extended corpus
+        with engine.connect() as connection:
+            fingerprint = corpus_fingerprint(connection)
+        for name in ("tfidf", "lsi", "kmeans"):
+            refresh_fingerprint(name, fingerprint, {"last_fold_in": len(speech_ids)})
+        clear_pending_appends(speech_ids)
+        result["folded_in"] = True
+        return result
+    except Exception as e:
+        logging.error(f"Error appending speeches: {e}")
+        raise
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python -m modules.append_speeches <delta.csv>")
+        sys.exit(1)
+    print(append_speeches(sys.argv[1]))
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+from contextlib import contextmanager
+import numpy as np
+import joblib
+from sqlalchemy import text
+
+# Root directory of the artifact store; every artifact lives in <name>/v<version>/
+project_root = Path(__file__).resolve().parent.parent
+ARTIFACT_DIR = Path(os.getenv("model_dir", project_root / "data" / "models"))
+MANIFEST_NAME = "manifest.json"
+LOCK_NAME = "manifest.lock"  # Serialises manifest updates of stages running in parallel
+CURRENT_LINK = "current"  # Symlink to the published version of a memory-mapped index directory
+KEEP_VERSIONS = 3  # Older versions of an artifact are pruned from disk
+
+
+def corpus_fingerprint(connection):
+    """
+    Fingerprint of the processed corpus (row count, highest id and total text length), used to
+    tell whether a persisted model was fitted on the data currently in processed_speeches.
+    """
+    row = connection.execute(text("""
+        SELECT COUNT(*), COALESCE(MAX(speech_id), 0), COALESCE(SUM(LENGTH(processed_speech)), 0)
+        FROM processed_speeches
+    """)).fetchone()
+    return hashlib.sha1(f"{row[0]}:{row[1]}:{row[2]}".encode()).hexdigest()[:16]
+
+
+def read_manifest(artifact_dir=ARTIFACT_DIR):
+    """Return the manifest describing the current version of every artifact."""
+    manifest_path = Path(artifact_dir) / MANIFEST_NAME
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, artifact_dir=ARTIFACT_DIR):
+    """Atomically replace the manifest."""
+    artifact_dir = Path(artifact_dir)
+    artifact_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = artifact_dir / (MANIFEST_NAME + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, artifact_dir / MANIFEST_NAME)
+
+
+@contextmanager
+def manifest_lock(artifact_dir=ARTIFACT_DIR):
+    """Hold an exclusive lock on the store, across processes, for a read-modify-write of the manifest."""
+    artifact_dir = Path(artifact_dir)
+    artifact_dir.mkdir(parents=True, exist_ok=True)
+    with open(artifact_dir / LOCK_NAME, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def reserve_version(name, artifact_dir=ARTIFACT_DIR):
+    """Create the directory of the next version of an artifact and return (version, directory)."""
+    with manifest_lock(artifact_dir):
+        versions = [read_manifest(artifact_dir).get(name, {}).get("version", 0)]
+        for version_dir in (Path(artifact_dir) / name).glob("v*"):
+            if version_dir.name[1:].isdigit():
+                versions.append(int(version_dir.name[1:]))
+        version = max(versions) + 1
+        version_dir = Path(artifact_dir) / name / f"v{version}"
+        version_dir.mkdir(parents=True)
+    return version, version_dir
+
+
+def save_artifact(name, fingerprint, objects=None, arrays=None, metadata=None, artifact_dir=ARTIFACT_DIR):
+    """
+    Store a new version of an artifact: fitted estimators go to uncompressed joblib files (so the
+    numpy arrays inside them can be memory-mapped) and plain arrays to .npy files.
+    The files are written without holding the lock; the manifest is re-read and updated under it,
+    so artifacts saved by stages running in parallel don't drop each other's entries.
+    Returns the new version number.
+    """
+    objects = objects or {}
+    arrays = arrays or {}
+    version, version_dir = reserve_version(name, artifact_dir)
+
+    for key, obj in objects.items():
+        joblib.dump(obj, version_dir / f"{key}.joblib")
+    for key, array in arrays.items():
+        np.save(version_dir / f"{key}.npy", np.asarray(array))
+
+    with manifest_lock(artifact_dir):
+        manifest = read_manifest(artifact_dir)
+        manifest[name] = {
+            "version": version,
+            "fingerprint": fingerprint,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "path": str(version_dir.relative_to(artifact_dir)),
+            "objects": sorted(objects),
+            "arrays": sorted(arrays),
+            "metadata": metadata or {}
+        }
+        write_manifest(manifest, artifact_dir)
+        prune_versions(name, version, artifact_dir)
+    logging.info(f"Saved artifact '{name}' version {version} to {version_dir}.")
+    return version
+
+
+def refresh_fingerprint(name, fingerprint, metadata=None, artifact_dir=ARTIFACT_DIR):
+    """
+    Mark the current version of an artifact as valid for the corpus with `fingerprint`, e.g. after
+    new speeches were folded in with it instead of refitting. `metadata` is merged into its metadata.
+    """
+    with manifest_lock(artifact_dir):
+        manifest = read_manifest(artifact_dir)
+        if name not in manifest:
+            return
+        manifest[name]["fingerprint"] = fingerprint
+        manifest[name]["metadata"].update(metadata or {})
+        write_manifest(manifest, artifact_dir)
+
+
+def prune_versions(name, current_version, artifact_dir=ARTIFACT_DIR):
+    """Delete all but the last KEEP_VERSIONS versions of an artifact."""
+    for version_dir in (Path(artifact_dir) / name).glob("v*"):
+        try:
+            version = int(version_dir.name[1:])
+        except ValueError:
+            continue
+        if version <= current_version - KEEP_VERSIONS:
+            shutil.rmtree(version_dir, ignore_errors=True)
+
+
+def new_version_dir(path):
+    """Create and return the next `v<N>` directory under `path`, to be written and then published."""
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    versions = [int(version_dir.name[1:]) for version_dir in path.glob("v*") if version_dir.name[1:].isdigit()]
+    version_dir = path / f"v{max(versions, default=0) + 1}"
+    version_dir.mkdir()
+    return version_dir
+
+
+def publish_version(path, version_dir):
+    """
+    Atomically point `path/current` at a fully written version directory, then prune old versions.
+    Readers that memory-mapped an earlier version keep their files, which are never rewritten in place.
+    """
+    path = Path(path)
+    tmp_link = path / (CURRENT_LINK + ".tmp")
+    tmp_link.unlink(missing_ok=True)
+    tmp_link.symlink_to(Path(version_dir).name, target_is_directory=True)
+    os.replace(tmp_link, path / CURRENT_LINK)
+    prune_versions(path.name, int(Path(version_dir).name[1:]), path.parent)
+
+
+def load_artifact(name, fingerprint=None, mmap=True, artifact_dir=ARTIFACT_DIR):
+    """
+    Load the current version of an artifact as a dict of its objects and arrays (plus "version"
+    and "metadata"). Large arrays are memory-mapped read-only when `mmap` is set. Returns None if
+    the artifact doesn't exist or, when `fingerprint` is given, was fitted on different data.
+    """
+    entry = read_manifest(artifact_dir).get(name)
+    if entry is None:
+        return None
+    if fingerprint is not None and entry["fingerprint"] != fingerprint:
+        logging.info(f"Artifact '{name}' v{entry['version']} is stale (fitted on a different corpus).")
+        return None
+
+    version_dir = Path(artifact_dir) / entry["path"]
+    mmap_mode = "r" if mmap else None
+    artifact = {"version": entry["version"], "metadata": entry.get("metadata", {})}
+    for key in entry["objects"]:
+        artifact[key] = joblib.load(version_dir / f"{key}.joblib", mmap_mode=mmap_mode)
+    for key in entry["arrays"]:
+        artifact[key] = np.load(version_dir / f"{key}.npy", mmap_mode=mmap_mode)
+    return artifact
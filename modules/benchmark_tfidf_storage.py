@@ -0,0 +1,121 @@
+import sys
+import time
+import logging
+import numpy as np
+from sqlalchemy import text
+from modules.db import get_engine
+
+# Shared, pooled database engine (see modules/db.py)
+engine = get_engine()
+
+LEGACY_TABLE = "tfidf_values_legacy"  # Copy of the old layout, built from the tfidf_values view
+N_QUERIES = 50  # Query term sets timed per layout
+TERMS_PER_QUERY = 3
+MIN_DOCUMENT_FREQUENCY = 20  # Query terms are drawn among terms at least this frequent
+RESULT_LIMIT = 100
+
+# Logging setup
+logging.basicConfig(level=logging.INFO)
+
+# The aggregation at the core of the search query ("tfidf" scorer) against either layout
+QUERIES = {
+    "legacy": f"""
+        SELECT speech_id, AVG(tfidf_value) AS score, COUNT(DISTINCT term) AS matched_terms
+        FROM {LEGACY_TABLE}
+        WHERE term = ANY(:terms) AND tfidf_value > 0.2
+        GROUP BY speech_id
+        ORDER BY matched_terms DESC, score DESC
+        LIMIT {RESULT_LIMIT}
+    """,
+    "postings": f"""
+        SELECT p.speech_id, AVG(p.tfidf_value) AS score, COUNT(DISTINCT p.term_id) AS matched_terms
+        FROM terms t
+        JOIN tfidf_postings p ON p.term_id = t.term_id
+        WHERE t.term = ANY(:terms) AND p.tfidf_value > 0.2
+        GROUP BY p.speech_id
+        ORDER BY matched_terms DESC, score DESC
+        LIMIT {RESULT_LIMIT}
+    """,
+}
+
+LAYOUT_TABLES = {
+    "legacy": [LEGACY_TABLE],
+    "postings": ["terms", "tfidf_postings"],
+}
+
+
+def build_legacy_table(connection):
+    """Rebuild the old tfidf_values layout: TEXT term per posting, FLOAT8 weights, per-row tsvector and GIN index."""
+    logging.info(f"Building {LEGACY_TABLE} with the old layout...")
+    connection.execute(text(f"DROP TABLE IF EXISTS {LEGACY_TABLE};"))
+    connection.execute(text(f"""
+        CREATE TABLE {LEGACY_TABLE} AS
+        SELECT speech_id, term, tfidf_value, bm25_weight FROM tfidf_values ORDER BY speech_id, term;
+    """))
+    connection.execute(text(f"ALTER TABLE {LEGACY_TABLE} ADD PRIMARY KEY (speech_id, term);"))
+    connection.execute(text(f"ALTER TABLE {LEGACY_TABLE} ADD COLUMN term_vector tsvector;"))
+    connection.execute(text(f"UPDATE {LEGACY_TABLE} SET term_vector = to_tsvector('greek', term);"))
+    connection.execute(text(f"CREATE INDEX {LEGACY_TABLE}_term_vector_idx ON {LEGACY_TABLE} USING gin (term_vector);"))
+    connection.execute(text(f"VACUUM ANALYZE {LEGACY_TABLE};"))
+
+
+def layout_sizes(connection, tables):
+    """(table bytes, index bytes) summed over `tables`."""
+    table_bytes = index_bytes = 0
+    for table in tables:
+        row = connection.execute(text("SELECT pg_table_size(:t), pg_indexes_size(:t)"), {"t": table}).one()
+        table_bytes += row[0]
+        index_bytes += row[1]
+    return table_bytes, index_bytes
+
+
+def sample_queries(connection, n_queries=N_QUERIES, terms_per_query=TERMS_PER_QUERY):
+    terms = connection.execute(text("""
+        SELECT term FROM terms WHERE document_frequency >= :min_df ORDER BY random() LIMIT :n
+    """), {"min_df": MIN_DOCUMENT_FREQUENCY, "n": n_queries * terms_per_query}).scalars().all()
+    return [terms[i:i + terms_per_query] for i in range(0, len(terms), terms_per_query)]
+
+
+def time_queries(connection, query, queries):
+    """Latencies in milliseconds of running `query` once per term set (after one warm-up run of each)."""
+    statement = text(query)
+    for terms in queries:
+        connection.execute(statement, {"terms": terms}).fetchall()
+    latencies = []
+    for terms in queries:
+        started = time.perf_counter()
+        connection.execute(statement, {"terms": terms}).fetchall()
+        latencies.append((time.perf_counter() - started) * 1000)
+    return np.asarray(latencies)
+
+
+def run_benchmark(keep_legacy=False):
+    """
+    Compare size and search latency of the old tfidf_values layout with terms + tfidf_postings.
+    With `keep_legacy` the legacy copy is kept for the next run (and reused if it exists).
+    """
+    with engine.connect() as connection:
+        # VACUUM can't run inside a transaction block
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        legacy_exists = connection.execute(text("SELECT to_regclass(:t)"), {"t": LEGACY_TABLE}).scalar() is not None
+        if not (keep_legacy and legacy_exists):
+            build_legacy_table(connection)
+        connection.execute(text("VACUUM ANALYZE terms;"))
+        connection.execute(text("VACUUM ANALYZE tfidf_postings;"))
+
+        queries = sample_queries(connection)
+        print(f"{len(queries)} queries of {TERMS_PER_QUERY} terms (document frequency >= {MIN_DOCUMENT_FREQUENCY})")
+        print(f"{'layout':<10} {'table MB':>10} {'index MB':>10} {'total MB':>10} {'p50 ms':>8} {'p95 ms':>8}")
+        for layout, query in QUERIES.items():
+            table_bytes, index_bytes = layout_sizes(connection, LAYOUT_TABLES[layout])
+            latencies = time_queries(connection, query, queries)
+            print(f"{layout:<10} {table_bytes / 2**20:>10.1f} {index_bytes / 2**20:>10.1f} "
+                  f"{(table_bytes + index_bytes) / 2**20:>10.1f} "
+                  f"{np.percentile(latencies, 50):>8.2f} {np.percentile(latencies, 95):>8.2f}")
+
+        if not keep_legacy:
+            connection.execute(text(f"DROP TABLE IF EXISTS {LEGACY_TABLE};"))
+
+
+if __name__ == "__main__":
+    run_benchmark(keep_legacy="--keep" in sys.argv[1:])
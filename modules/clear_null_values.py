@@ -1,19 +1,9 @@
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
+from modules.db import get_engine
 import psycopg
-import os
-from dotenv import load_dotenv
 
-load_dotenv()
-
-# Database connection details
-db_user = os.getenv('db_user')
-db_password = os.getenv('db_password')
-db_host = os.getenv('db_host')
-db_port = os.getenv('db_port')
-db_name = os.getenv('db_name')
-
-# Create the database engine
-engine = create_engine(f'postgresql+psycopg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}', echo=True)
+# Shared, pooled database engine (see modules/db.py)
+engine = get_engine()
 
 def delete_null_member_name_rows():
     """
@@ -35,6 +25,7 @@ def delete_null_member_name_rows():
                 print(f"Deleted {result.rowcount} rows from the `final_speeches` table.")
     except Exception as e:
         print(f"An error occurred: {e}")
+        raise
 
 if __name__ == "__main__":
     print("Starting the process to clean the `final_speeches` table...")
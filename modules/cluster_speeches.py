@@ -1,24 +1,34 @@
 import os
+import numpy as np
 import pandas as pd
-from sklearn.cluster import KMeans
-from sqlalchemy import create_engine, text
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
+from sqlalchemy import text
+from modules.db import get_engine
 from dotenv import load_dotenv
 import logging
+from modules.artifact_store import save_artifact, load_artifact, corpus_fingerprint
+from modules.create_tf_idf import copy_rows_and_swap
+from modules.create_dimensions import bump_dataset_version
+from modules.snapshots import STAGE_SNAPSHOTS, snapshot_vectors
 
 # Load environment variables
 load_dotenv()
 
-# Database connection details
-db_user = os.getenv("db_user")
-db_password = os.getenv("db_password")
-db_host = os.getenv("db_host")
-db_port = os.getenv("db_port")
-db_name = os.getenv("db_name")
-
-# Create the database engine
-engine = create_engine(f"postgresql+psycopg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}", echo=True)
+# Shared, pooled database engine (see modules/db.py)
+engine = get_engine()
 print("Database connection initialized successfully.")
 
+# "streaming" fits MiniBatchKMeans over a float32 buffer, "full" keeps the original in-memory KMeans
+CLUSTER_MODE = os.getenv("cluster_mode", "streaming")
+# Candidate cluster counts (e.g. "8,10,12,16"); when set, k is chosen by silhouette score on a sample
+CLUSTER_K_CANDIDATES = [int(k) for k in os.getenv("cluster_k_candidates", "").split(",") if k.strip()]
+FETCH_SIZE = 10000  # Rows pulled per round trip while streaming lsi_speeches
+KMEANS_BATCH_SIZE = 4096  # Vectors per mini-batch update
+KMEANS_EPOCHS = 3  # Passes over the buffer with partial_fit
+SILHOUETTE_SAMPLE_SIZE = 10000  # Vectors used to score each candidate k
+TOP_TERMS_PER_CLUSTER = 10  # Terms describing each cluster in cluster_summary
+
 # Logging setup
 logging.basicConfig(level=logging.INFO)
 
@@ -49,59 +59,190 @@ def fetch_lsi_vectors():
         return [], pd.DataFrame()
 
 
-def store_clusters(speech_ids, clusters):
-    """Store clustering results in a new table."""
-    print("Storing clustering results in the database...")
-    try:
-        with engine.connect() as connection:
-            print("Dropping existing 'clustered_speeches' table...")
-            connection.execute(text("DROP TABLE IF EXISTS clustered_speeches"))
-            connection.commit()  # Commit the drop
-
-            print("Creating new 'clustered_speeches' table...")
-            connection.execute(text("""
-                CREATE TABLE clustered_speeches (
-                    speech_id INT PRIMARY KEY,
-                    cluster_id INT
-                )
-            """))
-            connection.commit()
-            print("Table 'clustered_speeches' created successfully.")
-
-            # Insert the clustering results
-            print("Inserting clustering results...")
-            for speech_id, cluster_id in zip(speech_ids, clusters):
-                connection.execute(text("""
-                    INSERT INTO clustered_speeches (speech_id, cluster_id)
-                    VALUES (:speech_id, :cluster_id)
-                """), {"speech_id": speech_id, "cluster_id": cluster_id})
-            connection.commit()
-            print(f"Inserted {len(speech_ids)} rows into 'clustered_speeches'.")
-    except Exception as e:
-        print(f"Error storing clustering results: {e}")
+def fetch_lsi_vectors_buffer():
+    """
+    Stream the LSI vectors in batches straight into a preallocated float32 buffer.
+    Returns (speech_ids int32 array, vectors float32 array of shape (n, dimensions)).
+    """
+    if STAGE_SNAPSHOTS:
+        print("Reading LSI vectors from the Parquet snapshot...")
+        return snapshot_vectors("lsi_speeches")
+    print("Streaming LSI vectors from the database...")
+    with engine.connect() as connection:
+        n_vectors, dimensions = connection.execute(text(
+            "SELECT COUNT(*), MAX(array_length(lsi_vector, 1)) FROM lsi_speeches"
+        )).fetchone()
+        speech_ids = np.empty(n_vectors, dtype=np.int32)
+        vectors = np.zeros((n_vectors, dimensions or 0), dtype=np.float32)
+        if not n_vectors:
+            return speech_ids, vectors
+
+        result = connection.execution_options(stream_results=True, yield_per=FETCH_SIZE).execute(
+            text("SELECT speech_id, lsi_vector FROM lsi_speeches ORDER BY speech_id")
+        )
+        position = 0
+        for rows in result.partitions():
+            # Rows inserted after the COUNT are left for the next run
+            rows = rows[:n_vectors - position]
+            speech_ids[position:position + len(rows)] = [row[0] for row in rows]
+            vectors[position:position + len(rows)] = [row[1] for row in rows]
+            position += len(rows)
+            if position == n_vectors:
+                break
+    print(f"Loaded {position} LSI vectors of dimension {dimensions}.")
+    return speech_ids[:position], vectors[:position]
+
+
+def fit_minibatch_kmeans(vectors, n_clusters, batch_size=KMEANS_BATCH_SIZE, epochs=KMEANS_EPOCHS):
+    """Fit k-means with mini-batch updates over the buffer, a few shuffled passes of `batch_size` rows."""
+    # The first batch initialises the centroids, so it must hold at least n_clusters rows
+    batch_size = max(batch_size, n_clusters)
+    kmeans = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size, random_state=42, n_init=3)
+    rng = np.random.default_rng(42)
+    for _ in range(epochs):
+        order = rng.permutation(len(vectors))
+        for start in range(0, len(vectors), batch_size):
+            kmeans.partial_fit(vectors[order[start:start + batch_size]])
+    return kmeans
+
+
+def predict_in_batches(kmeans, vectors, batch_size=KMEANS_BATCH_SIZE * 16):
+    """Assign every vector to its nearest centroid without materialising the full distance matrix."""
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), batch_size):
+        labels[start:start + batch_size] = kmeans.predict(vectors[start:start + batch_size])
+    return labels
+
+
+def choose_k_by_silhouette(vectors, candidates, sample_size=SILHOUETTE_SAMPLE_SIZE):
+    """Return the candidate k with the best silhouette score on a random sample of the vectors."""
+    rng = np.random.default_rng(42)
+    sample = vectors[rng.choice(len(vectors), size=min(sample_size, len(vectors)), replace=False)]
+    best_k, best_score = None, -1.0
+    for k in candidates:
+        if not 2 <= k < len(sample):
+            continue
+        labels = MiniBatchKMeans(n_clusters=k, batch_size=KMEANS_BATCH_SIZE, random_state=42, n_init=3).fit_predict(sample)
+        score = silhouette_score(sample, labels)
+        print(f"k={k}: silhouette score {score:.4f}")
+        if score > best_score:
+            best_k, best_score = k, score
+    return best_k
 
 
-def perform_clustering(n_clusters=10):
-    """Main function to fetch LSI vectors, perform clustering, and store results."""
+def store_clusters(speech_ids, clusters):
+    """Store clustering results in the clustered_speeches table, bulk-loaded with COPY and swapped in."""
+    print("Storing clustering results in the database...")
+    row_count = copy_rows_and_swap(
+        "clustered_speeches",
+        ["speech_id INT", "cluster_id INT"],
+        "speech_id",
+        zip((int(speech_id) for speech_id in speech_ids), (int(cluster_id) for cluster_id in clusters))
+    )
+    # Supports the keyset pagination of the /clusters page
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE INDEX IF NOT EXISTS clustered_speeches_cluster_speech_idx ON clustered_speeches (cluster_id, speech_id)"
+        ))
+    print(f"Inserted {row_count} rows into 'clustered_speeches'.")
+
+
+def store_centroids(centroids, clusters):
+    """Store every cluster's centroid and size in the cluster_centroids table."""
+    sizes = np.bincount(np.asarray(clusters), minlength=len(centroids))
+    copy_rows_and_swap(
+        "cluster_centroids",
+        ["cluster_id INT", "size INT", "centroid FLOAT[]"],
+        "cluster_id",
+        ((cluster_id, int(sizes[cluster_id]), centroid) for cluster_id, centroid in enumerate(np.asarray(centroids).tolist()))
+    )
+    print(f"Stored {len(centroids)} centroids in 'cluster_centroids'.")
+
+
+def cluster_top_terms(centroids, n_terms=TOP_TERMS_PER_CLUSTER):
+    """
+    Describe every cluster by the terms with the largest weight in its centroid, mapped back from
+    LSI space to the vocabulary through the stored SVD components. Empty if there is no LSI model.
+    """
+    lsi_model = load_artifact("lsi")
+    if lsi_model is None:
+        print("No stored LSI model, clusters are stored without top terms.")
+        return [[] for _ in range(len(centroids))]
+    terms = lsi_model["vectorizer"].get_feature_names_out()
+    term_weights = np.asarray(centroids) @ lsi_model["components"]
+    top = np.argsort(-term_weights, axis=1)[:, :n_terms]
+    return [terms[row].tolist() for row in top]
+
+
+def store_cluster_summary(centroids, clusters):
+    """Store every cluster's size and top terms in cluster_summary, read once and cached by the web app."""
+    sizes = np.bincount(np.asarray(clusters), minlength=len(centroids))
+    top_terms = cluster_top_terms(centroids)
+    copy_rows_and_swap(
+        "cluster_summary",
+        ["cluster_id INT", "size INT", "top_terms TEXT[]"],
+        "cluster_id",
+        ((cluster_id, int(sizes[cluster_id]), top_terms[cluster_id]) for cluster_id in range(len(centroids)))
+    )
+    print(f"Stored the summary of {len(centroids)} clusters in 'cluster_summary'.")
+
+
+def perform_clustering(n_clusters=10, mode=CLUSTER_MODE, k_candidates=CLUSTER_K_CANDIDATES):
+    """
+    Main function to fetch LSI vectors, perform clustering, and store results.
+
+    `mode="streaming"` reads the vectors into a float32 buffer and fits MiniBatchKMeans; `mode="full"`
+    runs KMeans over a DataFrame. With `k_candidates`, the number of clusters is chosen by silhouette score.
+    """
     print("Starting clustering process...")
-    speech_ids, lsi_vectors = fetch_lsi_vectors()
+    if mode == "streaming":
+        speech_ids, lsi_vectors = fetch_lsi_vectors_buffer()
+    else:
+        speech_ids, lsi_vectors = fetch_lsi_vectors()
+        lsi_vectors = lsi_vectors.to_numpy(dtype=np.float32)
 
     # Check if LSI vectors are empty
-    if lsi_vectors.empty or not speech_ids:
+    if not len(lsi_vectors) or not len(speech_ids):
         print("No LSI vectors found. Exiting clustering process.")
         return
 
-    print("Performing K-Means clustering...")
     try:
-        kmeans = KMeans(n_clusters=n_clusters, random_state=42)
-        clusters = kmeans.fit_predict(lsi_vectors)
+        if k_candidates:
+            print(f"Choosing the number of clusters among {k_candidates}...")
+            n_clusters = choose_k_by_silhouette(lsi_vectors, k_candidates) or n_clusters
+        n_clusters = min(n_clusters, len(lsi_vectors))
+
+        if mode == "streaming":
+            print(f"Performing MiniBatchKMeans clustering with {n_clusters} clusters...")
+            kmeans = fit_minibatch_kmeans(lsi_vectors, n_clusters)
+            clusters = predict_in_batches(kmeans, lsi_vectors)
+        else:
+            print("Performing K-Means clustering...")
+            kmeans = KMeans(n_clusters=n_clusters, random_state=42)
+            clusters = kmeans.fit_predict(lsi_vectors)
         print(f"Clustering completed. Assigned {n_clusters} clusters.")
 
+        # Keep the centroids so new speeches can be assigned without reclustering
+        with engine.connect() as connection:
+            fingerprint = corpus_fingerprint(connection)
+        save_artifact(
+            "kmeans",
+            fingerprint,
+            objects={"kmeans": kmeans},
+            arrays={"centroids": kmeans.cluster_centers_},
+            metadata={"n_clusters": n_clusters, "mode": mode, "inertia": float(kmeans.inertia_)}
+        )
+
         print("Storing clustering results...")
         store_clusters(speech_ids, clusters)
+        store_centroids(kmeans.cluster_centers_, clusters)
+        store_cluster_summary(kmeans.cluster_centers_, clusters)
+        with engine.begin() as connection:
+            bump_dataset_version(connection, "clusters")
         print("Clustering results stored successfully.")
     except Exception as e:
         print(f"Error during clustering: {e}")
+        raise
 
 
 if __name__ == "__main__":
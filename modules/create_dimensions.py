@@ -0,0 +1,81 @@
+import logging
+from sqlalchemy import text
+from modules.db import get_engine
+
+# Shared, pooled database engine (see modules/db.py)
+engine = get_engine()
+
+# Logging setup
+logging.basicConfig(level=logging.INFO)
+
+DIMENSION_QUERIES = {
+    # One row per member: their latest party, number of speeches and active period
+    "members": ("member_name", """
+        SELECT member_name,
+               (ARRAY_AGG(political_party ORDER BY sitting_date DESC NULLS LAST))[1] AS political_party,
+               COUNT(*) AS speech_count,
+               MIN(sitting_date) AS first_sitting_date,
+               MAX(sitting_date) AS last_sitting_date
+        FROM final_speeches
+        WHERE member_name IS NOT NULL
+        GROUP BY member_name
+    """),
+    # One row per party: number of speeches and distinct members
+    "parties": ("political_party", """
+        SELECT political_party,
+               COUNT(*) AS speech_count,
+               COUNT(DISTINCT member_name) AS member_count
+        FROM final_speeches
+        WHERE political_party IS NOT NULL
+        GROUP BY political_party
+    """),
+}
+
+
+def create_dataset_versions_table(connection):
+    """Create the table the web app polls to tell whether its cached lookups are out of date."""
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS dataset_versions (
+            name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+    """))
+
+
+def bump_dataset_version(connection, name):
+    """Record that the data behind `name` changed, invalidating the web app's cached copy."""
+    create_dataset_versions_table(connection)
+    connection.execute(text("""
+        INSERT INTO dataset_versions (name, version, updated_at)
+        VALUES (:name, 1, now())
+        ON CONFLICT (name) DO UPDATE
+        SET version = dataset_versions.version + 1,
+            updated_at = EXCLUDED.updated_at;
+    """), {"name": name})
+
+
+def create_dimension_tables():
+    """
+    Rebuild the members and parties dimension tables from final_speeches. Each table is built
+    next to the old one and swapped in, all in one transaction together with the version bump.
+    """
+    try:
+        with engine.begin() as connection:
+            for table_name, (primary_key, query) in DIMENSION_QUERIES.items():
+                logging.info(f"Building the {table_name} dimension table...")
+                connection.execute(text(f"DROP TABLE IF EXISTS {table_name}_staging;"))
+                connection.execute(text(f"CREATE TABLE {table_name}_staging AS {query};"))
+                connection.execute(text(f"ALTER TABLE {table_name}_staging ADD PRIMARY KEY ({primary_key});"))
+                connection.execute(text(f"DROP TABLE IF EXISTS {table_name};"))
+                connection.execute(text(f"ALTER TABLE {table_name}_staging RENAME TO {table_name};"))
+                connection.execute(text(f"ALTER INDEX {table_name}_staging_pkey RENAME TO {table_name}_pkey;"))
+            bump_dataset_version(connection, "dimensions")
+        logging.info("Dimension tables created successfully.")
+    except Exception as e:
+        logging.error(f"Error creating dimension tables: {e}")
+        raise
+
+
+if __name__ == "__main__":
+    create_dimension_tables()
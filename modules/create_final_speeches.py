@@ -1,55 +1,139 @@
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
+from modules.db import get_engine
+from modules.import_csv_to_db import add_source_row_column, source_row_column
 import psycopg
-import os
-from dotenv import load_dotenv
 
-load_dotenv()
+# Shared, pooled database engine (see modules/db.py)
+engine = get_engine()
 
-# Database connection details
-db_user = os.getenv('db_user')
-db_password = os.getenv('db_password')
-db_host = os.getenv('db_host')
-db_port = os.getenv('db_port')
-db_name = os.getenv('db_name')
+GROUP_COLUMNS = [
+    "member_name",
+    "sitting_date",
+    "parliamentary_period",
+    "parliamentary_session",
+    "parliamentary_sitting",
+    "political_party",
+    "government",
+    "member_region",
+    "roles",
+    "member_gender",
+]
 
-# Create the database engine
-engine = create_engine(f'postgresql+psycopg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}', echo=True)
+# New speeches are numbered in chronological order, with the remaining columns as tie-breakers
+ID_ORDER = ["sitting_date", "parliamentary_period", "parliamentary_session", "parliamentary_sitting"]
+ID_ORDER += [column for column in GROUP_COLUMNS if column not in ID_ORDER]
 
-create_table_query = """
-CREATE TABLE public.final_speeches AS
+# Matches a group `d` to the existing row `f` of the same member and sitting. Columns are compared
+# with `=` where they can't be NULL, so the (member_name, sitting_date) index is used.
+GROUP_MATCH = " AND ".join(
+    f"f.{column} = d.{column}" if column in ("member_name", "sitting_date")
+    else f"f.{column} IS NOT DISTINCT FROM d.{column}"
+    for column in GROUP_COLUMNS
+)
+
+# One row per member and sitting. Speeches without a member or a date are left out here instead of
+# being deleted afterwards, and are merged in the order they were loaded (see import_csv_to_db).
+groups_query = f"""
 SELECT
-    ROW_NUMBER() OVER () AS id, -- Generate a unique ID for each grouped row
-    member_name,
-    sitting_date,
-    parliamentary_period,
-    parliamentary_session,
-    parliamentary_sitting,
-    political_party,
-    government,
-    member_region,
-    roles,
-    member_gender,
-    STRING_AGG(speech, ' ') AS merged_speech -- Combine speeches into a single row
+    {", ".join(GROUP_COLUMNS)},
+    STRING_AGG(speech, ' ' ORDER BY {source_row_column}) AS merged_speech -- Combine speeches into a single row
 FROM
     speeches
+WHERE
+    member_name IS NOT NULL
+    AND sitting_date IS NOT NULL
 GROUP BY
-    member_name,
-    sitting_date,
-    parliamentary_period,
-    parliamentary_session,
-    parliamentary_sitting,
-    political_party,
-    government,
-    member_region,
-    roles,
-    member_gender
-ORDER BY
-    sitting_date, parliamentary_period, parliamentary_session, parliamentary_sitting;
+    {", ".join(GROUP_COLUMNS)}
+"""
+
+# First build: number every speech
+insert_query = f"""
+INSERT INTO final_speeches_staging (id, {", ".join(GROUP_COLUMNS)}, merged_speech)
+SELECT ROW_NUMBER() OVER (ORDER BY {", ".join(ID_ORDER)}) AS id, {", ".join(GROUP_COLUMNS)}, merged_speech
+FROM ({groups_query}) d;
+"""
+
+# Rebuild: a speech of an existing member and sitting keeps its id, so processed_speeches and
+# everything derived from it still point at the same speech. New speeches are numbered after the
+# current maximum id, as appends (modules/append_speeches.py) number them.
+keep_ids_insert_query = f"""
+INSERT INTO final_speeches_staging (id, {", ".join(GROUP_COLUMNS)}, merged_speech)
+SELECT
+    COALESCE(
+        f.id,
+        (SELECT COALESCE(MAX(id), 0) FROM final_speeches)
+        + ROW_NUMBER() OVER (PARTITION BY f.id IS NULL ORDER BY {", ".join(f"d.{column}" for column in ID_ORDER)})
+    ) AS id,
+    {", ".join(f"d.{column}" for column in GROUP_COLUMNS)},
+    d.merged_speech
+FROM ({groups_query}) d
+LEFT JOIN final_speeches f ON {GROUP_MATCH};
 """
 
+# Processed speeches whose id is gone or whose text changed are stale; preprocessing redoes them
+stale_processed_query = """
+DELETE FROM processed_speeches p
+WHERE NOT EXISTS (
+    SELECT 1
+    FROM final_speeches_staging s
+    JOIN final_speeches f ON f.id = s.id AND f.sitting_date = s.sitting_date
+    WHERE s.id = p.speech_id AND f.merged_speech = s.merged_speech
+);
+"""
+
+# B-tree indexes used by the web routes and by the id joins of a rebuild and of appends. The primary
+# key leads with id too, but this narrower index is cheaper to probe in every partition.
+index_definitions = {
+    "id_idx": "(id)",
+    "member_name_idx": "(member_name, sitting_date)",
+    "political_party_idx": "(political_party, sitting_date)",
+}
+
+
+def create_partitioned_table(connection, table, first_year, last_year):
+    """
+    Create `table` range-partitioned by `sitting_date`, with one partition per year from
+    `first_year` to `last_year` and a default partition for anything outside that range.
+    """
+    columns = ",\n".join(
+        f"{column} TIMESTAMP WITHOUT TIME ZONE NOT NULL" if column == "sitting_date"
+        else f"{column} TEXT NOT NULL" if column == "member_name"
+        else f"{column} TEXT"
+        for column in GROUP_COLUMNS
+    )
+    connection.execute(text(f"""
+        CREATE TABLE {table} (
+            id BIGINT NOT NULL,
+            {columns},
+            merged_speech TEXT
+        ) PARTITION BY RANGE (sitting_date);
+    """))
+    for year in range(first_year, last_year + 1):
+        connection.execute(text(f"""
+            CREATE TABLE {table}_y{year} PARTITION OF {table}
+            FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01');
+        """))
+    connection.execute(text(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT;"))
+
+
+def rename_relations(connection, old_prefix, new_prefix):
+    """Rename every table, partition and index whose name starts with `old_prefix`."""
+    relations = connection.execute(text("""
+        SELECT c.relname, c.relkind IN ('i', 'I') AS is_index
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = 'public' AND c.relname LIKE :pattern AND c.relkind IN ('r', 'p', 'i', 'I')
+    """), {"pattern": old_prefix.replace("_", "\\_") + "%"}).fetchall()
+    for name, is_index in relations:
+        kind = "INDEX" if is_index else "TABLE"
+        connection.execute(text(f"ALTER {kind} {name} RENAME TO {new_prefix}{name[len(old_prefix):]};"))
+
+
 def create_final_speeches_table():
     """
-    Execute the SQL command to create the `final_speeches` table with progress messages.
+    Rebuild the `final_speeches` table with progress messages. The new table is filled and indexed
+    next to the old one and swapped in at the end, all in a single transaction. Speeches that
+    already existed keep their ids; processed speeches that no longer match their speech are dropped.
     """
     try:
         print("Connecting to the database...")
@@ -58,15 +142,42 @@ def create_final_speeches_table():
 
             # Start a transaction
             with connection.begin():
-                print("Checking if `final_speeches` table exists...")
-                connection.execute(text("DROP TABLE IF EXISTS public.final_speeches;"))
-                print("Old `final_speeches` table dropped (if it existed).")
+                add_source_row_column(connection)
+                first_year, last_year = connection.execute(text("""
+                    SELECT EXTRACT(YEAR FROM MIN(sitting_date))::int, EXTRACT(YEAR FROM MAX(sitting_date))::int
+                    FROM speeches
+                """)).one()
+                if first_year is None:
+                    raise RuntimeError("The speeches table has no dated rows, import the CSV first.")
 
-                print("Creating the `final_speeches` table...")
-                connection.execute(text(create_table_query))
+                rebuilding = connection.execute(text("SELECT to_regclass('public.final_speeches')")).scalar() is not None
+                has_processed = connection.execute(text("SELECT to_regclass('public.processed_speeches')")).scalar() is not None
+
+                connection.execute(text("DROP TABLE IF EXISTS public.final_speeches_staging;"))
+                print(f"Creating the `final_speeches` table with yearly partitions {first_year}-{last_year}...")
+                create_partitioned_table(connection, "final_speeches_staging", first_year, last_year)
+                result = connection.execute(text(keep_ids_insert_query if rebuilding else insert_query))
+                print(f"Inserted {result.rowcount} speeches.")
+
+                print("Creating the primary key and indexes...")
+                connection.execute(text("ALTER TABLE final_speeches_staging ADD PRIMARY KEY (id, sitting_date);"))
+                for index_name, columns in index_definitions.items():
+                    connection.execute(text(f"CREATE INDEX final_speeches_staging_{index_name} ON final_speeches_staging {columns};"))
+                connection.execute(text("ANALYZE final_speeches_staging;"))
+
+                if has_processed:
+                    if rebuilding:
+                        result = connection.execute(text(stale_processed_query))
+                        print(f"Removed {result.rowcount} processed speeches that changed or no longer exist.")
+                    else:
+                        connection.execute(text("TRUNCATE processed_speeches;"))
+
+                connection.execute(text("DROP TABLE IF EXISTS public.final_speeches;"))
+                rename_relations(connection, "final_speeches_staging", "final_speeches")
                 print("Table `final_speeches` created successfully.")
     except Exception as e:
         print(f"An error occurred: {e}")
+        raise
 
 
 def verify_table_contents():
@@ -0,0 +1,124 @@
+import os
+import logging
+import numpy as np
+from scipy.sparse import csr_matrix, diags
+from sqlalchemy import text
+from modules.db import get_engine
+from sklearn.feature_extraction.text import CountVectorizer
+from dotenv import load_dotenv
+from modules.create_tf_idf import compute_term_weights, copy_rows_and_swap, load_tfidf_model
+
+# Load environment variables
+load_dotenv()
+
+# Shared, pooled database engine (see modules/db.py)
+engine = get_engine()
+
+TOP_K_TERMS = int(os.getenv("keyword_trends_top_k", 3))  # Terms stored per member/party and period
+GRANULARITIES = ("year", "month")
+
+# Logging setup
+logging.basicConfig(level=logging.INFO)
+
+
+def fetch_speeches_with_metadata():
+    """Return (speeches, member names, parties, period codes as YYYYMM ints) for every dated processed speech."""
+    logging.info("Fetching processed speeches with their member, party and date...")
+    with engine.connect() as connection:
+        result = connection.execute(text("""
+            SELECT p.processed_speech, f.member_name, f.political_party,
+                   EXTRACT(YEAR FROM f.sitting_date)::int * 100 + EXTRACT(MONTH FROM f.sitting_date)::int
+            FROM processed_speeches p
+            JOIN final_speeches f ON f.id = p.speech_id
+            WHERE f.sitting_date IS NOT NULL
+            ORDER BY p.speech_id
+        """)).fetchall()
+    logging.info(f"Retrieved {len(result)} speeches.")
+    return ([row[0] for row in result], [row[1] for row in result], [row[2] for row in result],
+            np.asarray([row[3] for row in result], dtype=np.int64))
+
+
+def vectorize_speeches(speeches):
+    """Return (terms, L2-normalised TF-IDF matrix), reusing the stored TF-IDF model when it is current."""
+    with engine.connect() as connection:
+        tfidf_model = load_tfidf_model(connection)
+    if tfidf_model is not None:
+        logging.info("Vectorizing speeches with the persisted TF-IDF model...")
+        return tfidf_model[0].get_feature_names_out(), tfidf_model.transform(speeches)
+    logging.info("No current TF-IDF model, fitting one...")
+    terms, tfidf_matrix, *_ = compute_term_weights(speeches, CountVectorizer(stop_words="english"))
+    return terms, tfidf_matrix
+
+
+def group_mean_matrix(labels, periods, tfidf_matrix):
+    """
+    Average the TF-IDF rows of every (label, period) group with one sparse indicator product.
+    Speeches without a label are skipped. Returns (group labels, group periods, speech counts, matrix).
+    """
+    labels = np.asarray(labels, dtype=object)
+    has_label = np.array([label is not None for label in labels])
+    names, name_index = np.unique(labels[has_label].astype(str), return_inverse=True)
+    group_keys, group_index = np.unique(name_index * 1000000 + periods[has_label], return_inverse=True)
+
+    speech_rows = np.flatnonzero(has_label)
+    indicator = csr_matrix(
+        (np.ones(len(speech_rows)), (group_index, speech_rows)),
+        shape=(len(group_keys), tfidf_matrix.shape[0])
+    )
+    counts = np.bincount(group_index, minlength=len(group_keys))
+    group_matrix = (diags(1.0 / counts) @ (indicator @ tfidf_matrix)).tocsr()
+    return names[group_keys // 1000000], group_keys % 1000000, counts, group_matrix
+
+
+def iter_top_terms(group_type, granularity, names, periods, counts, group_matrix, terms, k=TOP_K_TERMS):
+    """Yield one keyword_trends row per (group, period, rank) for the `k` highest scoring terms of each group."""
+    for row in range(group_matrix.shape[0]):
+        start, end = group_matrix.indptr[row], group_matrix.indptr[row + 1]
+        if start == end:
+            continue
+        scores = group_matrix.data[start:end]
+        columns = group_matrix.indices[start:end]
+        top = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        period = periods[row]
+        year, month = divmod(int(period), 100)
+        for rank, position in enumerate(top, start=1):
+            yield (group_type, str(names[row]), granularity, year, month, rank,
+                   str(terms[columns[position]]), float(scores[position]), int(counts[row]))
+
+
+def iter_keyword_trend_rows(speeches, members, parties, periods, k=TOP_K_TERMS):
+    """Compute the top-k terms of every member and party per year and per month."""
+    terms, tfidf_matrix = vectorize_speeches(speeches)
+    for group_type, labels in (("member", members), ("party", parties)):
+        for granularity in GRANULARITIES:
+            # Yearly buckets use month 0, so both granularities share one table and key
+            bucket_periods = periods // 100 * 100 if granularity == "year" else periods
+            names, group_periods, counts, group_matrix = group_mean_matrix(labels, bucket_periods, tfidf_matrix)
+            logging.info(f"Computed {len(names)} {group_type} x {granularity} groups.")
+            yield from iter_top_terms(group_type, granularity, names, group_periods, counts, group_matrix, terms, k)
+
+
+def create_keyword_trends(k=TOP_K_TERMS):
+    """Materialise the top-k terms per member and party, by year and by month, into keyword_trends."""
+    try:
+        speeches, members, parties, periods = fetch_speeches_with_metadata()
+        if not speeches:
+            logging.info("No processed speeches found, run the preprocessing stage first.")
+            return 0
+        row_count = copy_rows_and_swap(
+            "keyword_trends",
+            ["group_type TEXT", "group_name TEXT", "granularity TEXT", "year SMALLINT", "month SMALLINT",
+             "rank SMALLINT", "term TEXT", "score REAL", "speech_count INT"],
+            "group_type, group_name, granularity, year, month, rank",
+            iter_keyword_trend_rows(speeches, members, parties, periods, k)
+        )
+        logging.info(f"Stored {row_count} rows in keyword_trends.")
+        return row_count
+    except Exception as e:
+        logging.error(f"Error creating keyword trends: {e}")
+        raise
+
+
+if __name__ == "__main__":
+    create_keyword_trends()
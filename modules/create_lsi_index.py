@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import logging
+from pathlib import Path
+import numpy as np
+from sqlalchemy import text
+from modules.db import get_engine
+from sklearn.cluster import MiniBatchKMeans
+from modules.snapshots import STAGE_SNAPSHOTS, snapshot_vectors
+from modules.artifact_store import new_version_dir, publish_version
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Shared, pooled database engine (see modules/db.py)
+engine = get_engine()
+
+# Directory the index files are written to (and memory-mapped from by the web app)
+project_root = Path(__file__).resolve().parent.parent
+LSI_INDEX_PATH = Path(os.getenv("lsi_index_path", project_root / "data" / "lsi_index"))
+
+FETCH_SIZE = 10000  # Rows pulled per round trip while streaming lsi_speeches
+KMEANS_BATCH_SIZE = 4096  # Vectors per MiniBatchKMeans step when training the coarse quantizer
+
+# Logging setup
+logging.basicConfig(level=logging.INFO)
+
+
+def fetch_lsi_vectors():
+    """Stream lsi_speeches (or its Parquet snapshot) into (speech_ids int32, vectors float32) arrays."""
+    if STAGE_SNAPSHOTS:
+        return snapshot_vectors("lsi_speeches")
+    speech_ids, vectors = [], []
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=FETCH_SIZE).execute(
+            text("SELECT speech_id, lsi_vector FROM lsi_speeches ORDER BY speech_id")
+        )
+        for speech_id, lsi_vector in result:
+            speech_ids.append(speech_id)
+            vectors.append(lsi_vector)
+    return np.asarray(speech_ids, dtype=np.int32), np.asarray(vectors, dtype=np.float32)
+
+
+def default_n_lists(n_vectors):
+    """Number of inverted lists, roughly 4 * sqrt(n) as usual for IVF indexes."""
+    return max(1, min(n_vectors, int(4 * np.sqrt(n_vectors))))
+
+
+def write_lsi_index(speech_ids, vectors, n_lists=None, path=LSI_INDEX_PATH):
+    """
+    Build the IVF index: normalise the vectors, train `n_lists` centroids with MiniBatchKMeans,
+    group the vectors by nearest centroid and write everything as .npy files, into a new version
+    directory that is published through `path/current` once complete (see write_search_index).
+    """
+    root = path
+    path = new_version_dir(root)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.where(norms == 0, 1, norms)
+    n_lists = n_lists or default_n_lists(len(vectors))
+
+    logging.info(f"Training {n_lists} centroids on {len(vectors)} LSI vectors...")
+    kmeans = MiniBatchKMeans(n_clusters=n_lists, batch_size=KMEANS_BATCH_SIZE, n_init=3, random_state=42)
+    assignments = kmeans.fit_predict(vectors)
+    centroids = kmeans.cluster_centers_.astype(np.float32)
+    centroid_norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+    centroids = centroids / np.where(centroid_norms == 0, 1, centroid_norms)
+
+    # Vectors of the same list are stored contiguously, offsets[i]:offsets[i + 1] is list i
+    order = np.argsort(assignments, kind="stable")
+    offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assignments, minlength=n_lists))
+    list_ids = speech_ids[order]
+    id_order = np.argsort(list_ids, kind="stable")
+
+    np.save(path / "centroids.npy", centroids)
+    np.save(path / "offsets.npy", offsets)
+    np.save(path / "speech_ids.npy", list_ids)
+    np.save(path / "vectors.npy", vectors[order].astype(np.float32))
+    np.save(path / "sorted_ids.npy", list_ids[id_order])
+    np.save(path / "id_positions.npy", id_order.astype(np.int64))
+    with open(path / "meta.json", "w", encoding="utf-8") as f:
+        json.dump({
+            "n_vectors": len(list_ids),
+            "dimensions": int(vectors.shape[1]),
+            "n_lists": n_lists,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S")
+        }, f)
+    publish_version(root, path)
+    logging.info(f"LSI index written to {path}: {len(list_ids)} vectors in {n_lists} lists.")
+
+
+def build_lsi_index(n_lists=None, path=LSI_INDEX_PATH):
+    """Build the approximate nearest-neighbour index over the vectors in lsi_speeches."""
+    try:
+        speech_ids, vectors = fetch_lsi_vectors()
+        if not len(speech_ids):
+            logging.info("No LSI vectors found, run the LSI stage first.")
+            return
+        write_lsi_index(speech_ids, vectors, n_lists, path)
+    except Exception as e:
+        logging.error(f"Error building the LSI index: {e}")
+        raise
+
+
+if __name__ == "__main__":
+    logging.info("Building the LSI index...")
+    build_lsi_index()
+    logging.info("LSI index built successfully.")
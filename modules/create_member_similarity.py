@@ -1,26 +1,26 @@
 import os
 import numpy as np
-from sqlalchemy import create_engine, text
+from scipy.sparse import csr_matrix, diags
+from sqlalchemy import text
+from modules.db import get_engine
 from sqlalchemy.orm import sessionmaker
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
 from sklearn.feature_extraction.text import TfidfVectorizer
+from modules.create_tf_idf import load_tfidf_model
+from modules.snapshots import STAGE_SNAPSHOTS, read_snapshot
 from dotenv import load_dotenv
 import logging
 
 # Load environment variables
 load_dotenv()
 
-# Database connection details
-db_user = os.getenv("db_user")
-db_password = os.getenv("db_password")
-db_host = os.getenv("db_host")
-db_port = os.getenv("db_port")
-db_name = os.getenv("db_name")
-
-# Create the database engine
-engine = create_engine(f"postgresql+psycopg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}", echo=False)
+# Shared, pooled database engine (see modules/db.py)
+engine = get_engine()
 Session = sessionmaker(bind=engine)
 
+TOP_K_NEIGHBOURS = int(os.getenv("member_similarity_top_k", 50))  # Most similar members stored per member
+SIMILARITY_BLOCK_SIZE = 1024  # Members whose similarity rows are computed per sparse matrix product
+
 # Logging setup
 logging.basicConfig(level=logging.INFO)
 
@@ -53,107 +53,138 @@ def create_similarity_tables():
         session.close()
 
 
-def get_member_speeches(session, member_name):
-    """Retrieve all speeches for a given member from the database."""
-    print(f"Fetching speeches for member: {member_name}...")
-    # Adjust the SQL query to join with the 'final_speeches' table to get 'member_name'
+def get_speeches_with_members(session):
+    """Retrieve every processed speech together with the name of the member who gave it."""
+    if STAGE_SNAPSHOTS:
+        print("Reading processed speeches and their members from the Parquet snapshot...")
+        snapshot = read_snapshot("speech_members", columns=["member_name", "processed_speech"])
+        return snapshot.column("member_name").to_pylist(), snapshot.column("processed_speech").to_pylist()
+
+    print("Fetching processed speeches and their members...")
     sql_query = text("""
-        SELECT ps.processed_speech
+        SELECT fs.member_name, ps.processed_speech
         FROM processed_speeches ps
         JOIN final_speeches fs ON ps.speech_id = fs.id
-        WHERE fs.member_name = :member_name
+        WHERE fs.member_name IS NOT NULL
     """)
 
-    result = session.execute(sql_query, {"member_name": member_name}).fetchall()
-    speeches = [row[0] for row in result]
-    print(f"Retrieved {len(speeches)} speeches for {member_name}.")
-    return speeches
-
-
-def insert_similarity_scores(session, member_1, member_2, similarity_score):
-    """Insert similarity scores for a member pair into the member_similarity_scores table."""
-    print(f"Inserting similarity score for {member_1} and {member_2}...")
-    session.execute(
-        text("""
-            INSERT INTO member_similarity_scores (member_1, member_2, similarity_score)
-            VALUES (:member_1, :member_2, :similarity_score)
-            ON CONFLICT (member_1, member_2) DO UPDATE
-            SET similarity_score = EXCLUDED.similarity_score;
-        """),
-        {"member_1": member_1, "member_2": member_2, "similarity_score": similarity_score}
+    result = session.execute(sql_query).fetchall()
+    print(f"Retrieved {len(result)} speeches.")
+    return [row[0] for row in result], [row[1] for row in result]
+
+
+def build_member_matrix(speech_members, tfidf_matrix, aggregate="mean"):
+    """
+    Collapse the speech x term TF-IDF matrix into a sparse member x term matrix by summing (or
+    averaging) the rows of each member's speeches with a single sparse indicator product.
+    """
+    members, member_index = np.unique(np.asarray(speech_members, dtype=object), return_inverse=True)
+    n_speeches = len(speech_members)
+    indicator = csr_matrix(
+        (np.ones(n_speeches), (member_index, np.arange(n_speeches))),
+        shape=(len(members), n_speeches)
     )
-    session.commit()
-    print(f"Inserted similarity score: {similarity_score}")
-
-
-def calculate_similarity_and_store(session, members):
-    """Calculate pairwise similarities between members and store the results."""
-    print("Calculating pairwise member similarities...")
-
-    # Create a TfidfVectorizer object
-    vectorizer = TfidfVectorizer(stop_words="english")
-
-    # Prepare list to store all speeches for vectorization
-    all_speeches = {}
-    for member in members:
-        all_speeches[member] = get_member_speeches(session, member)
-
-    # Fit the vectorizer on all speeches of all members
-    print("Fitting the TfidfVectorizer on all speeches...")
-    all_speeches_list = [speech for speeches in all_speeches.values() for speech in speeches]
-    tfidf_matrix = vectorizer.fit_transform(all_speeches_list)
-
-    # Now, we will calculate pairwise similarities
-    print("Calculating cosine similarities between members...")
-    for i, member_1 in enumerate(members):
-        print(f"Processing member {i + 1}/{len(members)}: {member_1}")
-
-        # Get the TF-IDF vectors for member_1
-        member_1_speeches = all_speeches[member_1]
-        member_1_vectors = vectorizer.transform(member_1_speeches)
-
-        for j, member_2 in enumerate(members):
-            if i < j:  # Only calculate similarity once for each pair
-                print(f"Comparing {member_1} with {member_2}...")
-
-                # Get the TF-IDF vectors for member_2
-                member_2_speeches = all_speeches[member_2]
-                member_2_vectors = vectorizer.transform(member_2_speeches)
-
-                # Calculate cosine similarity between member_1 and member_2's speeches
-                similarity_score = cosine_similarity(member_1_vectors, member_2_vectors).mean()
-                print(f"Cosine similarity between {member_1} and {member_2}: {similarity_score}")
-                insert_similarity_scores(session, member_1, member_2, similarity_score)
+    member_matrix = indicator @ tfidf_matrix
+    if aggregate == "mean":
+        speech_counts = np.bincount(member_index, minlength=len(members))
+        member_matrix = diags(1.0 / speech_counts) @ member_matrix
+    return members.tolist(), member_matrix.tocsr()
+
+
+def iter_top_k_similarities(members, member_matrix, k=TOP_K_NEIGHBOURS, block_size=SIMILARITY_BLOCK_SIZE):
+    """
+    Yield (member_1, member_2, similarity_score) for the `k` most similar members of every member.
+    Rows are L2-normalised once, so each block of cosine similarities is one sparse matrix product.
+    """
+    normalized = normalize(member_matrix)
+    n_members = normalized.shape[0]
+    k = min(k, n_members - 1)
+    if k <= 0:
+        return
+    normalized_t = normalized.T.tocsc()
+
+    for start in range(0, n_members, block_size):
+        end = min(start + block_size, n_members)
+        similarities = (normalized[start:end] @ normalized_t).toarray()
+        # Never report a member as its own neighbour
+        similarities[np.arange(end - start), np.arange(start, end)] = -np.inf
+
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(similarities, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        for row in range(end - start):
+            member_1 = members[start + row]
+            for neighbour, score in zip(top[row].tolist(), top_scores[row].tolist()):
+                yield member_1, members[neighbour], score
+
+
+def store_similarity_scores(rows):
+    """Replace the contents of member_similarity_scores with a single COPY inside one transaction."""
+    raw_connection = engine.raw_connection()
+    row_count = 0
+    try:
+        with raw_connection.cursor() as cursor:
+            cursor.execute("TRUNCATE member_similarity_scores;")
+            with cursor.copy("COPY member_similarity_scores (member_1, member_2, similarity_score) FROM STDIN") as copy:
+                for row in rows:
+                    copy.write_row(row)
+                    row_count += 1
+        raw_connection.commit()
+    except Exception:
+        raw_connection.rollback()
+        raise
+    finally:
+        raw_connection.close()
+    print(f"Inserted {row_count} similarity scores.")
+    return row_count
+
+
+def calculate_similarity_and_store(session, k=TOP_K_NEIGHBOURS):
+    """
+    Calculate member similarities as the cosine between members' mean TF-IDF vectors and store
+    the top-k neighbours of every member.
+    """
+    speech_members, speeches = get_speeches_with_members(session)
+
+    # Reuse the TF-IDF model persisted by the TF-IDF stage if it was fitted on this corpus
+    tfidf_model = load_tfidf_model(session.connection())
+    if tfidf_model is not None:
+        print("Vectorizing speeches with the persisted TF-IDF model...")
+        tfidf_matrix = tfidf_model.transform(speeches)
+    else:
+        # Fit the vectorizer on all speeches of all members
+        print("Fitting the TfidfVectorizer on all speeches...")
+        vectorizer = TfidfVectorizer(stop_words="english")
+        tfidf_matrix = vectorizer.fit_transform(speeches)
+    del speeches
+
+    print("Building the member x term matrix...")
+    members, member_matrix = build_member_matrix(speech_members, tfidf_matrix)
+    print(f"Built vectors for {len(members)} members over {member_matrix.shape[1]} terms.")
+
+    print(f"Calculating cosine similarities between members (top {k} per member)...")
+    store_similarity_scores(iter_top_k_similarities(members, member_matrix, k))
 
 
 def process_member_similarity():
     """Main process to calculate member similarities."""
     session = Session()
     try:
-        print("Fetching members from the database...")
-        logging.info("Fetching members from the database...")
-
-        # Retrieve all unique members
-        members_query = text("SELECT DISTINCT member_name FROM final_speeches")
-
-        with engine.connect() as connection:
-            members = connection.execute(members_query).fetchall()
-            members = [member[0] for member in members]  # Extract member names
-
-        print(f"Found {len(members)} members in the database.")
-        logging.info(f"Found {len(members)} members in the database.")
-
         # Step 1: Create tables if they don't exist
         create_similarity_tables()
 
         # Step 2: Calculate pairwise similarities and store the results
-        calculate_similarity_and_store(session, members)
+        calculate_similarity_and_store(session)
 
         print("Similarity calculation and insertion completed successfully.")
         logging.info("Similarity calculation and insertion completed successfully.")
     except Exception as e:
         logging.error(f"An error occurred: {e}")
         print(f"An error occurred: {e}")
+        raise
     finally:
         session.close()
 
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import logging
+from array import array
+from pathlib import Path
+import numpy as np
+from sqlalchemy import text
+from modules.db import get_engine
+from sklearn.feature_extraction.text import CountVectorizer
+from dotenv import load_dotenv
+from modules.create_tf_idf import compute_term_weights
+from modules.artifact_store import new_version_dir, publish_version
+
+# Load environment variables
+load_dotenv()
+
+# Shared, pooled database engine (see modules/db.py)
+engine = get_engine()
+
+# Directory the index files are written to (and memory-mapped from by the web app)
+project_root = Path(__file__).resolve().parent.parent
+SEARCH_INDEX_PATH = Path(os.getenv("search_index_path", project_root / "data" / "search_index"))
+
+FETCH_SIZE = 100000  # Rows pulled per round trip when streaming tfidf_postings
+
+# Logging setup
+logging.basicConfig(level=logging.INFO)
+
+
+def write_search_index(terms, offsets, speech_ids, weights, bm25_weights, source, path=SEARCH_INDEX_PATH):
+    """
+    Write the inverted index as plain .npy files so every reader can memory-map them:
+    terms (sorted), offsets into the postings arrays, and the postings themselves
+    as parallel (speech_id int32, TF-IDF weight float32, BM25 weight float32) arrays.
+    Each build goes to a new version directory under `path`, published through `path/current`
+    once complete, so a running app never sees files rewritten under its memory maps.
+    """
+    root = path
+    path = new_version_dir(root)
+    np.save(path / "terms.npy", np.asarray(terms, dtype=str))
+    np.save(path / "offsets.npy", np.asarray(offsets, dtype=np.int64))
+    np.save(path / "speech_ids.npy", np.asarray(speech_ids, dtype=np.int32))
+    np.save(path / "weights.npy", np.asarray(weights, dtype=np.float32))
+    np.save(path / "bm25_weights.npy", np.asarray(bm25_weights, dtype=np.float32))
+    with open(path / "meta.json", "w", encoding="utf-8") as f:
+        json.dump({
+            "source": source,
+            "n_terms": len(terms),
+            "n_postings": len(speech_ids),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S")
+        }, f)
+    publish_version(root, path)
+    logging.info(f"Search index written to {path}: {len(terms)} terms, {len(speech_ids)} postings.")
+
+
+def build_index_from_tfidf_postings(path=SEARCH_INDEX_PATH):
+    """Build the index by streaming tfidf_postings in term order."""
+    terms, offsets = [], [0]
+    speech_ids, weights, bm25_weights = array("i"), array("f"), array("f")
+
+    logging.info("Streaming tfidf_postings to build the search index...")
+    with engine.connect() as connection:
+        # Term ids follow the sorted vocabulary, i.e. code point order, the same order numpy uses
+        # for searchsorted; reading in primary key order also avoids a sort
+        result = connection.execution_options(stream_results=True, yield_per=FETCH_SIZE).execute(text("""
+            SELECT t.term, p.speech_id, p.tfidf_value, p.bm25_weight
+            FROM tfidf_postings p
+            JOIN terms t ON t.term_id = p.term_id
+            ORDER BY p.term_id, p.speech_id
+        """))
+        for term, speech_id, tfidf_value, bm25_weight in result:
+            if not terms or terms[-1] != term:
+                if terms:
+                    offsets.append(len(speech_ids))
+                terms.append(term)
+            speech_ids.append(speech_id)
+            weights.append(tfidf_value)
+            bm25_weights.append(bm25_weight or 0.0)
+    if terms:
+        offsets.append(len(speech_ids))
+
+    write_search_index(terms, offsets, speech_ids, weights, bm25_weights, "tfidf_postings", path)
+
+
+def build_index_from_processed_speeches(path=SEARCH_INDEX_PATH):
+    """Build the index directly from processed_speeches by fitting TF-IDF and reading the CSC postings."""
+    logging.info("Fetching processed speeches to build the search index...")
+    with engine.connect() as connection:
+        result = connection.execute(text(
+            "SELECT speech_id, processed_speech FROM processed_speeches ORDER BY speech_id"
+        )).fetchall()
+    doc_ids = np.array([row[0] for row in result], dtype=np.int32)
+
+    # Same weights as the TF-IDF stage writes to tfidf_postings
+    terms, tfidf_matrix, bm25_matrix, _, _ = compute_term_weights(
+        [row[1] for row in result], CountVectorizer(stop_words="english")
+    )
+    del result
+
+    # In CSC form each column is exactly one term's postings list
+    postings = tfidf_matrix.tocsc()
+    postings.sort_indices()
+    bm25_postings = bm25_matrix.tocsc()
+    bm25_postings.sort_indices()
+    write_search_index(
+        terms,  # Already sorted
+        postings.indptr,
+        doc_ids[postings.indices],
+        postings.data,
+        bm25_postings.data,
+        "processed_speeches",
+        path
+    )
+
+
+def build_search_index(source="tfidf_postings", path=SEARCH_INDEX_PATH):
+    """Build the memory-mappable search index from `tfidf_postings` or `processed_speeches`."""
+    try:
+        if source == "tfidf_postings":
+            build_index_from_tfidf_postings(path)
+        elif source == "processed_speeches":
+            build_index_from_processed_speeches(path)
+        else:
+            raise ValueError(f"Unknown search index source: {source}")
+    except Exception as e:
+        logging.error(f"Error building search index: {e}")
+        raise
+
+
+if __name__ == "__main__":
+    logging.info("Building the search index...")
+    build_search_index()
+    logging.info("Search index built successfully.")
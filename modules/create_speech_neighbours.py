@@ -0,0 +1,106 @@
+import os
+import logging
+import numpy as np
+from sqlalchemy import text
+from modules.db import get_engine
+from dotenv import load_dotenv
+from modules.create_tf_idf import copy_rows_and_swap
+
+# Load environment variables
+load_dotenv()
+
+# Shared, pooled database engine (see modules/db.py)
+engine = get_engine()
+
+TOP_N_NEIGHBOURS = int(os.getenv("speech_neighbours_top_n", 10))  # Most similar speeches stored per speech
+NEIGHBOUR_BLOCK_SIZE = 512  # Speeches whose similarity rows are computed per matrix product
+FETCH_SIZE = 10000  # Rows pulled per round trip while streaming the LSI vectors
+
+# Logging setup
+logging.basicConfig(level=logging.INFO)
+
+
+def fetch_clustered_lsi_vectors():
+    """
+    Stream the LSI vector and cluster of every clustered speech, ordered by cluster.
+    Returns (cluster_ids, speech_ids, vectors) as NumPy arrays.
+    """
+    cluster_ids, speech_ids, vectors = [], [], []
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=FETCH_SIZE).execute(text("""
+            SELECT c.cluster_id, l.speech_id, l.lsi_vector
+            FROM lsi_speeches l
+            JOIN clustered_speeches c ON c.speech_id = l.speech_id
+            ORDER BY c.cluster_id, l.speech_id
+        """))
+        for cluster_id, speech_id, lsi_vector in result:
+            cluster_ids.append(cluster_id)
+            speech_ids.append(speech_id)
+            vectors.append(lsi_vector)
+    return (np.asarray(cluster_ids, dtype=np.int32),
+            np.asarray(speech_ids, dtype=np.int32),
+            np.asarray(vectors, dtype=np.float32))
+
+
+def iter_top_n_neighbours(speech_ids, vectors, n=TOP_N_NEIGHBOURS, block_size=NEIGHBOUR_BLOCK_SIZE):
+    """
+    Yield (speech_id, rank, neighbour_id, similarity) for the `n` most similar speeches of every
+    speech in `speech_ids`. Vectors are L2-normalised once, so each block of cosine similarities is
+    a single dense matrix product and only the top `n` of every row are sorted.
+    """
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    normalized = vectors / np.where(norms == 0, 1, norms)
+    n_speeches = len(speech_ids)
+    n = min(n, n_speeches - 1)
+    if n <= 0:
+        return
+
+    for start in range(0, n_speeches, block_size):
+        end = min(start + block_size, n_speeches)
+        similarities = normalized[start:end] @ normalized.T
+        # Never recommend a speech to itself
+        similarities[np.arange(end - start), np.arange(start, end)] = -np.inf
+
+        top = np.argpartition(-similarities, n - 1, axis=1)[:, :n]
+        top_scores = np.take_along_axis(similarities, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        for row in range(end - start):
+            speech_id = int(speech_ids[start + row])
+            for rank, (neighbour, score) in enumerate(zip(top[row].tolist(), top_scores[row].tolist()), start=1):
+                yield speech_id, rank, int(speech_ids[neighbour]), score
+
+
+def iter_cluster_neighbours(cluster_ids, speech_ids, vectors, n=TOP_N_NEIGHBOURS):
+    """Compute the nearest neighbours of every speech among the speeches of its own cluster."""
+    boundaries = np.flatnonzero(np.diff(cluster_ids)) + 1
+    for start, end in zip(np.r_[0, boundaries], np.r_[boundaries, len(cluster_ids)]):
+        logging.info(f"Computing neighbours for cluster {cluster_ids[start]} ({end - start} speeches)...")
+        yield from iter_top_n_neighbours(speech_ids[start:end], vectors[start:end], n)
+
+
+def create_speech_neighbours(n=TOP_N_NEIGHBOURS):
+    """Precompute the `n` most similar speeches of every speech (within its cluster) into speech_neighbours."""
+    try:
+        cluster_ids, speech_ids, vectors = fetch_clustered_lsi_vectors()
+        if not len(speech_ids):
+            logging.info("No clustered LSI vectors found, run the LSI and clustering stages first.")
+            return 0
+
+        row_count = copy_rows_and_swap(
+            "speech_neighbours",
+            ["speech_id INT", "rank SMALLINT", "neighbour_id INT", "similarity REAL"],
+            "speech_id, rank",
+            iter_cluster_neighbours(cluster_ids, speech_ids, vectors, n)
+        )
+        logging.info(f"Stored {row_count} neighbours for {len(speech_ids)} speeches in speech_neighbours.")
+        return row_count
+    except Exception as e:
+        logging.error(f"Error computing speech neighbours: {e}")
+        raise
+
+
+if __name__ == "__main__":
+    create_speech_neighbours()
@@ -1,98 +1,359 @@
 import os
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
+from modules.db import get_engine
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
-from sklearn.feature_extraction.text import TfidfVectorizer
-import pandas as pd
+from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer
+from sklearn.pipeline import make_pipeline
+from scipy.sparse import csr_matrix
+import numpy as np
 import logging
+from modules.artifact_store import save_artifact, load_artifact, corpus_fingerprint
+from modules.snapshots import STAGE_SNAPSHOTS, read_snapshot
 
 # Load environment variables
 load_dotenv()
 
-# Database connection details
-db_user = os.getenv("db_user")
-db_password = os.getenv("db_password")
-db_host = os.getenv("db_host")
-db_port = os.getenv("db_port")
-db_name = os.getenv("db_name")
-
-# Create the database engine
-engine = create_engine(f"postgresql+psycopg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}", echo=False)
+# Shared, pooled database engine (see modules/db.py)
+engine = get_engine()
 Session = sessionmaker(bind=engine)
 
+# BM25 parameters used for the precomputed bm25_weight of every posting
+BM25_K1 = float(os.getenv("bm25_k1", 1.2))
+BM25_B = float(os.getenv("bm25_b", 0.75))
+
 # Logging setup
 logging.basicConfig(level=logging.INFO)
 
 def create_tfidf_table():
-    """Create the tfidf_values table if it doesn't exist."""
+    """Create the terms, tfidf_postings and speech_stats tables if they don't exist."""
     session = Session()
     try:
-        logging.info("Creating tfidf_values table...")
+        logging.info("Creating tfidf tables...")
 
         session.execute(
             text("""
-                CREATE TABLE IF NOT EXISTS tfidf_values (
+                CREATE TABLE IF NOT EXISTS terms (
+                    term_id INT PRIMARY KEY,
+                    term TEXT NOT NULL,
+                    document_frequency INT
+                );
+                CREATE UNIQUE INDEX IF NOT EXISTS terms_term_idx ON terms (term);
+
+                CREATE TABLE IF NOT EXISTS tfidf_postings (
+                    term_id INT,
                     speech_id INT,
-                    term TEXT,
-                    tfidf_value FLOAT,
-                    PRIMARY KEY (speech_id, term)
+                    tfidf_value REAL,
+                    bm25_weight REAL,
+                    PRIMARY KEY (term_id, speech_id)
+                );
+
+                CREATE TABLE IF NOT EXISTS speech_stats (
+                    speech_id INT PRIMARY KEY,
+                    doc_length INT
                 );
             """)
         )
         session.commit()
-        logging.info("tfidf_values table is ready.")
+        logging.info("tfidf tables are ready.")
     except Exception as e:
         session.rollback()
-        logging.error(f"Error creating tfidf_values table: {e}")
+        logging.error(f"Error creating tfidf tables: {e}")
+        raise
     finally:
         session.close()
 
+
+def drop_tfidf_values_view(connection):
+    """Drop the tfidf_values compatibility view, or the table of the same name built by older versions."""
+    relkind = connection.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass('tfidf_values')")).scalar()
+    if relkind == "v":
+        connection.execute(text("DROP VIEW tfidf_values;"))
+    elif relkind is not None:
+        connection.execute(text("DROP TABLE tfidf_values;"))
+
+
+def create_tfidf_values_view(connection):
+    """(Re)create tfidf_values as a view over terms and tfidf_postings, with the columns of the old table."""
+    drop_tfidf_values_view(connection)
+    connection.execute(text("""
+        CREATE VIEW tfidf_values AS
+        SELECT p.speech_id, t.term, p.tfidf_value::FLOAT AS tfidf_value, p.bm25_weight::FLOAT AS bm25_weight
+        FROM tfidf_postings p
+        JOIN terms t ON t.term_id = p.term_id;
+    """))
+
+
+def weigh_counts(counts, idf, document_frequency, n_docs, avg_doc_length):
+    """
+    Derive, over the CSR structure of a term-count matrix:
+    - the L2-normalised TF-IDF matrix (the same values TfidfVectorizer produces),
+    - the BM25 weight of every (speech, term) posting,
+    - each speech's length in tokens.
+    The IDF vector, document frequencies, corpus size and average length are those of the corpus
+    the weights are relative to. Returns (tfidf_matrix, bm25_matrix, doc_lengths).
+    """
+    counts = counts.tocsr().astype(np.float64)
+    counts.sort_indices()
+    n_rows = counts.shape[0]
+    term_frequencies = counts.data
+    term_indices = counts.indices
+    # Row of every stored entry, so per-document values can be broadcast onto the postings
+    rows = np.repeat(np.arange(n_rows), np.diff(counts.indptr))
+
+    raw_tfidf = term_frequencies * idf[term_indices]
+    tfidf_norms = np.sqrt(np.bincount(rows, weights=raw_tfidf ** 2, minlength=n_rows))
+    tfidf_data = raw_tfidf / np.where(tfidf_norms > 0, tfidf_norms, 1.0)[rows]
+
+    doc_lengths = np.asarray(counts.sum(axis=1)).ravel()
+    bm25_idf = np.log1p((n_docs - document_frequency + 0.5) / (document_frequency + 0.5))
+    length_norm = 1 - BM25_B + BM25_B * doc_lengths[rows] / (avg_doc_length or 1.0)
+    bm25_data = (bm25_idf[term_indices] * term_frequencies * (BM25_K1 + 1)
+                 / (term_frequencies + BM25_K1 * length_norm))
+
+    tfidf_matrix = csr_matrix((tfidf_data, term_indices, counts.indptr), shape=counts.shape)
+    bm25_matrix = csr_matrix((bm25_data, term_indices, counts.indptr), shape=counts.shape)
+    return tfidf_matrix, bm25_matrix, doc_lengths.astype(np.int64)
+
+
+def compute_term_weights(speeches, vectorizer):
+    """
+    Fit `vectorizer` (a CountVectorizer) on the speeches and weigh them with `weigh_counts`.
+    Returns (terms, tfidf_matrix, bm25_matrix, doc_lengths, transformer), where
+    the fitted TfidfTransformer holds the IDF vector.
+    """
+    counts = vectorizer.fit_transform(speeches).tocsr()
+    n_docs = counts.shape[0]
+    transformer = TfidfTransformer().fit(counts)
+    document_frequency = np.bincount(counts.indices, minlength=counts.shape[1])
+    avg_doc_length = counts.sum() / n_docs if n_docs else 0.0
+
+    tfidf_matrix, bm25_matrix, doc_lengths = weigh_counts(
+        counts, transformer.idf_, document_frequency, n_docs, avg_doc_length
+    )
+    terms = vectorizer.get_feature_names_out().tolist()
+    return terms, tfidf_matrix, bm25_matrix, doc_lengths, transformer
+
+
+def fold_in_term_weights(speeches, model, n_docs, avg_doc_length):
+    """
+    Weigh new speeches with a stored TF-IDF model instead of refitting it. Terms outside the
+    fitted vocabulary are ignored, and the document frequencies BM25 needs are recovered from
+    the stored (smoothed) IDF vector. `n_docs` and `avg_doc_length` describe the fitted corpus.
+    Returns (terms, tfidf_matrix, bm25_matrix, doc_lengths).
+    """
+    vectorizer, transformer = model[0], model[-1]
+    idf = np.asarray(transformer.idf_)
+    # idf = ln((1 + n) / (1 + df)) + 1
+    document_frequency = (1 + n_docs) * np.exp(1 - idf) - 1
+    tfidf_matrix, bm25_matrix, doc_lengths = weigh_counts(
+        vectorizer.transform(speeches), idf, document_frequency, n_docs, avg_doc_length
+    )
+    return vectorizer.get_feature_names_out().tolist(), tfidf_matrix, bm25_matrix, doc_lengths
+
+
+def iter_posting_rows(tfidf_matrix, bm25_matrix, speech_ids, chunk_size=1000000):
+    """
+    Yield (term_id, speech_id, tfidf_value, bm25_weight) for every stored entry of the CSR weight
+    matrices (which share one structure) in term order, so tfidf_postings is laid out on disk the
+    way searches read it. A term's id is its column in the matrices, i.e. its index in the vocabulary.
+    """
+    rows = np.repeat(np.arange(tfidf_matrix.shape[0]), np.diff(tfidf_matrix.indptr))
+    # Stable, so the postings of a term keep the order of the speeches
+    order = np.argsort(tfidf_matrix.indices, kind="stable")
+    speech_ids = np.asarray(speech_ids)
+    for start in range(0, len(order), chunk_size):
+        chunk = order[start:start + chunk_size]
+        chunk = chunk[tfidf_matrix.data[chunk] > 0]  # Only insert non-zero values
+        yield from zip(tfidf_matrix.indices[chunk].tolist(), speech_ids[rows[chunk]].tolist(),
+                       tfidf_matrix.data[chunk].tolist(), bm25_matrix.data[chunk].tolist())
+
+
+def copy_rows_to_staging(table_name, column_definitions, primary_key, rows):
+    """
+    Stream rows into an unlogged `<table_name>_staging` table with COPY, then add its primary key
+    and make it crash-safe. `table_name` itself is not touched. Returns the number of rows copied.
+    """
+    staging_name = f"{table_name}_staging"
+    columns = ", ".join(definition.split()[0] for definition in column_definitions)
+    raw_connection = engine.raw_connection()
+    row_count = 0
+    try:
+        with raw_connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {staging_name};")
+            cursor.execute(f"CREATE UNLOGGED TABLE {staging_name} ({', '.join(column_definitions)});")
+            with cursor.copy(f"COPY {staging_name} ({columns}) FROM STDIN") as copy:
+                for row in rows:
+                    copy.write_row(row)
+                    row_count += 1
+            raw_connection.commit()
+            logging.info(f"Copied {row_count} rows into {staging_name}.")
+
+            # Build the key on the loaded data (much cheaper than maintaining it during the load)
+            cursor.execute(f"ALTER TABLE {staging_name} ADD PRIMARY KEY ({primary_key});")
+            cursor.execute(f"ALTER TABLE {staging_name} SET LOGGED;")
+        raw_connection.commit()
+    except Exception:
+        raw_connection.rollback()
+        raise
+    finally:
+        raw_connection.close()
+    return row_count
+
+
+def swap_in_staging(connection, table_name):
+    """Replace `table_name` with the table loaded by `copy_rows_to_staging`, within the caller's transaction."""
+    staging_name = f"{table_name}_staging"
+    connection.execute(text(f"DROP TABLE IF EXISTS {table_name};"))
+    connection.execute(text(f"ALTER TABLE {staging_name} RENAME TO {table_name};"))
+    connection.execute(text(f"ALTER INDEX {staging_name}_pkey RENAME TO {table_name}_pkey;"))
+
+
+def copy_rows_and_swap(table_name, column_definitions, primary_key, rows):
+    """
+    Stream rows into an unlogged `<table_name>_staging` table with COPY and then swap it in place
+    of `table_name` inside a single transaction.
+    """
+    row_count = copy_rows_to_staging(table_name, column_definitions, primary_key, rows)
+    with engine.begin() as connection:
+        swap_in_staging(connection, table_name)
+    return row_count
+
+
+def replace_rows(table_name, columns, key_column, keys, rows):
+    """
+    Delete the rows of `table_name` whose `key_column` is in `keys` and COPY `rows` in their
+    place, in one transaction. Used to update a few speeches without rebuilding the table.
+    """
+    raw_connection = engine.raw_connection()
+    row_count = 0
+    try:
+        with raw_connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {table_name} WHERE {key_column} = ANY(%s);", (list(keys),))
+            with cursor.copy(f"COPY {table_name} ({', '.join(columns)}) FROM STDIN") as copy:
+                for row in rows:
+                    copy.write_row(row)
+                    row_count += 1
+        raw_connection.commit()
+    except Exception:
+        raw_connection.rollback()
+        raise
+    finally:
+        raw_connection.close()
+    return row_count
+
+
+def copy_terms_to_staging(terms, document_frequency):
+    """Load the terms dictionary (integer id, text and document frequency of every vocabulary term) into terms_staging."""
+    row_count = copy_rows_to_staging(
+        "terms",
+        ["term_id INT", "term TEXT", "document_frequency INT"],
+        "term_id",
+        zip(range(len(terms)), terms, document_frequency.tolist())
+    )
+    # Searches resolve their query terms to ids through this index (renamed to terms_term_idx on the swap)
+    with engine.begin() as connection:
+        connection.execute(text("CREATE UNIQUE INDEX terms_staging_term_idx ON terms_staging (term)"))
+    return row_count
+
+
+def copy_postings_to_staging(rows):
+    """Load (term_id, speech_id, tfidf_value, bm25_weight) rows into tfidf_postings_staging."""
+    return copy_rows_to_staging(
+        "tfidf_postings",
+        ["term_id INT", "speech_id INT", "tfidf_value REAL", "bm25_weight REAL"],
+        "term_id, speech_id",
+        rows
+    )
+
+
+def copy_speech_stats_to_staging(speech_ids, doc_lengths):
+    """Load the per-speech document length (BM25's average length is taken over it) into speech_stats_staging."""
+    return copy_rows_to_staging(
+        "speech_stats",
+        ["speech_id INT", "doc_length INT"],
+        "speech_id",
+        zip(speech_ids, doc_lengths.tolist())
+    )
+
+
+def swap_in_tfidf_tables(connection):
+    """
+    Swap the staged terms, tfidf_postings and speech_stats in together, with the tfidf_values view
+    rebuilt over them, in the caller's transaction: readers see either the old tables or the new ones,
+    never new term ids next to old postings.
+    """
+    drop_tfidf_values_view(connection)
+    for table_name in ("terms", "tfidf_postings", "speech_stats"):
+        swap_in_staging(connection, table_name)
+    connection.execute(text("ALTER INDEX terms_staging_term_idx RENAME TO terms_term_idx;"))
+    create_tfidf_values_view(connection)
+
+
+def save_tfidf_model(connection, vectorizer, transformer, n_speeches):
+    """Store the fitted CountVectorizer + TfidfTransformer as the "tfidf" artifact."""
+    save_artifact(
+        "tfidf",
+        corpus_fingerprint(connection),
+        objects={"model": make_pipeline(vectorizer, transformer)},
+        arrays={"idf": transformer.idf_},
+        metadata={"n_terms": len(transformer.idf_), "n_speeches": n_speeches}
+    )
+
+
+def load_tfidf_model(connection=None, mmap=True):
+    """
+    Load the fitted TF-IDF model (a pipeline whose `transform` returns the same L2-normalised
+    values as tfidf_postings). With a connection, only a model fitted on the current corpus is
+    returned; None means the model has to be refitted.
+    """
+    fingerprint = corpus_fingerprint(connection) if connection is not None else None
+    artifact = load_artifact("tfidf", fingerprint=fingerprint, mmap=mmap)
+    return artifact["model"] if artifact else None
+
+
 def insert_tfidf_values_to_db(speeches, vectorizer, speech_ids, session):
     """Insert TF-IDF values for the corpus into the database, ensuring correct speech_id mapping."""
-    # Create the sparse matrix using TfidfVectorizer (using sparse format)
-    tfidf_matrix = vectorizer.fit_transform(speeches)  # This is a sparse matrix
-    terms = vectorizer.get_feature_names_out()
+    # Create the sparse weight matrices (using sparse format)
+    terms, tfidf_matrix, bm25_matrix, doc_lengths, transformer = compute_term_weights(speeches, vectorizer)
 
-    # Collect TF-IDF values in a list for batch insertion
-    tfidf_values = []
-    for doc_idx, doc in enumerate(tfidf_matrix):
-        for term_idx, value in enumerate(doc.toarray()[0]):  # Convert sparse to dense for iteration
-            if value > 0:  # Only insert non-zero values
-                tfidf_values.append((speech_ids[doc_idx], terms[term_idx], value))
+    # Persist the fitted vocabulary and IDF vector so later stages and the web app reuse them
+    save_tfidf_model(session.connection(), vectorizer, transformer, len(speech_ids))
 
     try:
-        for i in range(0, len(tfidf_values), 100):  # Batch insert to avoid memory overload
-            batch = tfidf_values[i:i + 100]
-            session.execute(
-                text("""
-                    INSERT INTO tfidf_values (speech_id, term, tfidf_value)
-                    VALUES (:speech_id, :term, :tfidf_value)
-                    ON CONFLICT (speech_id, term) DO UPDATE
-                    SET tfidf_value = EXCLUDED.tfidf_value;
-                """),
-                [{"speech_id": row[0], "term": row[1], "tfidf_value": row[2]} for row in batch]
-            )
-        session.commit()
-        logging.info(f"Inserted {len(tfidf_values)} rows into the tfidf_values table.")
+        # Load all three tables next to the live ones first, then swap them in at once
+        copy_terms_to_staging(terms, np.bincount(tfidf_matrix.indices, minlength=len(terms)))
+        row_count = copy_postings_to_staging(iter_posting_rows(tfidf_matrix, bm25_matrix, speech_ids))
+        copy_speech_stats_to_staging(speech_ids, doc_lengths)
+        with engine.begin() as connection:
+            swap_in_tfidf_tables(connection)
+        logging.info(f"Inserted {len(terms)} terms, {row_count} postings and {len(speech_ids)} speech_stats rows.")
     except Exception as e:
         session.rollback()
         logging.error(f"Error inserting TF-IDF values: {e}")
+        raise
 
 def process_corpus_and_insert():
     """Fetch corpus from the processed_speeches table, calculate TF-IDF and insert into the table."""
     session = Session()
     try:
-        logging.info("Fetching processed speeches from processed_speeches table...")
-        result = session.execute(text("SELECT speech_id, processed_speech FROM processed_speeches")).fetchall()
+        if STAGE_SNAPSHOTS:
+            logging.info("Reading processed speeches from the Parquet snapshot...")
+            snapshot = read_snapshot("processed_speeches")
+            speeches = snapshot.column("processed_speech").to_pylist()
+            speech_ids = snapshot.column("speech_id").to_pylist()
+        else:
+            logging.info("Fetching processed speeches from processed_speeches table...")
+            result = session.execute(text("SELECT speech_id, processed_speech FROM processed_speeches ORDER BY speech_id")).fetchall()
 
-        # Extract speeches and speech_ids
-        speeches = [row[1] for row in result]
-        speech_ids = [row[0] for row in result]
+            # Extract speeches and speech_ids
+            speeches = [row[1] for row in result]
+            speech_ids = [row[0] for row in result]
 
-        # Initialize TfidfVectorizer (using stopwords)
-        vectorizer = TfidfVectorizer(stop_words="english")  # You can customize the stopwords
+        # Initialize the term counter (using stopwords); TF-IDF and BM25 weights are derived from its counts
+        vectorizer = CountVectorizer(stop_words="english")  # You can customize the stopwords
 
-        # Create the tfidf_values table if it doesn't exist
+        # Create the tfidf tables if they don't exist
         create_tfidf_table()
 
         # Insert the TF-IDF values into the database
@@ -100,6 +361,7 @@ def process_corpus_and_insert():
 
     except Exception as e:
         logging.error(f"An error occurred: {e}")
+        raise
     finally:
         session.close()
 
@@ -0,0 +1,120 @@
+import os
+import time
+import threading
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Database connection details
+db_user = os.getenv("db_user")
+db_password = os.getenv("db_password")
+db_host = os.getenv("db_host")
+db_port = os.getenv("db_port", 5432)
+db_name = os.getenv("db_name")
+
+# Connection pool configuration (overridable through the environment / .env)
+POOL_SIZE = int(os.getenv("db_pool_size", 5))  # Connections kept open per process
+MAX_OVERFLOW = int(os.getenv("db_max_overflow", 10))  # Extra connections opened under load
+POOL_TIMEOUT = int(os.getenv("db_pool_timeout", 30))  # Seconds to wait for a free connection
+POOL_RECYCLE = int(os.getenv("db_pool_recycle", 1800))  # Seconds before a connection is replaced
+ECHO = os.getenv("db_echo", "false").lower() in ("1", "true", "yes")
+# Statement timeouts in milliseconds, 0 disables them. Pipeline stages run long bulk statements,
+# web requests should fail fast instead of holding a connection.
+STATEMENT_TIMEOUTS = {
+    "pipeline": int(os.getenv("db_statement_timeout_ms", 0)),
+    "app": int(os.getenv("db_app_statement_timeout_ms", 30000)),
+}
+
+
+def database_url():
+    """SQLAlchemy URL of the project database."""
+    return f"postgresql+psycopg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how often connections are checked out and how long callers wait for one."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        self._metrics_lock = threading.Lock()
+        self.metrics = {"checkouts": 0, "timeouts": 0, "wait_seconds_total": 0.0, "wait_seconds_max": 0.0}
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            with self._metrics_lock:
+                self.metrics["timeouts"] += 1
+            raise
+        waited = time.perf_counter() - started
+        with self._metrics_lock:
+            self.metrics["checkouts"] += 1
+            self.metrics["wait_seconds_total"] += waited
+            self.metrics["wait_seconds_max"] = max(self.metrics["wait_seconds_max"], waited)
+        return connection
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(role="pipeline"):
+    """
+    Return the process-wide engine for `role` ("pipeline" or "app"), creating it on first use.
+    Every module shares it instead of opening its own pool.
+    """
+    engine = _engines.get(role)
+    if engine is not None:
+        return engine
+    with _engines_lock:
+        if role not in _engines:
+            connect_args = {"application_name": f"greek_parliament_{role}"}
+            statement_timeout = STATEMENT_TIMEOUTS.get(role, 0)
+            if statement_timeout:
+                connect_args["options"] = f"-c statement_timeout={statement_timeout}"
+            _engines[role] = create_engine(
+                database_url(),
+                echo=ECHO,
+                poolclass=InstrumentedQueuePool,
+                pool_size=POOL_SIZE,
+                max_overflow=MAX_OVERFLOW,
+                pool_timeout=POOL_TIMEOUT,
+                pool_recycle=POOL_RECYCLE,
+                pool_pre_ping=True,
+                connect_args=connect_args,
+            )
+        return _engines[role]
+
+
+def pool_metrics():
+    """Checkout/wait counters and current pool usage of every engine created in this process."""
+    metrics = {}
+    for role, engine in _engines.items():
+        pool = engine.pool
+        metrics[role] = dict(pool.metrics, **{
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "idle": pool.checkedin(),
+            "overflow": pool.overflow(),
+        })
+    return metrics
+
+
+def _reset_after_fork():
+    """
+    A forked worker must never reuse the parent's connections: drop the inherited pools without
+    closing the sockets (they still belong to the parent), so the child opens its own on demand.
+    """
+    for engine in _engines.values():
+        engine.dispose(close=False)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,19 +1,16 @@
-import os
+import csv
+import sys
+import time
+import hashlib
+from datetime import datetime
 from pathlib import Path
-from sqlalchemy import create_engine
+from sqlalchemy import text
+from modules.db import get_engine
 import pandas as pd
 import psycopg
-from dotenv import load_dotenv
 
-load_dotenv()
-
-# Database connection details
-db_user = os.getenv('db_user')
-db_password = os.getenv('db_password')
-db_host = os.getenv('db_host')
-db_port = os.getenv('db_port')
-db_name = os.getenv('db_name')
 table_name = 'speeches'  # Table name in your PostgreSQL database
+source_row_column = 'source_row'  # Numbers the rows in load order, the order a sitting's speeches are merged in
 
 # Resolve the absolute path to the CSV file
 project_root = Path(__file__).resolve().parent.parent  # Adjust this based on your folder structure
@@ -22,8 +19,17 @@ csv_file_path = project_root / "data" / "Greek_Parliament_Proceedings_1989_2020.
 # Batch size for processing chunks
 chunk_size = 10000
 
-# Create the database engine
-engine = create_engine(f'postgresql+psycopg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}', echo=True)
+# Rows streamed through a single COPY before the batch and its checkpoint are committed
+copy_batch_rows = 50000
+
+# Bytes hashed at the start of a CSV file, and just before its checkpoint, to recognise the file on resume
+identity_block_bytes = 65536
+
+# Shared, pooled database engine (see modules/db.py)
+engine = get_engine()
+
+# Speech texts are far longer than the csv module's default field limit
+csv.field_size_limit(sys.maxsize)
 
 
 def preprocess_chunk(chunk):
@@ -39,15 +45,242 @@ def preprocess_chunk(chunk):
     return chunk
 
 
-def import_csv_to_postgresql():
+def parse_sitting_date(value):
+    """
+    Convert a DD/MM/YYYY date to a `datetime`, returning None for empty or malformed values
+    (the same behaviour as `pd.to_datetime(..., errors='coerce')` in `preprocess_chunk`).
+    """
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%d/%m/%Y')
+    except ValueError:
+        return None
+
+
+def create_speeches_table(connection, columns, target_table=table_name):
+    """
+    Create the speeches table with the layout `DataFrame.to_sql` would have produced
+    (TEXT columns and a TIMESTAMP `sitting_date`) if it doesn't exist yet.
+    """
+    column_definitions = ",\n".join(
+        f'"{column}" TIMESTAMP WITHOUT TIME ZONE' if column == 'sitting_date' else f'"{column}" TEXT'
+        for column in columns
+    )
+    connection.execute(text(f"CREATE TABLE IF NOT EXISTS {target_table} (\n{column_definitions}\n);"))
+    add_source_row_column(connection, target_table)
+
+
+def add_source_row_column(connection, target_table=table_name):
+    """
+    Add the identity column numbering the rows in load order. Loaders leave it out of their column
+    lists; tables created by older versions get their existing rows numbered in physical order.
+    """
+    connection.execute(text(
+        f"ALTER TABLE {target_table} ADD COLUMN IF NOT EXISTS {source_row_column} BIGINT GENERATED BY DEFAULT AS IDENTITY;"
+    ))
+
+
+def create_checkpoint_table(connection):
+    """Create the table that stores how far into each CSV file the COPY loader has committed."""
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS import_checkpoints (
+            source TEXT PRIMARY KEY,
+            byte_offset BIGINT NOT NULL,
+            rows_loaded BIGINT NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+    """))
+    # Identity of the file the checkpoint was taken on (missing in tables created by older versions)
+    connection.execute(text("""
+        ALTER TABLE import_checkpoints
+            ADD COLUMN IF NOT EXISTS file_size BIGINT,
+            ADD COLUMN IF NOT EXISTS file_mtime_ns BIGINT,
+            ADD COLUMN IF NOT EXISTS head_hash TEXT,
+            ADD COLUMN IF NOT EXISTS tail_hash TEXT;
+    """))
+
+
+def read_checkpoint(connection, source):
+    """Return the committed checkpoint of a CSV file (as a mapping), or None if it was never loaded."""
+    return connection.execute(
+        text("""
+            SELECT byte_offset, rows_loaded, file_size, file_mtime_ns, head_hash, tail_hash
+            FROM import_checkpoints WHERE source = :source
+        """),
+        {"source": source}
+    ).mappings().fetchone()
+
+
+def hash_block(csv_path, end, length=identity_block_bytes):
+    """SHA-1 of the (up to) `length` bytes of the file that end at byte `end`."""
+    start = max(0, end - length)
+    with open(csv_path, 'rb') as f:
+        f.seek(start)
+        return hashlib.sha1(f.read(end - start)).hexdigest()
+
+
+def file_identity(csv_path):
+    """Size, modification time and hash of the first block of a CSV file."""
+    stat = Path(csv_path).stat()
+    return {
+        "file_size": stat.st_size,
+        "file_mtime_ns": stat.st_mtime_ns,
+        "head_hash": hash_block(csv_path, min(stat.st_size, identity_block_bytes)),
+    }
+
+
+def resume_point(csv_path, checkpoint, identity):
     """
-    Import a large CSV file into the PostgreSQL database in chunks.
+    Return the (byte_offset, rows_loaded) to resume a CSV file from. The checkpoint is only trusted
+    for the file it was taken on, or for that file with records appended (same first block and same
+    bytes before the offset); for any other file at the same path the import restarts from the header.
+    """
+    if checkpoint is None:
+        return 0, 0
+    offset, rows_loaded = checkpoint["byte_offset"], checkpoint["rows_loaded"]
+    if checkpoint["head_hash"] is None:
+        # Written by an older version, which only recorded the path
+        return offset, rows_loaded
+    if checkpoint["head_hash"] == identity["head_hash"]:
+        if (checkpoint["file_size"], checkpoint["file_mtime_ns"]) == (identity["file_size"], identity["file_mtime_ns"]):
+            return offset, rows_loaded
+        if offset <= identity["file_size"] and checkpoint["tail_hash"] == hash_block(csv_path, offset):
+            print(f"{csv_path} has grown since it was last loaded, loading the new records.")
+            return offset, rows_loaded
+    print(f"{csv_path} is not the file that was last loaded from this path, importing it from the start "
+          f"(the {rows_loaded} rows loaded from the earlier file are kept).")
+    return 0, 0
+
+
+def iter_csv_records(csv_file, start_offset):
+    """
+    Yield (record, end_offset) for every CSV record after `start_offset`, where `end_offset` is the
+    byte position just after the record. Speeches may span several physical lines, so the
+    offset is tracked on the raw lines the csv reader actually consumed.
+    """
+    position = start_offset
+
+    def tracked_lines():
+        nonlocal position
+        for raw_line in csv_file:
+            position += len(raw_line)
+            yield raw_line.decode('utf-8')
+
+    csv_file.seek(start_offset)
+    for record in csv.reader(tracked_lines()):
+        yield record, position
+
+
+def copy_csv_to_postgresql(csv_path=csv_file_path, target_table=table_name, batch_rows=copy_batch_rows,
+                           resume=True):
+    """
+    Stream the CSV into PostgreSQL with `COPY ... FROM STDIN`.
+
+    Every batch of `batch_rows` rows is committed together with the byte offset it ended at, so
+    after a crash the loader resumes from the last committed offset without duplicating rows.
+    The checkpoint also records the file's size, mtime and leading bytes, so a different file
+    later copied to the same path is loaded from the start instead of from the old offset.
+    """
+    source = str(Path(csv_path).resolve())
+    identity = file_identity(csv_path)
+    started = time.perf_counter()
+
+    with open(csv_path, 'rb') as csv_file:
+        header = next(csv.reader([csv_file.readline().decode('utf-8-sig')]))
+        header_end = csv_file.tell()
+        date_index = header.index('sitting_date') if 'sitting_date' in header else None
+
+        with engine.begin() as connection:
+            create_speeches_table(connection, header, target_table)
+            create_checkpoint_table(connection)
+            checkpoint = read_checkpoint(connection, source) if resume else None
+        offset, rows_loaded = resume_point(csv_path, checkpoint, identity)
+
+        offset = max(offset, header_end)
+        if rows_loaded:
+            print(f"Resuming from byte {offset} ({rows_loaded} rows already loaded).")
+
+        column_list = ", ".join(f'"{column}"' for column in header)
+        copy_sql = f"COPY {target_table} ({column_list}) FROM STDIN"
+        records = iter_csv_records(csv_file, offset)
+        rows_at_start = rows_loaded
+        exhausted = False
+
+        while not exhausted:
+            batch_count = 0
+            raw_connection = engine.raw_connection()
+            try:
+                with raw_connection.cursor() as cursor:
+                    with cursor.copy(copy_sql) as copy:
+                        for record, end_offset in records:
+                            if len(record) != len(header):
+                                print(f"Skipping malformed record ending at byte {end_offset}.")
+                                offset = end_offset
+                                continue
+                            row = [value if value != '' else None for value in record]
+                            if date_index is not None:
+                                row[date_index] = parse_sitting_date(row[date_index])
+                            copy.write_row(row)
+                            offset = end_offset
+                            batch_count += 1
+                            if batch_count >= batch_rows:
+                                break
+                        else:
+                            exhausted = True
+
+                    rows_loaded += batch_count
+                    cursor.execute(
+                        """
+                        INSERT INTO import_checkpoints (source, byte_offset, rows_loaded, updated_at,
+                                                        file_size, file_mtime_ns, head_hash, tail_hash)
+                        VALUES (%s, %s, %s, now(), %s, %s, %s, %s)
+                        ON CONFLICT (source) DO UPDATE
+                        SET byte_offset = EXCLUDED.byte_offset,
+                            rows_loaded = EXCLUDED.rows_loaded,
+                            updated_at = EXCLUDED.updated_at,
+                            file_size = EXCLUDED.file_size,
+                            file_mtime_ns = EXCLUDED.file_mtime_ns,
+                            head_hash = EXCLUDED.head_hash,
+                            tail_hash = EXCLUDED.tail_hash;
+                        """,
+                        (source, offset, rows_loaded, identity["file_size"], identity["file_mtime_ns"],
+                         identity["head_hash"], hash_block(csv_path, offset))
+                    )
+                raw_connection.commit()
+            except Exception:
+                raw_connection.rollback()
+                raise
+            finally:
+                raw_connection.close()
+
+            elapsed = time.perf_counter() - started
+            rate = (rows_loaded - rows_at_start) / elapsed if elapsed else 0.0
+            print(f"Committed {rows_loaded} rows (byte {offset}), {rate:,.0f} rows/sec")
+
+    print(f"CSV file imported successfully! {rows_loaded - rows_at_start} rows in "
+          f"{time.perf_counter() - started:.1f}s")
+    return rows_loaded
+
+
+def import_csv_to_postgresql(mode='copy'):
+    """
+    Import a large CSV file into the PostgreSQL database.
+
+    `mode='copy'` streams the file through `COPY ... FROM STDIN` and can resume after a crash;
+    `mode='pandas'` keeps the original chunked `DataFrame.to_sql` loader.
     """
     try:
+        if mode == 'copy':
+            copy_csv_to_postgresql()
+            return
+
         # Process the CSV in chunks
         for chunk in pd.read_csv(csv_file_path, chunksize=chunk_size, encoding='utf-8'):
             # Preprocess the chunk
             chunk = preprocess_chunk(chunk)
+            with engine.begin() as connection:
+                create_speeches_table(connection, chunk.columns, table_name)
 
             # Write the chunk to the database
             chunk.to_sql(table_name, con=engine, if_exists='append', index=False)
@@ -57,7 +290,8 @@ def import_csv_to_postgresql():
         print("CSV file imported successfully!")
     except Exception as e:
         print(f"An error occurred: {e}")
+        raise
 
 
 if __name__ == "__main__":
-    import_csv_to_postgresql()
+    import_csv_to_postgresql(mode=sys.argv[1] if len(sys.argv) > 1 else 'copy')
@@ -1,11 +1,15 @@
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.decomposition import TruncatedSVD
-import pandas as pd
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
+from modules.db import get_engine
 from dotenv import load_dotenv
 import os
-from multiprocessing import Pool, cpu_count
+import queue
+import threading
+from multiprocessing import Process, Queue, cpu_count
 import logging
+from modules.artifact_store import save_artifact, load_artifact, corpus_fingerprint
+from modules.snapshots import STAGE_SNAPSHOTS, SnapshotWriter, iter_snapshot_batches, current_watermark
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -13,15 +17,19 @@ logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %
 # Load environment variables
 load_dotenv()
 
-# Database connection details
-db_user = os.getenv("db_user")
-db_password = os.getenv("db_password")
-db_host = os.getenv("db_host")
-db_port = os.getenv("db_port")
-db_name = os.getenv("db_name")
+# Shared, pooled database engine (see modules/db.py)
+engine = get_engine()
 
-# Create the database engine
-engine = create_engine(f"postgresql+psycopg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}", echo=True)
+N_COMPONENTS = 10  # Dimensions of the LSI space
+FETCH_SIZE = 10000  # Rows pulled per round trip while streaming the corpus
+NUM_WORKERS = int(os.getenv("lsi_workers", cpu_count()))  # Projection worker processes
+PROJECTION_BATCH_SIZE = 1000  # Speeches per batch handed to a projection worker
+QUEUE_BATCHES = 2  # Batches buffered per worker in each queue, which bounds memory usage
+WORKER_POLL_SECONDS = 5  # How often a blocked queue operation checks that the workers are still alive
+
+# Fitted model, loaded once per worker process by init_projection_worker()
+lsi_vectorizer = None
+lsi_svd = None
 
 def create_lsi_table():
     """Create the LSI table in the database."""
@@ -41,96 +49,272 @@ def create_lsi_table():
         logging.error(f"Error creating LSI table: {e}")
         raise
 
-def fetch_speeches_chunk(offset, limit):
-    """Fetch a chunk of processed speeches from the database."""
+def fetch_speeches_after(connection, last_id, limit):
+    """Fetch the next batch of processed speeches after `last_id`, using keyset pagination."""
+    return connection.execute(
+        text("""
+            SELECT speech_id, processed_speech
+            FROM processed_speeches
+            WHERE speech_id > :last_id
+            ORDER BY speech_id
+            LIMIT :limit
+        """),
+        {"last_id": last_id, "limit": limit}
+    ).fetchall()
+
+
+def iter_processed_speeches():
+    """Stream the processed speeches from the database (or its snapshot) without materialising the whole corpus."""
+    if STAGE_SNAPSHOTS:
+        for batch in iter_snapshot_batches("processed_speeches", columns=["processed_speech"]):
+            yield from batch.column(0).to_pylist()
+        return
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=FETCH_SIZE).execute(
+            text("SELECT processed_speech FROM processed_speeches ORDER BY speech_id")
+        )
+        for row in result:
+            yield row[0]
+
+
+def fit_lsi_model(n_components=N_COMPONENTS, force=False):
+    """
+    Fit a single LSI model on the full corpus: one TF-IDF vocabulary and a randomized truncated
+    SVD over the sparse TF-IDF matrix, stored as the "lsi" artifact. If the stored model was
+    already fitted on the current corpus it is reused instead of refitted.
+    """
     try:
         with engine.connect() as connection:
-            logging.debug(f"Fetching speeches: offset={offset}, limit={limit}")
-            result = connection.execute(
-                text("SELECT speech_id, processed_speech FROM processed_speeches ORDER BY speech_id LIMIT :limit OFFSET :offset"),
-                {"limit": limit, "offset": offset}
-            )
-            return pd.DataFrame(result.fetchall(), columns=["speech_id", "processed_speech"])
+            fingerprint = corpus_fingerprint(connection)
+        if not force and load_artifact("lsi", fingerprint=fingerprint) is not None:
+            logging.info("The stored LSI model matches the current corpus, skipping the fit.")
+            return load_lsi_model()
+
+        logging.info("Fitting the TF-IDF vectorizer on the full corpus...")
+        vectorizer = TfidfVectorizer(stop_words="english", max_features=10000)
+        tfidf_matrix = vectorizer.fit_transform(iter_processed_speeches())
+
+        logging.info(f"Fitting randomized SVD with {n_components} components on a {tfidf_matrix.shape} matrix...")
+        svd = TruncatedSVD(n_components=n_components, algorithm="randomized", random_state=42)
+        svd.fit(tfidf_matrix)
+        logging.info(f"Explained variance ratio: {svd.explained_variance_ratio_.sum():.4f}")
+
+        save_artifact(
+            "lsi",
+            fingerprint,
+            objects={"vectorizer": vectorizer, "svd": svd},
+            arrays={"components": svd.components_},
+            metadata={"n_components": n_components, "n_terms": len(vectorizer.vocabulary_),
+                      "explained_variance": float(svd.explained_variance_ratio_.sum())}
+        )
+        return vectorizer, svd
     except Exception as e:
-        logging.error(f"Error fetching speeches: {e}")
+        logging.error(f"Error fitting the LSI model: {e}")
         raise
 
 
-def compute_lsi_for_chunk(speeches_chunk, n_components=10):
-    """Compute LSI vectors for a chunk of speeches."""
-    try:
-        vectorizer = TfidfVectorizer(stop_words="english", max_features=10000)
-        tfidf_matrix = vectorizer.fit_transform(speeches_chunk["processed_speech"])
+def load_lsi_model(mmap=True):
+    """Load the stored LSI vectorizer and SVD (with memory-mapped components)."""
+    artifact = load_artifact("lsi", mmap=mmap)
+    if artifact is None:
+        raise RuntimeError("No LSI model found in the artifact store, run the LSI stage first.")
+    return artifact["vectorizer"], artifact["svd"]
+
 
-        svd = TruncatedSVD(n_components=n_components, random_state=42)
-        lsi_matrix = svd.fit_transform(tfidf_matrix)
+def init_projection_worker():
+    """Load the fitted LSI model once per worker process."""
+    global lsi_vectorizer, lsi_svd
+    lsi_vectorizer, lsi_svd = load_lsi_model()
 
-        return [(row["speech_id"], lsi_vector.tolist()) for row, lsi_vector in zip(speeches_chunk.to_dict(orient="records"), lsi_matrix)]
+
+def compute_lsi_for_chunk(speeches):
+    """Project a chunk of speeches into the global LSI space."""
+    try:
+        tfidf_matrix = lsi_vectorizer.transform(speeches)
+        return lsi_svd.transform(tfidf_matrix)
     except Exception as e:
         logging.error(f"Error during LSI computation: {e}")
         raise
 
-def store_lsi_vectors_in_parallel(data_chunk):
-    """Store LSI vectors for a chunk in the database with conflict handling."""
-    engine_process = create_engine(f"postgresql+psycopg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}", echo=False)
 
+def dead_worker_error(workers):
+    """Describe a worker that died without finishing (e.g. killed by the OOM killer), or return None."""
+    for worker in workers:
+        if not worker.is_alive() and worker.exitcode != 0:
+            return f"LSI worker {worker.pid} died with exit code {worker.exitcode}"
+    return None
+
+
+def put_task(task_queue, item, outcome):
+    """
+    Put `item` on the bounded task queue. Returns False instead of blocking forever once the
+    writer has reported an error, since the workers that would take it may be gone.
+    """
+    while True:
+        try:
+            task_queue.put(item, timeout=WORKER_POLL_SECONDS)
+            return True
+        except queue.Full:
+            if "error" in outcome:
+                return False
+
+
+def produce_speech_batches(task_queue, num_workers, outcome, batch_size=PROJECTION_BATCH_SIZE):
+    """
+    Producer: keyset-paginate processed_speeches and feed the batches to the workers.
+    `put` blocks while the bounded queue is full, so at most a few batches are in flight;
+    it stops early once the writer has reported an error. A failure to fetch is recorded in
+    `outcome` before the stop signals go out, so the writer rolls back instead of committing.
+    """
+    last_id = 0
+    batches = 0
     try:
-        with engine_process.connect() as connection:
-            with connection.begin():  # Start a transaction
-                for speech_id, lsi_vector in data_chunk:
-                    connection.execute(
-                        text("""
-                            INSERT INTO lsi_speeches (speech_id, lsi_vector)
-                            VALUES (:speech_id, :lsi_vector)
-                            ON CONFLICT (speech_id) DO NOTHING
-                        """),
-                        {"speech_id": speech_id, "lsi_vector": lsi_vector}
-                    )
-                logging.debug(f"Stored LSI vectors for {len(data_chunk)} speeches.")
+        if STAGE_SNAPSHOTS:
+            for batch in iter_snapshot_batches("processed_speeches", batch_size=batch_size):
+                if not put_task(task_queue, (batch.column("speech_id").to_pylist(),
+                                             batch.column("processed_speech").to_pylist()), outcome):
+                    return batches
+                batches += 1
+            logging.info(f"Queued {batches} batches from the processed_speeches snapshot.")
+            return batches
+        with engine.connect() as connection:
+            while True:
+                rows = fetch_speeches_after(connection, last_id, batch_size)
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                if not put_task(task_queue, ([row[0] for row in rows], [row[1] for row in rows]), outcome):
+                    return batches
+                batches += 1
+                logging.info(f"Queued batch {batches} (speeches up to id {last_id}).")
     except Exception as e:
-        logging.error(f"Error storing LSI vectors: {e}")
+        outcome.setdefault("error", f"Fetching speeches failed: {e}")
         raise
     finally:
-        engine_process.dispose()  # Clean up the engine for this process
+        # One stop signal per worker, even if fetching failed
+        for _ in range(num_workers):
+            if not put_task(task_queue, None, outcome):
+                break
+    return batches
 
 
+def projection_worker(task_queue, result_queue):
+    """Worker process: load the LSI model once, then project batches until the stop signal."""
+    try:
+        init_projection_worker()
+    except Exception as e:
+        result_queue.put(("error", f"Could not load the LSI model: {e}"))
+        task_queue = None
 
-def process_lsi_in_parallel(total_speeches, chunk_size=1000):
-    """Process LSI vectors in parallel."""
-    num_chunks = (total_speeches + chunk_size - 1) // chunk_size
-    logging.info(f"Processing {num_chunks} chunks with {cpu_count()} workers...")
+    while task_queue is not None:
+        batch = task_queue.get()
+        if batch is None:
+            break
+        speech_ids, speeches = batch
+        try:
+            result_queue.put((speech_ids, compute_lsi_for_chunk(speeches)))
+        except Exception as e:
+            result_queue.put(("error", str(e)))
+    result_queue.put(None)
 
-    with Pool(cpu_count()) as pool:
-        for i in range(num_chunks):
-            offset = i * chunk_size
-            logging.info(f"Fetching chunk {i + 1}/{num_chunks}...")
-            speeches_chunk = fetch_speeches_chunk(offset, chunk_size)
 
-            logging.info("Computing LSI vectors...")
-            lsi_data = compute_lsi_for_chunk(speeches_chunk)
+def write_lsi_vectors(result_queue, workers, outcome):
+    """
+    Single writer: stream every projected vector into lsi_speeches through one COPY and commit
+    once all workers are done (and, with stage snapshots, into the lsi_speeches snapshot as well).
+    A worker error, or a worker that dies without sending its stop signal, rolls everything back
+    and is reported through `outcome`.
+    """
+    num_workers = len(workers)
+    finished = 0
+    stored = 0
+    raw_connection = engine.raw_connection()
+    snapshot = SnapshotWriter("lsi_speeches") if STAGE_SNAPSHOTS else None
+    try:
+        with raw_connection.cursor() as cursor:
+            with cursor.copy("COPY lsi_speeches (speech_id, lsi_vector) FROM STDIN") as copy:
+                copy.set_types(["int4", "float8[]"])
+                while finished < num_workers:
+                    try:
+                        item = result_queue.get(timeout=WORKER_POLL_SECONDS)
+                    except queue.Empty:
+                        error = outcome.get("error") or dead_worker_error(workers)
+                        if error:
+                            raise RuntimeError(error)
+                        continue
+                    if item is None:
+                        finished += 1
+                    elif item[0] == "error":
+                        raise RuntimeError(item[1])
+                    else:
+                        speech_ids, vectors = item
+                        for speech_id, lsi_vector in zip(speech_ids, vectors.tolist()):
+                            copy.write_row((speech_id, lsi_vector))
+                        if snapshot is not None:
+                            snapshot.write_columns([speech_ids, vectors])
+                        stored += len(speech_ids)
+                        logging.debug(f"Stored LSI vectors for {len(speech_ids)} speeches.")
+                # Every worker stopped, but the producer may have stopped early after an error
+                if "error" in outcome:
+                    raise RuntimeError(outcome["error"])
+        raw_connection.commit()
+        outcome["stored"] = stored
+    except Exception as e:
+        raw_connection.rollback()
+        if snapshot is not None:
+            snapshot.abort()
+        outcome.setdefault("error", str(e))
+        return
+    finally:
+        raw_connection.close()
 
-            logging.info("Storing LSI vectors...")
-            pool.apply_async(store_lsi_vectors_in_parallel, (lsi_data,))
+    if snapshot is not None:
+        try:
+            with engine.connect() as connection:
+                snapshot.commit(current_watermark(connection, "lsi_speeches"))
+        except Exception as e:
+            snapshot.abort()
+            logging.warning(f"Could not write the lsi_speeches snapshot, it will be exported on first use: {e}")
 
-        pool.close()
-        pool.join()
 
-def apply_lsi_parallel():
-    """Main function to compute LSI using multiprocessing."""
-    create_lsi_table()  # Ensure the table is created before starting multiprocessing
+def process_lsi_in_parallel(num_workers=NUM_WORKERS, batch_size=PROJECTION_BATCH_SIZE):
+    """
+    Project all speeches with the fitted LSI model: a keyset producer, `num_workers` projection
+    processes and a single COPY writer, connected by bounded queues.
+    """
+    logging.info(f"Projecting speeches with {num_workers} workers...")
+    task_queue = Queue(maxsize=QUEUE_BATCHES * num_workers)
+    result_queue = Queue(maxsize=QUEUE_BATCHES * num_workers)
+
+    # Workers never touch the database, so nothing from the parent's pool leaks into them
+    workers = [Process(target=projection_worker, args=(task_queue, result_queue), daemon=True)
+               for _ in range(num_workers)]
+    for worker in workers:
+        worker.start()
+
+    outcome = {}
+    writer = threading.Thread(target=write_lsi_vectors, args=(result_queue, workers, outcome))
+    writer.start()
 
     try:
-        logging.info("Fetching total number of speeches...")
-        with engine.connect() as connection:
-            total_speeches = connection.execute(
-                text("SELECT COUNT(*) FROM processed_speeches")
-            ).scalar()
-            logging.info(f"Total speeches: {total_speeches}")
-    except Exception as e:
-        logging.error(f"Error fetching total number of speeches: {e}")
-        raise
+        produce_speech_batches(task_queue, num_workers, outcome, batch_size)
+    finally:
+        writer.join()
+        # After an error nobody drains the queues, so stop the workers that are still running
+        for worker in workers:
+            if "error" in outcome and worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+    if "error" in outcome:
+        raise RuntimeError(f"LSI projection failed: {outcome['error']}")
+    logging.info(f"Stored LSI vectors for {outcome['stored']} speeches.")
 
-    process_lsi_in_parallel(total_speeches)
+def apply_lsi_parallel():
+    """Main function to fit the global LSI model and project every speech using multiprocessing."""
+    create_lsi_table()  # Ensure the table is created before starting multiprocessing
+    fit_lsi_model()
+    process_lsi_in_parallel()
 
 if __name__ == "__main__":
     apply_lsi_parallel()
@@ -0,0 +1,303 @@
+import os
+import time
+import hashlib
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+from pathlib import Path
+from sqlalchemy import text
+from modules.db import get_engine
+from modules.create_dimensions import create_dataset_versions_table, bump_dataset_version
+
+# Shared, pooled database engine (see modules/db.py)
+engine = get_engine()
+
+MAX_PARALLEL_STAGES = int(os.getenv("pipeline_parallel_stages", 2))  # Independent stages run at once
+
+# Logging setup
+logging.basicConfig(level=logging.INFO)
+
+
+class Stage:
+    """
+    One pipeline step. `inputs` and `outputs` name tables (or files, as "file:<path>"); a stage
+    depends on the stages that produce its inputs, plus any stage listed in `after`.
+    """
+
+    def __init__(self, name, function, inputs=(), outputs=(), after=()):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.after = list(after)
+
+    def __repr__(self):
+        return f"Stage({self.name!r})"
+
+
+def resolve_dependencies(stages):
+    """
+    Return {stage name: set of stage names it waits for}. An input comes from the closest earlier
+    stage that outputs it, so a stage that rewrites its own input (e.g. a cleanup) is chained in order.
+    """
+    names = {stage.name for stage in stages}
+    dependencies = {}
+    for position, stage in enumerate(stages):
+        required = set()
+        for source in stage.inputs:
+            producer = next((earlier for earlier in reversed(stages[:position]) if source in earlier.outputs), None)
+            if producer is not None:
+                required.add(producer.name)
+        for name in stage.after:
+            if name not in names:
+                raise ValueError(f"Stage {stage.name} runs after unknown stage {name}")
+            required.add(name)
+        dependencies[stage.name] = required
+    return dependencies
+
+
+def create_pipeline_runs_table():
+    """Create the table recording the input watermark and timing of every stage's last run."""
+    with engine.begin() as connection:
+        create_dataset_versions_table(connection)
+        connection.execute(text("""
+            CREATE TABLE IF NOT EXISTS pipeline_runs (
+                stage TEXT PRIMARY KEY,
+                input_fingerprint TEXT,
+                status TEXT NOT NULL,
+                started_at TIMESTAMP,
+                duration_seconds DOUBLE PRECISION,
+                error TEXT
+            );
+        """))
+
+
+def source_watermark(connection, source):
+    """
+    Cheap change marker of one input: size and modification time for files, and for tables the
+    relation's file node (its oid for partitioned tables, which have no storage of their own),
+    which changes whenever a table is rebuilt, truncated or swapped in, plus the table's entry in
+    dataset_versions, which every pipeline stage (and an append) bumps for the tables it writes.
+    Neither needs to scan the table. Returns None if the input doesn't exist.
+    """
+    if source.startswith("file:"):
+        path = Path(source[len("file:"):])
+        if not path.exists():
+            return None
+        stat = path.stat()
+        return f"{stat.st_size}:{int(stat.st_mtime)}"
+    row = connection.execute(text("""
+        SELECT COALESCE(pg_relation_filenode(r.relation), r.relation::oid),
+               to_regclass('dataset_versions') IS NOT NULL
+        FROM (SELECT to_regclass(:name) AS relation) r
+        WHERE r.relation IS NOT NULL
+    """), {"name": source}).fetchone()
+    if row is None:
+        return None
+    file_node, has_versions = row
+    version = 0
+    if has_versions:
+        version = connection.execute(
+            text("SELECT version FROM dataset_versions WHERE name = :name"), {"name": source}
+        ).scalar() or 0
+    return f"{file_node}:{version}"
+
+
+def bump_table_versions(sources):
+    """Bump the dataset version of every table among `sources` (files carry their own mtime), marking it changed."""
+    tables = [source for source in sources if not source.startswith("file:")]
+    if not tables:
+        return
+    with engine.begin() as connection:
+        for table in tables:
+            bump_dataset_version(connection, table)
+
+
+def input_fingerprint(stage):
+    """Fingerprint of all inputs of a stage, or None if one of them is missing."""
+    with engine.connect() as connection:
+        watermarks = [source_watermark(connection, source) for source in stage.inputs]
+    if any(watermark is None for watermark in watermarks):
+        return None
+    return hashlib.sha1("|".join(watermarks).encode()).hexdigest()[:16]
+
+
+def outputs_exist(stage):
+    with engine.connect() as connection:
+        return all(source_watermark(connection, source) is not None for source in stage.outputs)
+
+
+def last_fingerprint(stage):
+    with engine.connect() as connection:
+        return connection.execute(
+            text("SELECT input_fingerprint FROM pipeline_runs WHERE stage = :stage AND status = 'succeeded'"),
+            {"stage": stage.name}
+        ).scalar()
+
+
+def record_run(stage, status, started_at, duration, fingerprint=None, error=None):
+    with engine.begin() as connection:
+        connection.execute(text("""
+            INSERT INTO pipeline_runs (stage, input_fingerprint, status, started_at, duration_seconds, error)
+            VALUES (:stage, :fingerprint, :status, to_timestamp(:started_at), :duration, :error)
+            ON CONFLICT (stage) DO UPDATE
+            SET input_fingerprint = EXCLUDED.input_fingerprint,
+                status = EXCLUDED.status,
+                started_at = EXCLUDED.started_at,
+                duration_seconds = EXCLUDED.duration_seconds,
+                error = EXCLUDED.error;
+        """), {"stage": stage.name, "fingerprint": fingerprint, "status": status, "started_at": started_at,
+               "duration": duration, "error": error})
+
+
+def is_up_to_date(stage):
+    """A stage can be skipped if its outputs exist and its inputs are unchanged since its last successful run."""
+    if not stage.inputs:
+        return False
+    fingerprint = input_fingerprint(stage)
+    return fingerprint is not None and fingerprint == last_fingerprint(stage) and outputs_exist(stage)
+
+
+def mark_up_to_date(stages):
+    """
+    Record the current inputs of `stages` as processed, for stages whose outputs were updated outside
+    the pipeline. Whatever updated them must have bumped the versions of the tables it wrote.
+    """
+    create_pipeline_runs_table()
+    for stage in stages:
+        record_run(stage, "succeeded", time.time(), 0.0, input_fingerprint(stage))
+
+
+def _run_stage_in_child(stage):
+    """Entry point of a forked stage process: any exception becomes a non-zero exit code."""
+    try:
+        stage.function()
+    except BaseException:
+        logging.exception(f"Stage {stage.name} failed.")
+        os._exit(1)
+    os._exit(0)
+
+
+def downstream_of(stages, dependencies, names):
+    """Names of the given stages and of every stage that (transitively) waits for one of them."""
+    downstream = set(names)
+    for stage in stages:
+        if dependencies[stage.name] & downstream:
+            downstream.add(stage.name)
+    return downstream
+
+
+def select_stages(stages, dependencies, only=None, start_from=None):
+    """
+    Return (names of stages to consider, names of stages forced to run). `only` runs exactly the given
+    stages; `start_from` runs a stage and everything downstream of it, regardless of watermarks.
+    """
+    names = [stage.name for stage in stages]
+    for name in list(only or []) + ([start_from] if start_from else []):
+        if name not in names:
+            raise ValueError(f"Unknown stage {name}; stages are: {', '.join(names)}")
+    if only:
+        return set(only), set(only)
+    if start_from:
+        downstream = downstream_of(stages, dependencies, [start_from])
+        return downstream, downstream
+    return set(names), set()
+
+
+def run_pipeline(stages, only=None, start_from=None, force=False, max_parallel=MAX_PARALLEL_STAGES,
+                 force_from=()):
+    """
+    Run the stages in dependency order. Independent stages run concurrently in forked processes (up to
+    `max_parallel` at once); a stage whose inputs haven't changed since its last successful run is skipped.
+    The stages in `force_from` and everything downstream of them run regardless, for changes the
+    watermarks can't see. A failed stage stops everything downstream of it. Returns {stage name: (status, seconds)}.
+    """
+    create_pipeline_runs_table()
+    stage_by_name = {stage.name: stage for stage in stages}
+    dependencies = resolve_dependencies(stages)
+    selected, forced = select_stages(stages, dependencies, only, start_from)
+    if force:
+        forced = set(selected)
+    forced |= downstream_of(stages, dependencies, force_from) & selected
+
+    pending = [stage.name for stage in stages if stage.name in selected]
+    # Stages outside the selection count as done for the ones inside it
+    finished = {stage.name for stage in stages if stage.name not in selected}
+    failed = set()
+    running = {}  # process sentinel -> (stage, process, started_at)
+    report = {}
+
+    while pending or running:
+        progressed = False
+        for name in list(pending):
+            if len(running) >= max(max_parallel, 1):
+                break
+            blocking = dependencies[name] - finished
+            if blocking & failed:
+                pending.remove(name)
+                progressed = True
+                failed.add(name)
+                report[name] = ("blocked", 0.0)
+                logging.error(f"Stage {name} skipped: an upstream stage failed.")
+                continue
+            if blocking:
+                continue
+            pending.remove(name)
+            progressed = True
+            stage = stage_by_name[name]
+            if name not in forced and is_up_to_date(stage):
+                finished.add(name)
+                report[name] = ("up to date", 0.0)
+                logging.info(f"Stage {name} is up to date, skipping.")
+                continue
+
+            logging.info(f"Starting stage {name}...")
+            # Bumped before the stage writes anything, so a snapshot it takes records the new versions
+            # and even a failed, partly written run counts as a change for the stages downstream
+            bump_table_versions(stage.outputs)
+            started_at = time.time()
+            if max_parallel <= 1:
+                # Run in this process, one stage at a time
+                try:
+                    stage.function()
+                    status = "succeeded"
+                except Exception as e:
+                    logging.exception(f"Stage {name} failed.")
+                    status, error = "failed", str(e)
+                duration = time.time() - started_at
+                if status == "succeeded":
+                    finished.add(name)
+                    record_run(stage, status, started_at, duration, input_fingerprint(stage))
+                else:
+                    failed.add(name)
+                    record_run(stage, status, started_at, duration, error=error)
+                report[name] = (status, duration)
+                logging.info(f"Stage {name} {status} in {duration:.1f}s.")
+                continue
+
+            process = multiprocessing.get_context("fork").Process(
+                target=_run_stage_in_child, args=(stage,), name=f"stage-{name}"
+            )
+            process.start()
+            running[process.sentinel] = (stage, process, started_at)
+
+        if not running:
+            if not progressed:
+                raise RuntimeError(f"Stages {pending} wait for stages that never run (circular 'after'?)")
+            continue
+        for sentinel in wait(list(running)):
+            stage, process, started_at = running.pop(sentinel)
+            process.join()
+            duration = time.time() - started_at
+            if process.exitcode == 0:
+                finished.add(stage.name)
+                record_run(stage, "succeeded", started_at, duration, input_fingerprint(stage))
+                status = "succeeded"
+            else:
+                failed.add(stage.name)
+                record_run(stage, "failed", started_at, duration, error=f"exit code {process.exitcode}")
+                status = "failed"
+            report[stage.name] = (status, duration)
+            logging.info(f"Stage {stage.name} {status} in {duration:.1f}s.")
+
+    return report
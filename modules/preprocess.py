@@ -1,100 +1,82 @@
 import os
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
+from modules.db import get_engine
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
 import spacy
-import pandas as pd
 import logging
-import unicodedata
-import re
-import pickle
 from multiprocessing import Pool
 from greek_stemmer import GreekStemmer  # type: ignore # Ensure this is correctly imported
-from tqdm import tqdm
+from modules.token_cache import TokenCache, stem_token, CACHE_PATH
 
 # Load environment variables
 load_dotenv()
 
-# Database connection details
-db_user = os.getenv("db_user")
-db_password = os.getenv("db_password")
-db_host = os.getenv("db_host")
-db_port = os.getenv("db_port")
-db_name = os.getenv("db_name")
-
-# Create the database engine
-engine = create_engine(f"postgresql+psycopg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}", echo=False)
+# Shared, pooled database engine (see modules/db.py)
+engine = get_engine()
 Session = sessionmaker(bind=engine)
 
-# Load the Greek language model from SpaCy
-try:
-    nlp = spacy.load("el_core_news_sm")
-except OSError:
-    raise Exception("Greek language model not found. Please run python -m spacy download el_core_news_sm.")
-
-# Load stopwords from SpaCy
-stopwords = nlp.Defaults.stop_words
+# Preprocessing engine configuration (overridable through the environment / .env)
+NUM_WORKERS = int(os.getenv("preprocess_workers", os.cpu_count() or 1))  # Worker processes in the pool
+CHUNK_SIZE = int(os.getenv("preprocess_chunk_size", 100))  # Speeches handed to a worker per task
+SPACY_BATCH_SIZE = int(os.getenv("spacy_batch_size", 250))  # Batch size for nlp.pipe inside a worker
+BATCH_SIZE = 100  # Batch size for inserts into the database
+# Speeches fetched per page in streaming mode; a few tasks per worker keeps the pool busy
+PAGE_SIZE = int(os.getenv("preprocess_page_size", NUM_WORKERS * CHUNK_SIZE * 4))
 
-# Initialize Greek stemmer
-greek_stemmer = GreekStemmer()  # Assuming GreekStemmer has been correctly initialized
+SPACY_MODEL = "el_core_news_sm"
+# Stemming only needs the tokens, so every trained component is left out and only the tokenizer runs
+EXCLUDED_COMPONENTS = ["tok2vec", "tagger", "morphologizer", "attribute_ruler", "parser", "senter", "ner", "lemmatizer"]
 
-CHUNK_SIZE = 100  # Process 100 speeches at a time
-BATCH_SIZE = 100  # Batch size for inserts into the database
+# Per-process NLP state, populated once per worker by init_worker()
+nlp = None
+stopwords = None
+greek_stemmer = None
+token_cache = None
 
 # Logging setup
 logging.basicConfig(level=logging.INFO)
 
 
-def remove_accents(text):
-    """Remove accents from Greek words."""
-    if not text:
-        return ''
-    normalized_text = unicodedata.normalize('NFD', text)
-    accent_removed_text = ''.join(
-        char for char in normalized_text if unicodedata.category(char) != 'Mn'
-    )
-    return unicodedata.normalize('NFC', accent_removed_text)
+def load_nlp():
+    """Load the trimmed Greek spaCy pipeline (tokenizer only)."""
+    try:
+        return spacy.load(SPACY_MODEL, exclude=EXCLUDED_COMPONENTS)
+    except OSError:
+        raise Exception("Greek language model not found. Please run python -m spacy download el_core_news_sm.")
+
+
+def init_worker(cache_path=CACHE_PATH):
+    """
+    Pool initializer: load the spaCy pipeline, stopwords, stemmer and the persisted token cache
+    once per worker process.
+    """
+    global nlp, stopwords, greek_stemmer, token_cache
+    nlp = load_nlp()
+    stopwords = nlp.Defaults.stop_words
+    greek_stemmer = GreekStemmer()
+    token_cache = TokenCache.load(cache_path, track_new=True)
+
+
+def create_pool(cache_path=CACHE_PATH):
+    """Create the preprocessing process pool with per-worker NLP initialisation."""
+    logging.info(f"Starting preprocessing pool with {NUM_WORKERS} workers "
+                 f"(chunk size {CHUNK_SIZE}, spaCy batch size {SPACY_BATCH_SIZE})...")
+    return Pool(NUM_WORKERS, initializer=init_worker, initargs=(cache_path,))
 
 
-def preprocess_documents_chunk(texts, nlp, greek_stopwords, UNWANTED_PATTERN, TAB_PATTERN, stemmer, batch_size=250,
-                               n_process=1):
+def preprocess_documents_chunk(texts, nlp, greek_stopwords, stemmer, cache, batch_size=250, n_process=1):
     """
     Generator that preprocesses texts in chunks to manage memory usage.
+    Cleaning and stemming are memoised per surface form through `cache`.
     """
-    for doc in nlp.pipe(texts, batch_size=batch_size, n_process=n_process, disable=["parser", "ner"]):
+    for doc in nlp.pipe(texts, batch_size=batch_size, n_process=n_process):
         tokens = []
         for token in doc:
-            # Remove unwanted patterns
-            cleaned_token = UNWANTED_PATTERN.sub('', token.text)
-            cleaned_token = TAB_PATTERN.sub('', cleaned_token)
-
-            # Uppercase the word and remove accents before passing to stemmer
-            cleaned_token = cleaned_token.upper()  # Uppercase
-            cleaned_token = remove_accents(cleaned_token)  # Remove accents
-
-            # Skip if token is empty, a stopword, or a single character
-            if (not cleaned_token) or (cleaned_token.lower() in greek_stopwords) or (len(cleaned_token) == 1):
-                continue
-
-            # Apply stemming based on POS tag
-            pos = token.pos_
-            try:
-                if pos == "NOUN":
-                    stemmed = stemmer.stem(cleaned_token)  # Stemming method
-                elif pos == "VERB":
-                    stemmed = stemmer.stem(cleaned_token)  # Stemming method
-                elif pos in {"ADJ", "ADV"}:
-                    stemmed = stemmer.stem(cleaned_token)  # Stemming method
-                elif pos == "PROPN":
-                    stemmed = stemmer.stem(cleaned_token)  # Stemming method
-                else:
-                    stemmed = stemmer.stem(cleaned_token)  # Stemming method
-
-                if stemmed:
-                    tokens.append(stemmed)
-            except Exception as e:
-                print(f"Error stemming word '{cleaned_token}': {e}")
-                continue
+            # Every POS tag is stemmed the same way, so the surface form alone determines the stem
+            stemmed = stem_token(token.text, stemmer, greek_stopwords, cache)
+            if stemmed:
+                tokens.append(stemmed)
 
         preprocessed_text = ' '.join(tokens)
         yield preprocessed_text
@@ -118,6 +100,7 @@ def create_processed_speeches_table():
     except Exception as e:
         session.rollback()
         logging.error(f"Error creating processed_speeches table: {e}")
+        raise
     finally:
         session.close()
 
@@ -145,13 +128,47 @@ def save_processed_speeches(speeches_data):
         logging.info(f"Inserted {len(speeches_data)} rows into the processed_speeches table.")
     except Exception as e:
         session.rollback()
-        logging.error(f"An error occurred: {e}")
+        logging.error(f"Error inserting preprocessed speeches: {e}")
+        raise
     finally:
         session.close()
 
 
-def preprocess_and_store_speeches():
-    """Preprocess speeches and store them into the processed_speeches table."""
+def fetch_unprocessed_speeches_page(session, last_id, limit=PAGE_SIZE):
+    """
+    Fetch the next page of final_speeches rows with an id greater than `last_id`, using keyset
+    pagination, together with the highest id scanned. Rows already present in
+    processed_speeches are skipped so that only new speeches are preprocessed.
+    """
+    page = session.execute(
+        text("""
+            SELECT fs.id, fs.merged_speech, ps.speech_id IS NOT NULL AS processed
+            FROM final_speeches fs
+            LEFT JOIN processed_speeches ps ON ps.speech_id = fs.id
+            WHERE fs.id > :last_id
+            ORDER BY fs.id
+            LIMIT :limit
+        """),
+        {"last_id": last_id, "limit": limit}
+    ).fetchall()
+    if not page:
+        return [], None
+    pending = [(row[0], row[1]) for row in page if not row[2]]
+    return pending, page[-1][0]
+
+
+def preprocess_and_store_speeches(streaming=True, start_after=0):
+    """
+    Preprocess speeches and store them into the processed_speeches table.
+
+    In streaming mode final_speeches is walked page by page (from the first id above `start_after`)
+    and every page is committed as soon as it is processed, so an interrupted run loses at most one
+    page and a re-run only processes speeches that are not in processed_speeches yet.
+    """
+    if streaming:
+        preprocess_and_store_speeches_streaming(start_after=start_after)
+        return
+
     session = Session()
     try:
         logging.info("Fetching speeches from final_speeches table...")
@@ -162,33 +179,68 @@ def preprocess_and_store_speeches():
         logging.info(f"Split speeches into {len(chunks)} chunks.")
 
         processed_speeches_data = []
-        with Pool(3) as pool:  # Process in parallel with 3 processes
-            logging.info(f"Processing chunks using 3 CPU cores...")
-            results = pool.map(process_chunk, chunks)
+        cache = TokenCache.load()
+        with create_pool() as pool:
+            # Flatten results into a list of processed speeches as they stream back
+            for sublist, cache_delta in pool.imap_unordered(process_chunk, chunks):
+                cache.merge_delta(cache_delta)
+                for row in sublist:
+                    processed_speeches_data.append((row[0], row[1]))  # Append speech_id and processed_speech
 
-        # Flatten results into a list of processed speeches
-        for sublist in results:
-            for row in sublist:
-                processed_speeches_data.append((row[0], row[1]))  # Append speech_id and processed_speech
+        logging.info(f"Token cache: {cache.stats()}")
+        cache.save()
 
         # Save the processed speeches to the database
         save_processed_speeches(processed_speeches_data)
     except Exception as e:
         logging.error(f"An error occurred: {e}")
+        raise
     finally:
         session.close()
 
 
+def preprocess_and_store_speeches_streaming(page_size=PAGE_SIZE, start_after=0):
+    """Keyset-paginate over final_speeches, preprocessing and committing one page at a time."""
+    session = Session()
+    last_id = start_after
+    total_processed = 0
+    cache = TokenCache.load()
+    try:
+        with create_pool() as pool:
+            while True:
+                pending, last_scanned_id = fetch_unprocessed_speeches_page(session, last_id, page_size)
+                session.commit()  # Release the snapshot between pages
+                if last_scanned_id is None:
+                    break
+                last_id = last_scanned_id
+                if not pending:
+                    continue
+
+                chunks = [pending[i:i + CHUNK_SIZE] for i in range(0, len(pending), CHUNK_SIZE)]
+                # Each chunk is committed in its own transaction as soon as a worker returns it
+                for processed_chunk, cache_delta in pool.imap_unordered(process_chunk, chunks):
+                    save_processed_speeches(processed_chunk)
+                    cache.merge_delta(cache_delta)
+                    total_processed += len(processed_chunk)
+                logging.info(f"Processed speeches up to id {last_id} ({total_processed} in this run). "
+                             f"Token cache: {cache.stats()}")
+
+        logging.info(f"Streaming preprocessing finished: {total_processed} new speeches processed.")
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise
+    finally:
+        session.close()
+        # Keep what the workers learned, even after a partial run
+        cache.save()
+
+
 def process_chunk(chunk):
-    """Process a chunk of speeches (for multiprocessing)."""
+    """Process a chunk of speeches (for multiprocessing, in a worker set up by init_worker)."""
     logging.info(f"Processing chunk with {len(chunk)} speeches...")
     speeches = [row[1] for row in chunk]  # Extract speeches
     speech_ids = [row[0] for row in chunk]  # Extract speech_ids
 
-    # Preprocess the speeches with the required arguments
-    UNWANTED_PATTERN = re.compile(r'[0-9@#$%^&*()\-\_=+\[\]{};:\'",.<>/?\\|`~!]')
-    TAB_PATTERN = re.compile(r'\t+')
-
     # Process each chunk with the correct arguments
     preprocessed_speeches = [
         preprocessed_speech
@@ -196,14 +248,15 @@ def process_chunk(chunk):
             texts=speeches,
             nlp=nlp,
             greek_stopwords=stopwords,
-            UNWANTED_PATTERN=UNWANTED_PATTERN,
-            TAB_PATTERN=TAB_PATTERN,
-            stemmer=greek_stemmer
+            stemmer=greek_stemmer,
+            cache=token_cache,
+            batch_size=SPACY_BATCH_SIZE
         )
     ]
 
+    # The cache delta lets the parent process merge, report and persist what this worker learned
     return [(speech_id, preprocessed_speech) for speech_id, preprocessed_speech in
-            zip(speech_ids, preprocessed_speeches)]
+            zip(speech_ids, preprocessed_speeches)], token_cache.take_delta()
 
 
 if __name__ == "__main__":
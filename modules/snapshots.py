@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import time
+import logging
+from pathlib import Path
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import text
+from modules.db import get_engine
+from modules.pipeline import source_watermark
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Shared, pooled database engine (see modules/db.py)
+engine = get_engine()
+
+# Directory of the Parquet snapshots; every snapshot is <name>.parquet plus a <name>.json sidecar
+project_root = Path(__file__).resolve().parent.parent
+SNAPSHOT_DIR = Path(os.getenv("snapshot_dir", project_root / "data" / "snapshots"))
+# When set, the ML stages read their inputs from the snapshots instead of querying PostgreSQL
+STAGE_SNAPSHOTS = os.getenv("stage_snapshots", "false").lower() in ("1", "true", "yes")
+COMPRESSION = "zstd"
+FETCH_SIZE = 10000  # Rows per round trip while exporting, and per record batch while reading
+
+# Logging setup
+logging.basicConfig(level=logging.INFO)
+
+# Snapshots that can be taken: the tables whose watermark they record, the query that exports them,
+# their Arrow schema and, for those that can be imported back into a table, its primary key
+SNAPSHOTS = {
+    "processed_speeches": {
+        "sources": ["processed_speeches"],
+        "query": "SELECT speech_id, processed_speech FROM processed_speeches ORDER BY speech_id",
+        "schema": pa.schema([("speech_id", pa.int32()), ("processed_speech", pa.large_string())]),
+        "primary_key": "speech_id",
+    },
+    "speech_members": {
+        "sources": ["processed_speeches", "final_speeches"],
+        "query": """
+            SELECT ps.speech_id, fs.member_name, ps.processed_speech
+            FROM processed_speeches ps
+            JOIN final_speeches fs ON ps.speech_id = fs.id
+            WHERE fs.member_name IS NOT NULL
+            ORDER BY ps.speech_id
+        """,
+        "schema": pa.schema([("speech_id", pa.int32()), ("member_name", pa.string()),
+                             ("processed_speech", pa.large_string())]),
+    },
+    "lsi_speeches": {
+        "sources": ["lsi_speeches"],
+        "query": "SELECT speech_id, lsi_vector FROM lsi_speeches ORDER BY speech_id",
+        "schema": pa.schema([("speech_id", pa.int32()), ("lsi_vector", pa.list_(pa.float32()))]),
+        "primary_key": "speech_id",
+    },
+}
+
+# PostgreSQL types of the Arrow types above, for importing a snapshot
+SQL_TYPES = {pa.int32(): "INT", pa.string(): "TEXT", pa.large_string(): "TEXT", pa.list_(pa.float32()): "FLOAT[]"}
+
+
+def snapshot_path(name, snapshot_dir=SNAPSHOT_DIR):
+    return Path(snapshot_dir) / f"{name}.parquet"
+
+
+def current_watermark(connection, name):
+    """Watermark of the tables a snapshot is taken from, None if one of them doesn't exist."""
+    watermarks = [source_watermark(connection, source) for source in SNAPSHOTS[name]["sources"]]
+    if any(watermark is None for watermark in watermarks):
+        return None
+    return "|".join(watermarks)
+
+
+def read_snapshot_metadata(name, snapshot_dir=SNAPSHOT_DIR):
+    metadata_path = snapshot_path(name, snapshot_dir).with_suffix(".json")
+    if not metadata_path.exists():
+        return None
+    with open(metadata_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def snapshot_is_current(connection, name, snapshot_dir=SNAPSHOT_DIR):
+    """True if the snapshot exists and its source tables haven't changed since it was taken."""
+    metadata = read_snapshot_metadata(name, snapshot_dir)
+    if metadata is None or not snapshot_path(name, snapshot_dir).exists():
+        return False
+    return metadata["watermark"] == current_watermark(connection, name)
+
+
+def to_arrow(values, field):
+    """Convert one column to Arrow; a 2-D float array becomes a list column without a Python round trip."""
+    if pa.types.is_list(field.type) and isinstance(values, np.ndarray) and values.ndim == 2:
+        offsets = np.arange(0, values.size + 1, values.shape[1], dtype=np.int32)
+        return pa.ListArray.from_arrays(offsets, pa.array(values.astype(np.float32).ravel()))
+    return pa.array(values, type=field.type)
+
+
+class SnapshotWriter:
+    """
+    Write a snapshot one batch of columns at a time into a temporary file. `commit` moves it in
+    place and records the watermark of its source tables; `abort` throws it away.
+    """
+
+    def __init__(self, name, snapshot_dir=SNAPSHOT_DIR):
+        self.name = name
+        self.snapshot_dir = Path(snapshot_dir)
+        self.schema = SNAPSHOTS[name]["schema"]
+        self.path = snapshot_path(name, snapshot_dir)
+        self.tmp_path = self.path.with_suffix(".parquet.tmp")
+        self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+        self.writer = pq.ParquetWriter(self.tmp_path, self.schema, compression=COMPRESSION)
+        self.rows = 0
+
+    def write_columns(self, columns):
+        """Append one batch, given as a sequence of columns in schema order."""
+        batch = pa.RecordBatch.from_arrays(
+            [to_arrow(values, field) for values, field in zip(columns, self.schema)], schema=self.schema
+        )
+        self.writer.write_batch(batch)
+        self.rows += batch.num_rows
+
+    def commit(self, watermark):
+        self.writer.close()
+        metadata_path = self.path.with_suffix(".json")
+        # Without its sidecar a snapshot counts as stale, so drop it before replacing the data
+        metadata_path.unlink(missing_ok=True)
+        os.replace(self.tmp_path, self.path)
+        with open(metadata_path, "w", encoding="utf-8") as f:
+            json.dump({"watermark": watermark, "rows": self.rows,
+                       "created_at": time.strftime("%Y-%m-%dT%H:%M:%S")}, f)
+        logging.info(f"Wrote snapshot '{self.name}' ({self.rows} rows) to {self.path}.")
+
+    def abort(self):
+        self.writer.close()
+        self.tmp_path.unlink(missing_ok=True)
+
+
+def export_snapshot(name, snapshot_dir=SNAPSHOT_DIR):
+    """Stream the snapshot's query into a Parquet file. Returns the number of rows written."""
+    spec = SNAPSHOTS[name]
+    logging.info(f"Exporting snapshot '{name}'...")
+    with engine.connect() as connection:
+        # Taken before reading, so rows written meanwhile make the snapshot stale rather than lost
+        watermark = current_watermark(connection, name)
+        if watermark is None:
+            raise RuntimeError(f"Cannot export snapshot '{name}': {', '.join(spec['sources'])} must exist.")
+        writer = SnapshotWriter(name, snapshot_dir)
+        try:
+            result = connection.execution_options(stream_results=True, yield_per=FETCH_SIZE).execute(text(spec["query"]))
+            for rows in result.partitions():
+                writer.write_columns(list(zip(*rows)))
+        except Exception:
+            writer.abort()
+            raise
+    writer.commit(watermark)
+    return writer.rows
+
+
+def ensure_snapshot(name, snapshot_dir=SNAPSHOT_DIR):
+    """Return the path of an up-to-date snapshot, exporting it first if it is missing or stale."""
+    with engine.connect() as connection:
+        is_current = snapshot_is_current(connection, name, snapshot_dir)
+    if not is_current:
+        export_snapshot(name, snapshot_dir)
+    return snapshot_path(name, snapshot_dir)
+
+
+def read_snapshot(name, columns=None, snapshot_dir=SNAPSHOT_DIR):
+    """Read an up-to-date snapshot as a (memory-mapped) Arrow table."""
+    return pq.read_table(ensure_snapshot(name, snapshot_dir), columns=columns, memory_map=True)
+
+
+def iter_snapshot_batches(name, columns=None, batch_size=FETCH_SIZE, snapshot_dir=SNAPSHOT_DIR):
+    """Iterate over an up-to-date snapshot in Arrow record batches of `batch_size` rows."""
+    parquet_file = pq.ParquetFile(ensure_snapshot(name, snapshot_dir), memory_map=True)
+    yield from parquet_file.iter_batches(batch_size=batch_size, columns=columns)
+
+
+def snapshot_vectors(name="lsi_speeches", snapshot_dir=SNAPSHOT_DIR):
+    """
+    Return (speech_ids int32, vectors float32 of shape (n, dimensions)) from a vector snapshot.
+    The float values are handed to NumPy without conversion; row groups are combined with at most one copy.
+    """
+    table = read_snapshot(name, snapshot_dir=snapshot_dir)
+    speech_ids = table.column("speech_id").to_numpy()
+    vectors = table.column("lsi_vector").combine_chunks()
+    if not len(speech_ids):
+        return speech_ids, np.zeros((0, 0), dtype=np.float32)
+    values = vectors.flatten().to_numpy()
+    return speech_ids, values.reshape(len(speech_ids), -1)
+
+
+def import_snapshot(name, table_name=None, snapshot_dir=SNAPSHOT_DIR):
+    """Load a snapshot back into PostgreSQL (into `table_name`, by default the table it was taken from)."""
+    # Imported here because create_tf_idf reads its input through this module
+    from modules.create_tf_idf import copy_rows_and_swap
+
+    spec = SNAPSHOTS[name]
+    if "primary_key" not in spec:
+        raise ValueError(f"Snapshot '{name}' is derived from several tables and can't be imported.")
+    column_definitions = [f"{field.name} {SQL_TYPES[field.type]}" for field in spec["schema"]]
+    parquet_file = pq.ParquetFile(snapshot_path(name, snapshot_dir), memory_map=True)
+
+    def iter_rows():
+        for batch in parquet_file.iter_batches(batch_size=FETCH_SIZE):
+            yield from zip(*(column.to_pylist() for column in batch.columns))
+
+    row_count = copy_rows_and_swap(table_name or name, column_definitions, spec["primary_key"], iter_rows())
+    logging.info(f"Imported {row_count} rows from snapshot '{name}' into {table_name or name}.")
+    return row_count
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("export", "import"):
+        print("Usage: python -m modules.snapshots export [name ...] | import <name> [table]")
+        sys.exit(1)
+    if sys.argv[1] == "export":
+        for snapshot_name in sys.argv[2:] or SNAPSHOTS:
+            export_snapshot(snapshot_name)
+    else:
+        import_snapshot(*sys.argv[2:4])
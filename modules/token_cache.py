@@ -0,0 +1,155 @@
+import os
+import re
+import pickle
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+
+# Resolve the default location of the persisted cache
+project_root = Path(__file__).resolve().parent.parent
+CACHE_PATH = Path(os.getenv("token_cache_path", project_root / "data" / "token_cache.pkl"))
+CACHE_SIZE = int(os.getenv("token_cache_size", 200000))  # Maximum number of cached surface forms
+
+UNWANTED_PATTERN = re.compile(r'[0-9@#$%^&*()\-\_=+\[\]{};:\'",.<>/?\\|`~!]')
+TAB_PATTERN = re.compile(r'\t+')
+
+
+def remove_accents(text):
+    """Remove accents from Greek words."""
+    if not text:
+        return ''
+    normalized_text = unicodedata.normalize('NFD', text)
+    accent_removed_text = ''.join(
+        char for char in normalized_text if unicodedata.category(char) != 'Mn'
+    )
+    return unicodedata.normalize('NFC', accent_removed_text)
+
+
+class TokenCache:
+    """
+    Bounded LRU cache from a token's surface form to its stemmed form. Tokens that are dropped
+    during preprocessing (stopwords, single characters, empty after cleaning) map to ''.
+    Lookups and inserts are locked, as the web app shares one cache between request threads.
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE, track_new=False):
+        self.maxsize = maxsize
+        self.track_new = track_new  # Remember new entries for take_delta (worker processes)
+        self._entries = OrderedDict()
+        self._new_entries = {}
+        self.hits = 0
+        self.misses = 0
+        self._delta_hits = 0
+        self._delta_misses = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, token):
+        """Return the cached stem for `token` (marking it as recently used), or None on a miss."""
+        with self._lock:
+            value = self._entries.get(token)
+            if value is None:
+                self.misses += 1
+                self._delta_misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            self._delta_hits += 1
+            return value
+
+    def put(self, token, value):
+        """Store a stem, evicting the least recently used entry once the cache is full."""
+        with self._lock:
+            self._entries[token] = value
+            self._entries.move_to_end(token)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            if self.track_new:
+                self._new_entries[token] = value
+
+    def take_delta(self):
+        """
+        Return and reset the entries and hit/miss counts collected since the last call, so worker
+        processes can ship what they learned back to the parent.
+        """
+        delta = {"entries": self._new_entries, "hits": self._delta_hits, "misses": self._delta_misses}
+        self._new_entries = {}
+        self._delta_hits = 0
+        self._delta_misses = 0
+        return delta
+
+    def merge_delta(self, delta):
+        """Fold a delta produced by `take_delta` in another process into this cache."""
+        for token, value in delta["entries"].items():
+            self.put(token, value)
+        self.hits += delta["hits"]
+        self.misses += delta["misses"]
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        """Human readable summary of the cache usage."""
+        return (f"{len(self._entries)} entries, {self.hits} hits, {self.misses} misses, "
+                f"hit rate {self.hit_rate:.1%}")
+
+    def save(self, path=CACHE_PATH):
+        """Persist the cache entries (in LRU order) to disk."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(list(self._entries.items()), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        logging.info(f"Saved token cache to {path} ({len(self._entries)} entries).")
+
+    @classmethod
+    def load(cls, path=CACHE_PATH, maxsize=CACHE_SIZE, track_new=False):
+        """Load a cache persisted by `save`, or return an empty cache if there is none."""
+        cache = cls(maxsize)
+        path = Path(path)
+        if path.exists():
+            try:
+                with open(path, "rb") as f:
+                    for token, value in pickle.load(f):
+                        cache.put(token, value)
+            except Exception as e:
+                logging.warning(f"Could not load token cache from {path}: {e}")
+        cache.track_new = track_new
+        return cache
+
+
+def stem_token(token_text, stemmer, greek_stopwords, cache):
+    """
+    Clean, uppercase, de-accent and stem a single token, memoising the result by surface form.
+    Returns '' for tokens that should be dropped.
+    """
+    cached = cache.get(token_text)
+    if cached is not None:
+        return cached
+
+    # Remove unwanted patterns
+    cleaned_token = UNWANTED_PATTERN.sub('', token_text)
+    cleaned_token = TAB_PATTERN.sub('', cleaned_token)
+
+    # Uppercase the word and remove accents before passing to stemmer
+    cleaned_token = remove_accents(cleaned_token.upper())
+
+    # Skip if token is empty, a stopword, or a single character
+    if (not cleaned_token) or (cleaned_token.lower() in greek_stopwords) or (len(cleaned_token) == 1):
+        stemmed = ''
+    else:
+        try:
+            stemmed = stemmer.stem(cleaned_token) or ''
+        except Exception as e:
+            logging.warning(f"Error stemming word '{cleaned_token}': {e}")
+            stemmed = ''
+
+    cache.put(token_text, stemmed)
+    return stemmed
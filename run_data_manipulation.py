@@ -1,63 +1,131 @@
+import argparse
+
 # Import the necessary functions from the modules
+from modules.pipeline import Stage, run_pipeline, resolve_dependencies, mark_up_to_date, MAX_PARALLEL_STAGES
 from modules.cluster_speeches import perform_clustering
-from modules.import_csv_to_db import import_csv_to_postgresql
+from modules.import_csv_to_db import import_csv_to_postgresql, csv_file_path
 from modules.create_final_speeches import create_final_speeches_table
-from modules.clear_null_values import delete_null_member_name_rows
+from modules.create_dimensions import create_dimension_tables
 from modules.preprocess import  create_processed_speeches_table,preprocess_and_store_speeches
 from modules.create_tf_idf import process_corpus_and_insert
 from modules.create_indexes import create_indexes
 from modules.create_member_similarity import process_member_similarity
 from modules.lsi import apply_lsi_parallel
+from modules.create_speech_neighbours import create_speech_neighbours
+from modules.create_lsi_index import build_lsi_index, LSI_INDEX_PATH
+from modules.create_search_index import build_search_index, SEARCH_INDEX_PATH
+from modules.artifact_store import CURRENT_LINK
+from modules.create_keyword_trends import create_keyword_trends
+from modules.append_speeches import append_speeches, clear_pending_appends
+
+
+def preprocess_speeches():
+    create_processed_speeches_table()
+    preprocess_and_store_speeches()
+
 
-def run_data_pipeline():
+# The pipeline as a graph: a stage runs after the stages producing its inputs (and those in `after`),
+# and is skipped when its inputs haven't changed since its last successful run.
+STAGES = [
+    Stage("import_csv", import_csv_to_postgresql,
+          inputs=[f"file:{csv_file_path}"], outputs=["speeches"]),
+    Stage("final_speeches", create_final_speeches_table,
+          inputs=["speeches"], outputs=["final_speeches"]),
+    Stage("dimensions", create_dimension_tables,
+          inputs=["final_speeches"], outputs=["members", "parties"]),
+    Stage("preprocess", preprocess_speeches,
+          inputs=["final_speeches"], outputs=["processed_speeches"]),
+    Stage("tfidf", process_corpus_and_insert,
+          inputs=["processed_speeches"], outputs=["terms", "tfidf_postings", "speech_stats"]),
+    Stage("indexes", create_indexes,
+          inputs=["terms"]),
+    Stage("search_index", build_search_index,
+          inputs=["terms", "tfidf_postings"], outputs=[f"file:{SEARCH_INDEX_PATH / CURRENT_LINK / 'meta.json'}"]),
+    # Both reuse the stored TF-IDF model, so they wait for the tfidf stage
+    Stage("member_similarity", process_member_similarity,
+          inputs=["processed_speeches"], outputs=["member_similarity_scores"], after=["tfidf"]),
+    Stage("keyword_trends", create_keyword_trends,
+          inputs=["processed_speeches", "final_speeches"], outputs=["keyword_trends"], after=["tfidf"]),
+    Stage("lsi", apply_lsi_parallel,
+          inputs=["processed_speeches"], outputs=["lsi_speeches"]),
+    Stage("clustering", perform_clustering,
+          inputs=["lsi_speeches"], outputs=["clustered_speeches", "cluster_centroids", "cluster_summary"]),
+    Stage("speech_neighbours", create_speech_neighbours,
+          inputs=["lsi_speeches", "clustered_speeches"], outputs=["speech_neighbours"]),
+    Stage("lsi_index", build_lsi_index,
+          inputs=["lsi_speeches"], outputs=[f"file:{LSI_INDEX_PATH / CURRENT_LINK / 'meta.json'}"]),
+]
+
+
+def run_data_pipeline(only=None, start_from=None, force=False, max_parallel=MAX_PARALLEL_STAGES, force_from=()):
     """
-    Run the data manipulation pipeline sequentially.
+    Run the data manipulation pipeline. Stages whose inputs are unchanged are skipped (unless they are
+    in or downstream of `force_from`) and independent stages run in parallel; returns True if every
+    stage succeeded or was up to date.
     """
-    try:
-
-        print("Starting the data manipulation pipeline...")
-        # Step 1: Import CSV to Database
-        print("\nStep 1: Importing CSV into the database...")
-        import_csv_to_postgresql()
-        print("Step 1 completed\n")
-
-        # Step 2: Create `final_speeches` table
-        print("Step 2: Creating the `final_speeches` table...")
-        create_final_speeches_table()
-        print("Step 2 completed\n")
-
-        # Step 3: Clear rows with NULL `member_name`
-        print("Step 3: Cleaning `final_speeches` table by removing rows with NULL `member_name`...")
-        delete_null_member_name_rows()
-        print("Step 3 completed\n")
-        
-        print("Step 4: Preprocessing , TF-IDF calculation  process...")
-        create_processed_speeches_table()
-        preprocess_and_store_speeches()
-
-        print("Step 4 completed\n ")
-        print("Step 5: Create Indexes using GIN postgres' indexing")
-        create_indexes()
-        print("Step 5: Completed \n")
-
-        print("Step 6 : Creating member_similarity table")
-        process_member_similarity()
-        print("Step 6: Completed\n")
-
-        print("Step 7 : Creating lsi vectors  table")
-        apply_lsi_parallel()
-        print("Step 7: Completed \n")
-
-        print("Step 8 : Creating clusters  table")
-        perform_clustering()
+    print("Starting the data manipulation pipeline...")
+    report = run_pipeline(STAGES, only=only, start_from=start_from, force=force, max_parallel=max_parallel,
+                          force_from=force_from)
+
+    print("\nStage timings:")
+    for stage in STAGES:
+        if stage.name in report:
+            status, seconds = report[stage.name]
+            print(f"  {stage.name:<20} {status:<12} {seconds:8.1f}s")
 
+    if all(status in ("succeeded", "up to date") for status, _ in report.values()):
         print("Data manipulation pipeline completed successfully.")
+        return True
+    print("The pipeline finished with failed stages, see the log above.")
+    return False
 
 
+# Stages whose outputs an append updates in place; the model stages only when the new speeches were folded in
+APPEND_STAGES = ["final_speeches", "preprocess"]
+FOLD_IN_STAGES = ["tfidf", "lsi", "clustering"]
 
 
-    except Exception as e:
-        print(f"An error occurred during the pipeline: {e}")
+def append_and_refresh(csv_path, max_parallel=MAX_PARALLEL_STAGES):
+    """
+    Append a CSV of new sittings (see modules/append_speeches.py), then run the pipeline so the
+    stages derived from the changed tables (dimensions, neighbours, indexes, trends...) catch up.
+    If the new speeches weren't folded in, the model stages and everything after them are forced to
+    rerun, since their stored models are what is out of date; once that succeeds the speeches no
+    longer need folding in.
+    """
+    result = append_speeches(csv_path)
+    covered = APPEND_STAGES + (FOLD_IN_STAGES if result["folded_in"] else [])
+    mark_up_to_date([stage for stage in STAGES if stage.name in covered])
+    if result["folded_in"]:
+        return run_data_pipeline(max_parallel=max_parallel)
+    print("The new speeches weren't folded into the stored models, refitting them.")
+    if not run_data_pipeline(max_parallel=max_parallel, force_from=FOLD_IN_STAGES):
+        return False
+    clear_pending_appends()
+    return True
+
+
+def print_stages():
+    dependencies = resolve_dependencies(STAGES)
+    for stage in STAGES:
+        after = ", ".join(sorted(dependencies[stage.name])) or "-"
+        print(f"{stage.name:<20} after: {after}")
+
 
 if __name__ == "__main__":
-    run_data_pipeline()
+    parser = argparse.ArgumentParser(description="Run the Greek Parliament data pipeline.")
+    parser.add_argument("--from", dest="start_from", help="rerun this stage and everything downstream of it")
+    parser.add_argument("--only", nargs="+", help="run only these stages")
+    parser.add_argument("--force", action="store_true", help="run the selected stages even if their inputs are unchanged")
+    parser.add_argument("--jobs", type=int, default=MAX_PARALLEL_STAGES, help="stages run at once (1 runs them in this process)")
+    parser.add_argument("--list", action="store_true", help="list the stages and their dependencies")
+    parser.add_argument("--append", metavar="CSV", help="append the sittings of a delta CSV instead of rebuilding")
+    args = parser.parse_args()
+
+    if args.list:
+        print_stages()
+    elif args.append:
+        if not append_and_refresh(args.append, args.jobs):
+            raise SystemExit(1)
+    elif not run_data_pipeline(args.only, args.start_from, args.force, args.jobs):
+        raise SystemExit(1)